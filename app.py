@@ -1,65 +1,118 @@
-import os
 import logging
+import os
 import sys
 from flask import Flask, jsonify
 from flask_cors import CORS
 from dotenv import load_dotenv
-from apscheduler.schedulers.background import BackgroundScheduler
-
-# Import blueprints and utility functions
-from blueprints.auth import auth_bp, init_bcrypt
-from blueprints.users import users_bp
-from blueprints.admin import admin_bp
-from blueprints.mpesa import mpesa_bp
-from utils.subscription_manager import expired_subscriptions
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from utils.config import get_section, load_config
 from utils.db import get_db_connection
-from blueprints.error_handlers import register_error_handlers
-
-# Ensure logs directory exists
-if not os.path.exists("logs"):
-    os.makedirs("logs")
-
-# Configure logging for both file and console
-log_file = "logs/wiman.log"
-logging.basicConfig(
-    level=logging.DEBUG,  # Set to DEBUG to capture all messages
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler(log_file),  # Logs to file
-        logging.StreamHandler(sys.stdout)  # Logs to terminal
-    ]
-)
-
-app = Flask(__name__)
-CORS(app, origins=["http://localhost:5173"])
-register_error_handlers(app)
-app.config['SECRET_KEY'] = os.getenv("SECRET_KEY", "12345678")
-
-init_bcrypt(app)
-
-# Register blueprints
-app.register_blueprint(auth_bp, url_prefix='/auth')
-app.register_blueprint(users_bp, url_prefix='/users')
-app.register_blueprint(admin_bp, url_prefix='/admin')
-app.register_blueprint(mpesa_bp, url_prefix='/mpesa')
-
-# Add a root route to prevent 404 errors
-@app.route('/')
-def home():
-    app.logger.debug("Home route accessed")
-    return {"message": "Welcome to WIMAN API!"}, 200
-
-@app.route("/api/test")
-def test_api():
-    app.logger.info("Test API route accessed")
-    return jsonify({"message": "API is working!"})
-
-# Scheduler for expired subscriptions
-scheduler = BackgroundScheduler()
-scheduler.add_job(expired_subscriptions, 'interval', hours=12)  # Runs every 12 hours
-scheduler.start()
+
+
+def create_app(config=None, start_background=True):
+    """Builds the Flask app.
+
+    ``config`` is the path of an ini file to read instead of config.ini, or
+    a {section: {key: value}} mapping applied on top of config.ini. Building
+    the app only sets up logging and routes: the DB pool, the mail and
+    M-Pesa clients, the bcrypt pool and the expiry engine are created on
+    first use. Pre-fork servers pass ``start_background=False`` and call
+    start_background_jobs() in each worker instead (see gunicorn.conf.py).
+
+    Settings are read once per process: logging is configured by the first
+    call, and modules such as the blueprints copy their limits into
+    constants when first imported. A ``config`` passed to a later call only
+    reaches code that reads get_section() at call time, so tests and
+    benchmarks that need different settings build the app in a fresh
+    process.
+    """
+    if config and 'blueprints.auth' in sys.modules:
+        logging.getLogger(__name__).warning("create_app(config) called after the app was first built; "
+                                            "logging and import-time settings keep their old values")
+    if isinstance(config, str):
+        load_config(config)
+    elif config:
+        load_config(overrides=config)
+
+    # Imported here so modules that read settings at import time see the config loaded above
+    from blueprints.auth import auth_bp
+    from blueprints.users import users_bp
+    from blueprints.admin import admin_bp
+    from blueprints.mpesa import mpesa_bp
+    from blueprints.accounting import accounting_bp
+    from blueprints.error_handlers import register_error_handlers
+    from utils.db import init_db
+    from utils.logging_config import configure_logging
+    from utils.metrics import init_metrics
+
+    # Queue-based logging: records are written to the rotating log file and
+    # stdout by a background thread, configured from [logging] in config.ini
+    configure_logging()
+
+    app = Flask(__name__)
+    proxy_hops = get_section('app').getint('proxy_hops', 0)
+    if proxy_hops:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxy_hops, x_proto=proxy_hops)
+    origins = get_section('app').get('cors_origins', 'http://localhost:5173')
+    CORS(app, origins=[origin.strip() for origin in origins.split(',') if origin.strip()])
+    register_error_handlers(app)
+    app.config['SECRET_KEY'] = os.getenv("SECRET_KEY", "12345678")
+
+    init_db(app)
+    init_metrics(app)
+
+    # Register blueprints
+    app.register_blueprint(auth_bp, url_prefix='/auth')
+    app.register_blueprint(users_bp, url_prefix='/users')
+    app.register_blueprint(admin_bp, url_prefix='/admin')
+    app.register_blueprint(mpesa_bp, url_prefix='/mpesa')
+    app.register_blueprint(accounting_bp, url_prefix='/accounting')
+
+    # Add a root route to prevent 404 errors
+    @app.route('/')
+    def home():
+        app.logger.debug("Home route accessed")
+        return {"message": "Welcome to WIMAN API!"}, 200
+
+    @app.route("/api/test")
+    def test_api():
+        app.logger.info("Test API route accessed")
+        return jsonify({"message": "API is working!"})
+
+    if start_background:
+        start_background_jobs()
+    return app
+
+
+def start_background_jobs():
+    """Registers the periodic jobs and starts the scheduler thread in this process.
+
+    The sweep catches up on subscriptions the expiry engine missed and
+    reloads its upcoming deadlines; reconciliation settles STK checkouts
+    whose callback never came. Jobs run in whichever worker currently
+    holds the scheduler lock; registering again replaces the job. The
+    mailer is started here too, so mail spooled before a restart goes out
+    without waiting for the next email to be sent.
+    """
+    from utils.mailer import get_mailer
+    from utils.reconcile import reconcile_payments
+    from utils.revocation import purge_expired_revocations
+    from utils.scheduler import register_job
+    from utils.sessions import purge_stale_sessions
+    from utils.subscription_manager import run_expiry_sweep
+
+    register_job('expire_subscriptions', run_expiry_sweep,
+                 interval=get_section('expiry').getint('sweep_interval_minutes', 10) * 60)
+    register_job('reconcile_payments', reconcile_payments,
+                 interval=get_section('reconcile').getint('interval_minutes', 10) * 60)
+    register_job('purge_token_revocations', purge_expired_revocations, interval=3600, run_at_start=False)
+    register_job('purge_stale_sessions', purge_stale_sessions, interval=600, run_at_start=False)
+    get_mailer()
+
 
 if __name__ == '__main__':
+    app = create_app()
     try:
         app.logger.debug("Testing database connection")
         connection = get_db_connection()
@@ -68,7 +121,7 @@ if __name__ == '__main__':
             app.logger.info("Database connection established!")
     except Exception as e:
         print(f"Database connection error: {e}")
-        app.logger.error(f"Database connection error: {e}")
+        app.logger.error("Database connection error: %s", e)
     finally:
         if 'connection' in locals():
             connection.close()
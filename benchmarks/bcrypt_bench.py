@@ -0,0 +1,72 @@
+"""Measures login password verification throughput through the bcrypt pool.
+
+Usage:
+    python -m benchmarks.bcrypt_bench [--rounds 12] [--workers N] [--clients 32]
+                                      [--logins 200] [--executor thread|process]
+
+Reports verifications (i.e. logins) per second overall and per core, plus
+how many requests the pool rejected as busy.
+"""
+import argparse
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.passwords import PasswordHasher, PasswordPoolBusy
+
+
+def run(rounds, workers, clients, logins, executor, max_queue):
+    hasher = PasswordHasher(rounds=rounds, workers=workers, max_queue=max_queue, executor=executor)
+    password = "correct horse battery staple"
+    stored_hash = hasher.hash(password)
+    hasher.check(stored_hash, password)  # warm the pool up before timing
+
+    rejected = 0
+    lock = threading.Lock()
+
+    def login(_):
+        nonlocal rejected
+        try:
+            assert hasher.check(stored_hash, password)
+        except PasswordPoolBusy:
+            with lock:
+                rejected += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(login, range(logins)))
+    elapsed = time.perf_counter() - started
+    hasher.shutdown()
+
+    completed = logins - rejected
+    return {
+        'rounds': rounds,
+        'workers': hasher.workers,
+        'executor': executor,
+        'clients': clients,
+        'logins': completed,
+        'rejected': rejected,
+        'seconds': round(elapsed, 3),
+        'logins_per_second': round(completed / elapsed, 2),
+        'logins_per_second_per_core': round(completed / elapsed / hasher.workers, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=12)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--max-queue', type=int, default=1000)
+    parser.add_argument('--executor', choices=['thread', 'process'], default='thread')
+    args = parser.parse_args()
+
+    result = run(args.rounds, args.workers, args.clients, args.logins, args.executor, args.max_queue)
+    for key, value in result.items():
+        print(f"{key:>28}: {value}")
+
+
+if __name__ == '__main__':
+    main()
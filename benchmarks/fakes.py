@@ -0,0 +1,315 @@
+"""Local stand-ins for the services the API talks to during a load test.
+
+- FakeDaraja: an HTTP server answering the OAuth, STK push and STK query
+  endpoints.
+- SmtpSink: an SMTP server that accepts and discards every message, or
+  refuses the next ones with the replies it is given.
+- ScratchDatabase: a throwaway database on a local MySQL server, built by
+  the schema migrations and seeded with users, plans and subscriptions.
+"""
+import json
+import socketserver
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import MySQLdb
+
+from utils.migrate import upgrade
+
+PLANS = [
+    # (name, duration, price, bandwidth)
+    ('Basic', 1, 150, '5Mbps'),
+    ('Basic', 7, 300, '5Mbps'),
+    ('Premium', 7, 600, '10Mbps'),
+    ('Premium', 30, 1500, '10Mbps'),
+    ('Enterprise', 30, 3000, '50Mbps'),
+]
+
+# ResultDesc Daraja sends with common STK ResultCodes
+RESULT_DESCRIPTIONS = {
+    0: 'The service request is processed successfully.',
+    1: 'The balance is insufficient for the transaction.',
+    1032: 'Request cancelled by user',
+    1037: 'DS timeout user cannot be reached',
+}
+
+
+def phone_number(index):
+    return f"2547{index:08d}"
+
+
+class _DarajaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, body, status=200, content_type='application/json'):
+        payload = body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        self.server.calls['oauth'] += 1
+        if self.server.oauth_body is not None:
+            self._reply(self.server.oauth_body, content_type='text/html')
+            return
+        token = uuid.uuid4().hex
+        self.server.tokens.add(token)
+        self._reply({'access_token': token, 'expires_in': self.server.expires_in})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        time.sleep(self.server.latency)
+        token = self.headers.get('Authorization', '').partition('Bearer ')[2]
+        if token not in self.server.tokens:
+            self.server.calls['unauthorized'] += 1
+            self._reply({'errorCode': '404.001.04', 'errorMessage': 'Invalid Access Token'}, status=401)
+            return
+        if self.path == '/mpesa/stkpushquery/v1/query':
+            self._query(body.get('CheckoutRequestID'))
+            return
+        self.server.calls['stkpush'] += 1
+        self._reply({
+            'MerchantRequestID': uuid.uuid4().hex,
+            'CheckoutRequestID': f"ws_CO_{uuid.uuid4().hex}",
+            'ResponseCode': '0',
+            'ResponseDescription': 'Success. Request accepted for processing',
+            'CustomerMessage': 'Success. Request accepted for processing',
+        })
+
+    def _query(self, checkout_request_id):
+        self.server.calls['stkquery'] += 1
+        result_code = self.server.results.get(checkout_request_id, self.server.default_result)
+        if result_code is None:
+            self._reply({'requestId': uuid.uuid4().hex, 'errorCode': '500.001.1001',
+                         'errorMessage': 'The transaction is being processed'}, status=500)
+            return
+        self._reply({
+            'ResponseCode': '0',
+            'ResponseDescription': 'The service request has been accepted successsfully',
+            'MerchantRequestID': uuid.uuid4().hex,
+            'CheckoutRequestID': checkout_request_id,
+            'ResultCode': str(result_code),
+            'ResultDesc': RESULT_DESCRIPTIONS.get(result_code, 'The transaction failed'),
+        })
+
+
+class _QuietHTTPServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        pass  # clients that time out and hang up are expected
+
+
+class FakeDaraja:
+    """Answers /oauth/v1/generate, STK pushes and STK queries after ``latency`` seconds.
+
+    A query answers with ``results[checkout_request_id]`` if set, else
+    ``default_result``: a ResultCode, or None for a push the customer has
+    not answered yet. Calls with a token it did not issue, or one dropped
+    by revoke_tokens(), get a 401. Setting ``oauth_body`` makes the OAuth
+    endpoint answer with that body instead of a token, like a proxy error
+    page.
+    """
+
+    def __init__(self, latency=0.05, default_result=0, expires_in='3599'):
+        self.server = _QuietHTTPServer(('127.0.0.1', 0), _DarajaHandler)
+        self.server.daemon_threads = True
+        self.server.latency = latency
+        self.server.calls = {'oauth': 0, 'stkpush': 0, 'stkquery': 0, 'unauthorized': 0}
+        self.server.results = {}
+        self.server.default_result = default_result
+        self.server.expires_in = expires_in
+        self.server.tokens = set()
+        self.server.oauth_body = None
+
+    @property
+    def results(self):
+        return self.server.results
+
+    @property
+    def calls(self):
+        return self.server.calls
+
+    def revoke_tokens(self):
+        self.server.tokens.clear()
+
+    @property
+    def latency(self):
+        return self.server.latency
+
+    @latency.setter
+    def latency(self, seconds):
+        self.server.latency = seconds
+
+    @property
+    def oauth_body(self):
+        return self.server.oauth_body
+
+    @oauth_body.setter
+    def oauth_body(self, body):
+        self.server.oauth_body = body
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True, name='fake-daraja').start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _SmtpHandler(socketserver.StreamRequestHandler):
+    def _send(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        with self.server.lock:
+            self.server.connections += 1
+        self._send('220 smtp-sink ready')
+        in_data = False
+        for raw in self.rfile:
+            line = raw.rstrip(b'\r\n')
+            if in_data:
+                if line == b'.':
+                    in_data = False
+                    with self.server.lock:
+                        self.server.messages += 1
+                    self._send('250 OK')
+                continue
+            command = line[:4].upper()
+            if command in (b'EHLO', b'HELO'):
+                self._send('250 smtp-sink')
+            elif command == b'MAIL' and self.server.rejects:
+                with self.server.lock:
+                    reply = self.server.rejects.pop(0) if self.server.rejects else '250 OK'
+                self._send(reply)
+            elif command == b'DATA':
+                in_data = True
+                self._send('354 End data with <CR><LF>.<CR><LF>')
+            elif command == b'QUIT':
+                self._send('221 Bye')
+                return
+            else:  # MAIL, RCPT, NOOP, RSET
+                self._send('250 OK')
+
+
+class SmtpSink:
+    """Minimal plaintext SMTP server that counts and discards messages.
+
+    Replies appended to ``rejects`` (e.g. '451 Try again later') answer the
+    next MAIL commands instead of accepting them, one reply per message.
+    """
+
+    def __init__(self):
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), _SmtpHandler)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.messages = 0
+        self.server.connections = 0
+        self.server.rejects = []
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    @property
+    def messages(self):
+        return self.server.messages
+
+    @property
+    def connections(self):
+        return self.server.connections
+
+    @property
+    def rejects(self):
+        return self.server.rejects
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True, name='smtp-sink').start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ScratchDatabase:
+    """Recreates ``database`` on a local MySQL server and seeds it for a run.
+
+    The database is dropped and rebuilt every time so each run starts from
+    the same rows.
+    """
+
+    def __init__(self, host, port, user, password, database='wiman_bench'):
+        self.settings = {'host': host, 'port': port, 'user': user, 'password': password}
+        self.database = database
+
+    def _connect(self, **extra):
+        return MySQLdb.connect(**self.settings, **extra)
+
+    def create(self):
+        db = self._connect()
+        try:
+            cursor = db.cursor()
+            cursor.execute(f"DROP DATABASE IF EXISTS `{self.database}`")
+            cursor.execute(f"CREATE DATABASE `{self.database}`")
+        finally:
+            db.close()
+
+        db = self._connect(database=self.database)
+        try:
+            upgrade(db, log=lambda message: None)
+        finally:
+            db.close()
+        return self
+
+    def seed(self, users, password_hash, subscriptions_per_user=1):
+        """Adds ``users`` active users (bench_user_N) plus bench_admin, the plans and some subscriptions."""
+        db = self._connect(database=self.database)
+        try:
+            cursor = db.cursor()
+            cursor.executemany(
+                "INSERT INTO plans (name, duration) VALUES (%s, %s)",
+                [(name, duration) for name, duration, _, _ in PLANS])
+            cursor.executemany(
+                "INSERT INTO subscription_plans (name, duration_days, price, bandwidth_limit) VALUES (%s, %s, %s, %s)",
+                PLANS)
+            cursor.execute(
+                "INSERT INTO users (username, email, password_hash, phone_number, status, role) "
+                "VALUES ('bench_admin', 'admin@bench.local', %s, %s, 'active', 'admin')",
+                (password_hash, phone_number(0)))
+            for start in range(1, users + 1, 1000):
+                batch = range(start, min(start + 1000, users + 1))
+                cursor.executemany(
+                    "INSERT INTO users (username, email, password_hash, phone_number, status, role) "
+                    "VALUES (%s, %s, %s, %s, 'active', 'user')",
+                    [(f"bench_user_{i}", f"user{i}@bench.local", password_hash, phone_number(i)) for i in batch])
+                # Every user gets one running subscription plus expired ones, spread across the plans.
+                # The database is fresh, so bench_admin is id 1 and bench_user_N is id N + 1.
+                cursor.executemany(
+                    "INSERT INTO subscriptions (user_id, plan_id, expires_at, status) "
+                    "VALUES (%s, %s, NOW() + INTERVAL %s DAY, %s)",
+                    [(i + 1, 1 + (i + n) % len(PLANS), (1 if n == 0 else -1) * (1 + (i + n) % 30),
+                      'active' if n == 0 else 'expired')
+                     for i in batch for n in range(subscriptions_per_user)])
+            db.commit()
+        finally:
+            db.close()
+        return self
+
+    def drop(self):
+        db = self._connect()
+        try:
+            db.cursor().execute(f"DROP DATABASE IF EXISTS `{self.database}`")
+        finally:
+            db.close()
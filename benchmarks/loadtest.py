@@ -0,0 +1,505 @@
+"""Boots the API against local fakes and measures it under realistic traffic mixes.
+
+Usage:
+    python -m benchmarks.loadtest run [--duration 30] [--concurrency 16] [--users 2000]
+                                      [--scenarios login_storm,protected_polling,...]
+                                      [--output bench-results.json]
+    python -m benchmarks.loadtest compare BASELINE.json CURRENT.json
+                                      [--max-throughput-drop 10] [--max-latency-increase 20]
+
+``run`` needs a local MySQL server on which it may create and drop a scratch
+database (BENCH_MYSQL_HOST, BENCH_MYSQL_PORT, BENCH_MYSQL_USER,
+BENCH_MYSQL_PASSWORD; localhost:3306 as root by default). It starts a fake
+Daraja and an SMTP sink, serves the app from a subprocess pointed at them
+through WIMAN_CONFIG, runs each scenario for ``duration`` seconds and writes
+per-endpoint throughput and p50/p95/p99 latency to ``output``.
+
+``compare`` prints the change for every endpoint present in both files and
+exits with status 1 if any of them regressed past the thresholds.
+"""
+import argparse
+import configparser
+import datetime
+import json
+import math
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from urllib.parse import urljoin
+
+import requests
+
+from benchmarks.fakes import PLANS, FakeDaraja, ScratchDatabase, SmtpSink, phone_number
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_PASSWORD = 'bench-password'
+ACCOUNTING_SECRET = 'bench-accounting-secret'
+# Interim updates per accounting request, as an access point batching a few seconds of them
+ACCOUNTING_BATCH = 500
+
+
+class Client:
+    """One simulated client: a keep-alive session whose calls are timed into a shared Recorder."""
+
+    def __init__(self, base_url, recorder):
+        self.base_url = base_url
+        self.recorder = recorder
+        self.session = requests.Session()
+
+    def call(self, endpoint, method, path, expect=(200,), **kwargs):
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, urljoin(self.base_url, path), timeout=30, **kwargs)
+        except requests.RequestException:
+            self.recorder.record(endpoint, time.perf_counter() - started, ok=False)
+            return None
+        self.recorder.record(endpoint, time.perf_counter() - started, ok=response.status_code in expect)
+        return response
+
+    def close(self):
+        self.session.close()
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, elapsed, ok=True):
+        with self._lock:
+            self.samples[endpoint].append(elapsed)
+            if not ok:
+                self.errors[endpoint] += 1
+
+    def summary(self, elapsed):
+        endpoints = {}
+        for endpoint, samples in sorted(self.samples.items()):
+            samples.sort()
+            endpoints[endpoint] = {
+                'requests': len(samples),
+                'errors': self.errors[endpoint],
+                'error_rate': round(self.errors[endpoint] / len(samples), 4),
+                'rps': round(len(samples) / elapsed, 2),
+                'mean_ms': round(sum(samples) / len(samples) * 1000, 3),
+                'p50_ms': round(percentile(samples, 50) * 1000, 3),
+                'p95_ms': round(percentile(samples, 95) * 1000, 3),
+                'p99_ms': round(percentile(samples, 99) * 1000, 3),
+                'max_ms': round(samples[-1] * 1000, 3),
+            }
+        return endpoints
+
+
+def percentile(sorted_samples, p):
+    """Nearest-rank percentile of an already sorted list."""
+    index = max(0, math.ceil(p / 100 * len(sorted_samples)) - 1)
+    return sorted_samples[index]
+
+
+# -- Scenarios --------------------------------------------------------------
+# Each one is a single iteration of a simulated user; ctx is the BenchContext.
+
+def login_storm(ctx, client, rng):
+    username = f"bench_user_{rng.randint(1, ctx.users)}"
+    client.call('POST /auth/login', 'POST', '/auth/login',
+                json={'username': username, 'password': BENCH_PASSWORD})
+
+
+def protected_polling(ctx, client, rng):
+    _, token = rng.choice(ctx.tokens)
+    client.call('GET /users/protected', 'GET', '/users/protected',
+                expect=(200, 403), headers={'x-access-token': token})
+
+
+def subscribe_and_pay(ctx, client, rng):
+    index, token = rng.choice(ctx.tokens)
+    headers = {'x-access-token': token}
+    plan_id = rng.randint(1, len(PLANS))
+    amount = PLANS[plan_id - 1][2]
+    phone = phone_number(index)
+
+    client.call('POST /users/subscribe', 'POST', '/users/subscribe', expect=(201,),
+                headers=headers, json={'plan_id': plan_id})
+    response = client.call('POST /mpesa/pay', 'POST', '/mpesa/pay', expect=(202,), headers=headers,
+                           json={'phone_number': phone, 'amount': amount})
+    if response is None or response.status_code != 202:
+        return
+    handle = response.json()['handle']
+    # Long-poll until the push worker has the CheckoutRequestID, as the frontend does
+    response = client.call('GET /mpesa/pay/<handle>', 'GET', f'/mpesa/pay/{handle}?wait=10&status=queued',
+                           headers=headers)
+    checkout_id = response.json().get('checkout_request_id') if response is not None and response.ok else None
+    client.call('POST /mpesa/mpesa/callback', 'POST', '/mpesa/mpesa/callback',
+                json=stk_callback(checkout_id or f"ws_CO_{uuid.uuid4().hex}", phone, amount))
+
+
+def admin_listing(ctx, client, rng):
+    headers = {'x-access-token': ctx.admin_token}
+    for endpoint, path in (('GET /admin/admin/users', '/admin/admin/users?limit=100'),
+                           ('GET /admin/admin/subscriptions', '/admin/admin/subscriptions?limit=100')):
+        for _ in range(ctx.admin_pages):
+            response = client.call(endpoint, 'GET', path, headers=headers)
+            if response is None or 'next' not in response.links:
+                break
+            path = response.links['next']['url']
+
+
+def accounting_ingest(ctx, client, rng):
+    # Counters grow with the time since the run started, well under any plan's rate
+    elapsed = int(time.monotonic() - ctx.started)
+    updates = []
+    for _ in range(ACCOUNTING_BATCH):
+        user = rng.randint(1, ctx.users)
+        updates.append({
+            'Acct-Status-Type': 'Interim-Update',
+            'Acct-Session-Id': f"{user:08X}-{rng.randint(1, 3)}",
+            'NAS-Identifier': f"ap-{user % 50}",
+            'User-Name': f"bench_user_{user}",
+            'Acct-Session-Time': elapsed,
+            'Acct-Input-Octets': elapsed * 2000,
+            'Acct-Output-Octets': elapsed * 20000,
+        })
+    client.call('POST /accounting/updates', 'POST', '/accounting/updates',
+                headers={'X-Accounting-Secret': ACCOUNTING_SECRET}, json={'updates': updates})
+
+
+# Weighted blend of the above, roughly what a busy hotspot sees
+MIXED_WEIGHTS = [(protected_polling, 70), (login_storm, 15), (subscribe_and_pay, 10), (admin_listing, 5)]
+
+
+def mixed(ctx, client, rng):
+    scenario = rng.choices([s for s, _ in MIXED_WEIGHTS], weights=[w for _, w in MIXED_WEIGHTS])[0]
+    scenario(ctx, client, rng)
+
+
+SCENARIOS = {
+    'login_storm': login_storm,
+    'protected_polling': protected_polling,
+    'subscribe_and_pay': subscribe_and_pay,
+    'admin_listing': admin_listing,
+    'accounting_ingest': accounting_ingest,
+    'mixed': mixed,
+}
+
+
+def stk_callback(checkout_id, phone, amount):
+    """A successful STK callback body as Safaricom sends it."""
+    return {"Body": {"stkCallback": {
+        "MerchantRequestID": uuid.uuid4().hex,
+        "CheckoutRequestID": checkout_id,
+        "ResultCode": 0,
+        "ResultDesc": "The service request is processed successfully.",
+        "CallbackMetadata": {"Item": [
+            {"Name": "Amount", "Value": amount},
+            {"Name": "MpesaReceiptNumber", "Value": uuid.uuid4().hex[:10].upper()},
+            {"Name": "TransactionDate", "Value": int(time.strftime('%Y%m%d%H%M%S'))},
+            {"Name": "PhoneNumber", "Value": int(phone)},
+        ]},
+    }}}
+
+
+class BenchContext:
+    def __init__(self, base_url, users, admin_pages):
+        self.base_url = base_url
+        self.users = users
+        self.admin_pages = admin_pages
+        self.tokens = []  # (user index, access token)
+        self.admin_token = None
+        self.started = time.monotonic()
+
+    def log_in(self, token_users):
+        """Logs in the users the token-based scenarios act as; not part of the measurements."""
+        session = requests.Session()
+
+        def token(username):
+            response = session.post(urljoin(self.base_url, '/auth/login'),
+                                    json={'username': username, 'password': BENCH_PASSWORD}, timeout=30)
+            response.raise_for_status()
+            return response.json()['access_token']
+
+        self.admin_token = token('bench_admin')
+        self.tokens = [(i, token(f"bench_user_{i}")) for i in range(1, min(token_users, self.users) + 1)]
+        session.close()
+
+
+def run_scenario(ctx, scenario, duration, concurrency, seed):
+    recorder = Recorder()
+    deadline = time.monotonic() + duration
+
+    def worker(n):
+        rng = random.Random(seed * 1000 + n)
+        client = Client(ctx.base_url, recorder)
+        try:
+            while time.monotonic() < deadline:
+                scenario(ctx, client, rng)
+        finally:
+            client.close()
+
+    threads = [threading.Thread(target=worker, args=(n,), daemon=True) for n in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return {'seconds': round(elapsed, 3), 'endpoints': recorder.summary(elapsed)}
+
+
+# -- App under test ---------------------------------------------------------
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def write_config(path, workdir, database, smtp_port, bcrypt_rounds, pool_size):
+    """config.ini with the database, SMTP and log settings pointed at the benchmark fakes."""
+    config = configparser.ConfigParser()
+    config.read(os.path.join(ROOT, 'config.ini'))
+    for section in ('database', 'smtp', 'logging', 'security', 'ratelimit', 'stk'):
+        if not config.has_section(section):
+            config.add_section(section)
+    config['database'].update({
+        'host': database.settings['host'],
+        'port': str(database.settings['port']),
+        'user': database.settings['user'],
+        'password': database.settings['password'],
+        'database': database.database,
+        'pool_size': str(pool_size),
+    })
+    config['smtp'].update({
+        'host': '127.0.0.1', 'port': str(smtp_port), 'use_tls': 'False',
+        'username': '', 'password': '', 'spool_dir': os.path.join(workdir, 'spool'),
+    })
+    config['logging'].update({
+        'file': os.path.join(workdir, 'wiman.log'), 'console': 'False', 'level': 'WARNING',
+    })
+    config['security']['bcrypt_rounds'] = str(bcrypt_rounds)
+    # Every simulated client comes from 127.0.0.1; the limits would measure the limiter, not the API
+    config['ratelimit']['enabled'] = 'False'
+    # The werkzeug server below starts a thread per request, so there is no thread pool for waiters to exhaust
+    config['stk']['max_waiters'] = '10000'
+    with open(path, 'w') as f:
+        config.write(f)
+
+
+def start_app(config_path, daraja_url, port):
+    env = dict(os.environ,
+               WIMAN_CONFIG=config_path,
+               SECRET_KEY='bench-secret-key',
+               ACCOUNTING_SECRET=ACCOUNTING_SECRET,
+               MPESA_BASE_URL=daraja_url,
+               MPESA_CONSUMER_KEY='bench', MPESA_CONSUMER_SECRET='bench',
+               MPESA_SHORTCODE='174379', MPESA_PASSKEY='bench',
+               MPESA_CALLBACK_URL=f"http://127.0.0.1:{port}/mpesa/mpesa/callback")
+    process = subprocess.Popen([sys.executable, '-m', 'benchmarks.loadtest', 'serve', '--port', str(port)],
+                               cwd=ROOT, env=env)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"App exited during startup with status {process.returncode}")
+        try:
+            requests.get(f"http://127.0.0.1:{port}/", timeout=1)
+            return process
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("App did not start within 60s")
+
+
+def serve(port):
+    """Entry point of the app subprocess (configured through its environment)."""
+    from werkzeug.serving import make_server
+
+    from app import create_app
+    make_server('127.0.0.1', port, create_app(), threaded=True).serve_forever()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    import bcrypt
+
+    database = ScratchDatabase(
+        host=os.getenv('BENCH_MYSQL_HOST', '127.0.0.1'),
+        port=int(os.getenv('BENCH_MYSQL_PORT', 3306)),
+        user=os.getenv('BENCH_MYSQL_USER', 'root'),
+        password=os.getenv('BENCH_MYSQL_PASSWORD', ''),
+        database=args.database,
+    )
+    password_hash = bcrypt.hashpw(BENCH_PASSWORD.encode(), bcrypt.gensalt(args.bcrypt_rounds)).decode()
+    print(f"Seeding {args.users} users into {args.database}...")
+    database.create().seed(args.users, password_hash, subscriptions_per_user=args.subscriptions_per_user)
+
+    daraja = FakeDaraja(latency=args.daraja_latency / 1000).start()
+    smtp = SmtpSink().start()
+    port = free_port()
+    process = None
+    results = {}
+    try:
+        with tempfile.TemporaryDirectory(prefix='wiman-bench-') as workdir:
+            config_path = os.path.join(workdir, 'config.ini')
+            write_config(config_path, workdir, database, smtp.port, args.bcrypt_rounds,
+                         pool_size=max(10, args.concurrency))
+            process = start_app(config_path, daraja.url, port)
+
+            ctx = BenchContext(f"http://127.0.0.1:{port}", args.users, args.admin_pages)
+            ctx.log_in(args.token_users)
+            for name in args.scenarios:
+                print(f"Running {name} for {args.duration}s with {args.concurrency} clients...")
+                results[name] = run_scenario(ctx, SCENARIOS[name], args.duration, args.concurrency, args.seed)
+                print_scenario(name, results[name])
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+        daraja.stop()
+        smtp.stop()
+        if not args.keep_database:
+            database.drop()
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'settings': {key: getattr(args, key) for key in (
+                'duration', 'concurrency', 'users', 'token_users', 'bcrypt_rounds',
+                'daraja_latency', 'admin_pages', 'subscriptions_per_user', 'seed')},
+        },
+        'scenarios': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+def print_scenario(name, result):
+    print(f"\n{name} ({result['seconds']}s)")
+    print(f"  {'endpoint':<34}{'requests':>9}{'errors':>8}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for endpoint, stats in result['endpoints'].items():
+        print(f"  {endpoint:<34}{stats['requests']:>9}{stats['errors']:>8}{stats['rps']:>10}"
+              f"{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}")
+    print()
+
+
+# -- Comparison -------------------------------------------------------------
+
+def compare(baseline, current, max_throughput_drop, max_latency_increase, min_latency_delta, max_error_increase):
+    """Returns a list of regression descriptions; prints a per-endpoint table as it goes."""
+    regressions = []
+    print(f"{'scenario / endpoint':<52}{'rps':>16}{'p95 ms':>20}{'p99 ms':>20}")
+    for scenario, result in current['scenarios'].items():
+        base_endpoints = baseline['scenarios'].get(scenario, {}).get('endpoints', {})
+        for endpoint, stats in result['endpoints'].items():
+            base = base_endpoints.get(endpoint)
+            if base is None:
+                continue
+            label = f"{scenario} / {endpoint}"
+            problems = []
+
+            rps_change = change(base['rps'], stats['rps'])
+            if rps_change is not None and -rps_change > max_throughput_drop:
+                problems.append(f"throughput down {-rps_change:.1f}%")
+            for key in ('p95_ms', 'p99_ms'):
+                latency_change = change(base[key], stats[key])
+                if latency_change is not None and latency_change > max_latency_increase \
+                        and stats[key] - base[key] > min_latency_delta:
+                    problems.append(f"{key[:3]} up {latency_change:.1f}%")
+            if stats['error_rate'] - base['error_rate'] > max_error_increase:
+                problems.append(f"error rate {base['error_rate']:.2%} -> {stats['error_rate']:.2%}")
+
+            print(f"{label:<52}{format_change(base['rps'], stats['rps']):>16}"
+                  f"{format_change(base['p95_ms'], stats['p95_ms']):>20}"
+                  f"{format_change(base['p99_ms'], stats['p99_ms']):>20}"
+                  f"{'  REGRESSION: ' + ', '.join(problems) if problems else ''}")
+            regressions.extend(f"{label}: {problem}" for problem in problems)
+    return regressions
+
+
+def change(before, after):
+    """Percentage change, or None when there is no baseline to compare against."""
+    if not before:
+        return None
+    return (after - before) / before * 100
+
+
+def format_change(before, after):
+    percent = change(before, after)
+    return f"{after:g} ({percent:+.1f}%)" if percent is not None else f"{after:g}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='run the scenarios and write a results file')
+    run_parser.add_argument('--scenarios', type=lambda value: value.split(','), default=list(SCENARIOS))
+    run_parser.add_argument('--duration', type=float, default=30, help='seconds per scenario')
+    run_parser.add_argument('--concurrency', type=int, default=16)
+    run_parser.add_argument('--users', type=int, default=2000)
+    run_parser.add_argument('--token-users', type=int, default=200,
+                            help='users logged in up front for the token-based scenarios')
+    run_parser.add_argument('--subscriptions-per-user', type=int, default=3)
+    run_parser.add_argument('--admin-pages', type=int, default=3)
+    run_parser.add_argument('--bcrypt-rounds', type=int, default=12)
+    run_parser.add_argument('--daraja-latency', type=float, default=50, help='fake Daraja latency in ms')
+    run_parser.add_argument('--seed', type=int, default=1)
+    run_parser.add_argument('--database', default='wiman_bench')
+    run_parser.add_argument('--keep-database', action='store_true')
+    run_parser.add_argument('--output', default='bench-results.json')
+
+    compare_parser = commands.add_parser('compare', help='compare two results files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--max-throughput-drop', type=float, default=10, help='percent')
+    compare_parser.add_argument('--max-latency-increase', type=float, default=20, help='percent, p95 and p99')
+    compare_parser.add_argument('--min-latency-delta', type=float, default=1,
+                                help='ms; smaller p95/p99 increases are treated as noise')
+    compare_parser.add_argument('--max-error-increase', type=float, default=0.01, help='absolute error rate')
+
+    serve_parser = commands.add_parser('serve', help=argparse.SUPPRESS)
+    serve_parser.add_argument('--port', type=int, required=True)
+
+    args = parser.parse_args()
+    if args.command == 'serve':
+        serve(args.port)
+    elif args.command == 'run':
+        unknown = set(args.scenarios) - set(SCENARIOS)
+        if unknown:
+            parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+        run(args)
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        regressions = compare(baseline, current, args.max_throughput_drop, args.max_latency_increase,
+                              args.min_latency_delta, args.max_error_increase)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s):")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("\nNo regressions.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""Runs the payment reconciliation job against a fake Daraja and checks what it wrote.
+
+Usage:
+    python -m benchmarks.reconcile_bench [--checkouts 20000] [--users 2000] [--workers 8]
+                                         [--daraja-latency 50] [--output reconcile-results.json]
+
+Needs a local MySQL server like the load test (BENCH_MYSQL_* variables).
+It seeds a scratch database with ``checkouts`` STK checkouts an hour old,
+as if every callback had been lost: most still pending, some paid whose
+payment was never written, some that never left the push queue. The fake
+Daraja answers each STK query with paid, cancelled, failed or still
+processing. The job is then run twice and the script exits with status 1
+unless:
+
+- every paid checkout has exactly one payments row, and nothing else has one
+- cancelled and failed checkouts were settled, still-processing ones left pending
+- the second run backfilled nothing
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import uuid
+
+from benchmarks.fakes import FakeDaraja, ScratchDatabase, phone_number
+from benchmarks.loadtest import git_commit
+
+# Share of pending checkouts Daraja reports as each ResultCode; None is "still being processed"
+QUERY_RESULTS = [(0, 0.7), (1032, 0.12), (1037, 0.03), (1, 0.05), (None, 0.1)]
+# Share of checkouts seeded as paid without a payment, and as never pushed
+PAID_SHARE = 0.05
+QUEUED_SHARE = 0.02
+
+
+def seed_checkouts(database, daraja, count, users, seed):
+    """Inserts the checkouts and tells the fake Daraja how to answer for each; returns the expected outcomes."""
+    rng = random.Random(seed)
+    codes = [code for code, _ in QUERY_RESULTS]
+    weights = [weight for _, weight in QUERY_RESULTS]
+    expected = {'paid': 0, 'pending': 0, 'cancelled': 0, 'failed': 0}
+    rows = []
+    for index in range(count):
+        user = 1 + rng.randint(1, users)  # bench_user_N is id N + 1
+        checkout_request_id = f"ws_CO_{uuid.uuid4().hex}"
+        roll = rng.random()
+        if roll < QUEUED_SHARE:
+            status, checkout_request_id, receipt = 'queued', None, None
+            expected['failed'] += 1
+        elif roll < QUEUED_SHARE + PAID_SHARE:
+            status, receipt = 'paid', f"R{index:09d}"
+            expected['paid'] += 1
+        else:
+            status, receipt = 'pending', None
+            code = rng.choices(codes, weights)[0]
+            daraja.results[checkout_request_id] = code
+            if code is None:
+                expected['pending'] += 1
+            elif code == 0:
+                expected['paid'] += 1
+            else:
+                expected['cancelled' if code in (1032, 1037) else 'failed'] += 1
+        rows.append((uuid.uuid4().hex, user, phone_number(user - 1), 10 + index % 500, status,
+                     checkout_request_id, receipt))
+
+    db = database._connect(database=database.database)
+    try:
+        cursor = db.cursor()
+        for start in range(0, len(rows), 1000):
+            cursor.executemany(
+                "INSERT INTO stk_checkouts (handle, user_id, phone_number, amount, status, checkout_request_id, "
+                "receipt_number, created_at) VALUES (%s, %s, %s, %s, %s, %s, %s, NOW() - INTERVAL 1 HOUR)",
+                rows[start:start + 1000])
+        db.commit()
+    finally:
+        db.close()
+    return expected
+
+
+def check(database, expected, second_run):
+    """Returns the list of problems found in the database after both runs."""
+    db = database._connect(database=database.database)
+    try:
+        cursor = db.cursor()
+        cursor.execute("SELECT status, COUNT(*) FROM stk_checkouts GROUP BY status")
+        statuses = dict(cursor.fetchall())
+        cursor.execute(
+            "SELECT COUNT(*), COUNT(DISTINCT p.checkout_request_id), SUM(c.status = 'paid') "
+            "FROM payments p LEFT JOIN stk_checkouts c ON c.checkout_request_id = p.checkout_request_id")
+        payments, distinct, for_paid = cursor.fetchone()
+    finally:
+        db.close()
+
+    problems = []
+    for status, count in expected.items():
+        if statuses.get(status, 0) != count:
+            problems.append(f"{statuses.get(status, 0)} checkouts are {status}, expected {count}")
+    if payments != expected['paid'] or distinct != payments or for_paid != payments:
+        problems.append(f"{payments} payments ({distinct} distinct checkouts, {for_paid} paid), "
+                        f"expected one for each of the {expected['paid']} paid checkouts")
+    if second_run['backfilled']:
+        problems.append(f"the second run backfilled {second_run['backfilled']} payments")
+    return problems
+
+
+def run(args):
+    database = ScratchDatabase(
+        host=os.getenv('BENCH_MYSQL_HOST', '127.0.0.1'),
+        port=int(os.getenv('BENCH_MYSQL_PORT', 3306)),
+        user=os.getenv('BENCH_MYSQL_USER', 'root'),
+        password=os.getenv('BENCH_MYSQL_PASSWORD', ''),
+        database=args.database,
+    )
+    print(f"Seeding {args.users} users and {args.checkouts} checkouts into {args.database}...")
+    database.create().seed(args.users, '!', subscriptions_per_user=1)
+    daraja = FakeDaraja(latency=args.daraja_latency / 1000).start()
+    os.environ.update(MPESA_BASE_URL=daraja.url, MPESA_CONSUMER_KEY='bench', MPESA_CONSUMER_SECRET='bench',
+                      MPESA_SHORTCODE='174379', MPESA_PASSKEY='bench')
+    try:
+        expected = seed_checkouts(database, daraja, args.checkouts, args.users, args.seed)
+        with tempfile.TemporaryDirectory(prefix='wiman-reconcile-') as workdir:
+            from utils.config import load_config
+            load_config(overrides={
+                'database': {
+                    'host': database.settings['host'], 'port': str(database.settings['port']),
+                    'user': database.settings['user'], 'password': database.settings['password'],
+                    'database': database.database, 'pool_size': str(args.workers + 2),
+                },
+                'daraja': {'pool_size': str(args.workers)},
+                'logging': {'file': os.path.join(workdir, 'wiman.log'), 'console': 'False'},
+            })
+            from utils.logging_config import configure_logging
+            from utils.reconcile import Reconciler
+
+            configure_logging()
+            reconciler = Reconciler(workers=args.workers, chunk_size=args.chunk_size, min_age=60)
+            runs = []
+            for attempt in ('first', 'second'):
+                summary = reconciler.run()
+                runs.append(summary)
+                rate = summary['checked'] / summary['seconds'] if summary['seconds'] else 0
+                print(f"{attempt} run: {rate:,.0f} checkouts/s, "
+                      + ', '.join(f"{key}={value}" for key, value in summary.items()))
+        print(f"STK queries answered by the fake Daraja: {daraja.server.calls['stkquery']}")
+        problems = check(database, expected, runs[1])
+    finally:
+        daraja.stop()
+        if not args.keep_database:
+            database.drop()
+
+    for problem in problems:
+        print(f"FAIL: {problem}")
+    if not problems:
+        print("OK: payments and checkout states match what Daraja reported")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'meta': {'commit': git_commit(), 'settings': {key: getattr(args, key) for key in (
+                    'checkouts', 'users', 'workers', 'chunk_size', 'daraja_latency', 'seed')}},
+                'expected': expected,
+                'runs': runs,
+                'problems': problems,
+            }, f, indent=2)
+        print(f"Wrote {args.output}")
+    return 1 if problems else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--checkouts', type=int, default=20000)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--chunk-size', type=int, default=500)
+    parser.add_argument('--daraja-latency', type=float, default=50, help='fake Daraja latency in ms')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--database', default='wiman_reconcile_bench')
+    parser.add_argument('--keep-database', action='store_true')
+    parser.add_argument('--output')
+    sys.exit(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""Measures how long the API takes to start and how much memory a fresh process holds.
+
+Usage:
+    python -m benchmarks.startup_bench [--runs 10] [--output startup-results.json]
+
+Every run starts a new interpreter, so imports are cold (apart from the OS
+file cache), and records:
+
+- import_ms: importing app (Flask, CORS and the config only)
+- create_app_ms: create_app(start_background=False), which imports the
+  blueprints and utils and registers the routes
+- first_request_ms: GET / through the test client
+- rss_mb: peak resident memory of the process after the first request
+- baseline_rss_mb: the same for a bare interpreter, for comparison
+- threads and modules: threads alive and modules loaded after create_app
+
+No database or network access is needed: building the app must not open
+connections, and the benchmark fails if it tries to. The median of each
+figure is printed, and written to ``output`` with every run when given.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FIELDS = ['import_ms', 'create_app_ms', 'first_request_ms', 'rss_mb', 'baseline_rss_mb', 'threads', 'modules']
+
+
+def _peak_rss_mb():
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def measure(log_file):
+    """Runs in the child interpreter; prints one JSON line of measurements."""
+    import socket
+    import threading
+    import time
+
+    def no_network(*args, **kwargs):
+        raise RuntimeError("create_app() opened a network connection")
+
+    started = time.perf_counter()
+    from app import create_app
+    imported = time.perf_counter()
+
+    socket.socket.connect = no_network
+    app = create_app({'logging': {'file': log_file, 'console': 'False'}}, start_background=False)
+    created = time.perf_counter()
+    threads = threading.active_count()
+    modules = len(sys.modules)
+
+    response = app.test_client().get('/')
+    answered = time.perf_counter()
+    if response.status_code != 200:
+        raise RuntimeError(f"GET / returned {response.status_code}")
+
+    print(json.dumps({
+        'import_ms': round((imported - started) * 1000, 1),
+        'create_app_ms': round((created - imported) * 1000, 1),
+        'first_request_ms': round((answered - created) * 1000, 1),
+        'rss_mb': _peak_rss_mb(),
+        'threads': threads,
+        'modules': modules,
+    }))
+
+
+def _baseline_rss_mb():
+    output = subprocess.check_output(
+        [sys.executable, '-c', 'from benchmarks.startup_bench import _peak_rss_mb; print(_peak_rss_mb())'],
+        cwd=ROOT, text=True)
+    return float(output)
+
+
+def run(args):
+    runs = []
+    with tempfile.TemporaryDirectory(prefix='wiman-startup-') as scratch:
+        log_file = os.path.join(scratch, 'wiman.log')
+        for index in range(args.runs):
+            output = subprocess.check_output(
+                [sys.executable, '-m', 'benchmarks.startup_bench', 'measure', log_file], cwd=ROOT, text=True)
+            result = json.loads(output.strip().splitlines()[-1])
+            result['baseline_rss_mb'] = _baseline_rss_mb()
+            runs.append(result)
+            print(f"run {index + 1}/{args.runs}: " + ', '.join(f"{field}={result[field]}" for field in FIELDS))
+
+    median = {field: statistics.median(run[field] for run in runs) for field in FIELDS}
+    print("\nmedian: " + ', '.join(f"{field}={median[field]}" for field in FIELDS))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'meta': {'python': platform.python_version(), 'platform': platform.platform(), 'runs': args.runs},
+                'median': median,
+                'runs': runs,
+            }, f, indent=2)
+        print(f"Wrote {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup time and memory benchmark for the WiMaN API")
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--output')
+    commands = parser.add_subparsers(dest='command')
+    measure_parser = commands.add_parser('measure', help=argparse.SUPPRESS)
+    measure_parser.add_argument('log_file')
+    args = parser.parse_args()
+
+    if args.command == 'measure':
+        measure(args.log_file)
+    else:
+        run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+import hmac
+import logging
+import os
+from functools import wraps
+from flask import Blueprint, request, jsonify
+from utils.accounting import get_usage_aggregator, parse_update, AccountingOverloaded, STOP
+from utils.config import get_section
+from utils.sessions import get_session_registry, GATEWAY
+
+accounting_bp = Blueprint('accounting', __name__)
+logger = logging.getLogger(__name__)
+
+# Most updates one request may carry
+MAX_BATCH = get_section('accounting').getint('max_batch', 5000)
+
+# Access points authenticate with the shared secret in ACCOUNTING_SECRET
+def accounting_secret_required(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        secret = os.getenv("ACCOUNTING_SECRET")
+        if not secret:
+            logger.error("Accounting update refused: ACCOUNTING_SECRET is not set")
+            return jsonify({"error": "Accounting is not configured"}), 503
+        if not hmac.compare_digest(request.headers.get('X-Accounting-Secret', ''), secret):
+            return jsonify({"error": "Invalid accounting secret"}), 401
+        return f(*args, **kwargs)
+    return decorated
+
+# Batched RADIUS-style accounting (Start, Interim-Update, Stop) from access points:
+# {"updates": [{"Acct-Status-Type": ..., "Acct-Session-Id": ..., "User-Name": ..., ...}, ...]}
+# Invalid updates are reported by position; "disconnect" lists sessions whose plan limit is exceeded.
+@accounting_bp.route("/updates", methods=["POST"])
+@accounting_secret_required
+def ingest_updates():
+    data = request.get_json(silent=True)
+    raw_updates = data.get("updates") if isinstance(data, dict) else data
+    if not isinstance(raw_updates, list):
+        return jsonify({"error": "Expected a JSON body with an 'updates' list"}), 400
+    if len(raw_updates) > MAX_BATCH:
+        return jsonify({"error": f"At most {MAX_BATCH} updates can be sent per request"}), 413
+
+    updates, rejected = [], []
+    for index, raw in enumerate(raw_updates):
+        try:
+            update = parse_update(raw)
+        except ValueError as e:
+            rejected.append({"index": index, "error": str(e)})
+            continue
+        if update is not None:
+            updates.append(update)
+
+    try:
+        disconnect = get_usage_aggregator().ingest(updates)
+    except AccountingOverloaded as e:
+        logger.warning("Accounting updates refused: %s", e)
+        response = jsonify({"error": "Accounting is busy, resend these updates shortly"})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    # Accounting doubles as the gateways' heartbeat for the admin session view
+    get_session_registry().heartbeats([(f"{GATEWAY}:{update['session_key']}", update['username'], GATEWAY,
+                                        update['status'] == STOP) for update in updates])
+    return jsonify({"accepted": len(updates), "rejected": rejected, "disconnect": disconnect}), 200
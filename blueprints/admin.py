@@ -1,43 +1,81 @@
-from flask import Blueprint, request, jsonify, current_app
+import logging
+import queue
+from flask import Blueprint, request, jsonify, Response
+from utils.config import get_section
 from utils.db import get_db_connection
-from blueprints.users import token_required  # Reuse token_required decorator
+from utils.auth import token_required, token_cache_stats
+from utils.bulk_users import read_rows, set_status, update_users, import_users
 from functools import wraps
-from flask_bcrypt import Bcrypt
-from utils.subscription_manager import expired_subscriptions
+from utils.accounting import get_usage_aggregator
+from utils.entitlements import get_entitlement_index
+from utils.passwords import hash_password, PasswordPoolBusy, UPDATE_PASSWORD_HASH
+from utils.scheduler import get_scheduler
+from utils.sessions import get_session_registry, format_event
+from utils.revocation import get_revocation_store
+from utils.pagination import page_args, page_response, stream_rows, wants_stream
+from utils.subscription_manager import expired_subscriptions, get_expiry_engine
+from utils.user_cache import get_user_record, invalidate_user, user_cache_stats
 
 admin_bp = Blueprint('admin', __name__)
-bcrypt = Bcrypt()
+logger = logging.getLogger(__name__)
+
+_session_settings = get_section('sessions')
+# Seconds between keep-alive comments on an idle stream
+STREAM_KEEPALIVE = _session_settings.getfloat('stream_keepalive', 15)
+
+UPDATE_EMAIL = "UPDATE users SET email = %s WHERE username = %s"
+BLOCK_USER = "UPDATE users SET status = 'blocked' WHERE username = %s"
 
 # Admin authentication decorator
 def admin_required(f):
     @wraps(f)
     def decorated(current_user, *args, **kwargs):
         try:
-            with get_db_connection() as db, db.cursor() as cursor:
-                cursor.execute("SELECT role FROM users WHERE username = %s", (current_user,))
-                user_role = cursor.fetchone()
-                
-                if not user_role or user_role[0] != 'admin':  
-                    return jsonify({"error": "Unauthorized access"}), 403
+            user = get_user_record(current_user)
+            if not user or user.role != 'admin' or user.status == 'blocked':
+                return jsonify({"error": "Unauthorized access"}), 403
         except Exception as e:
-            current_app.logger.error(f"Error checking admin role: {e}")
+            logger.error("Error checking admin role: %s", e)
             return jsonify({"error": "An internal error occurred"}), 500
         
         return f(current_user, *args, **kwargs)
     return decorated
 
-# Fetch all users
+# The /admin/users query after ``after_id`` with the given filters, and its parameters (no LIMIT)
+def users_page_query(after_id, status=None, role=None, q=None):
+    conditions, params = ["id > %s"], [after_id]
+    for column, value in (('status', status), ('role', role)):
+        if value:
+            conditions.append(f"{column} = %s")
+            params.append(value)
+    if q:
+        conditions.append("username LIKE %s")
+        params.append(q.replace('%', r'\%').replace('_', r'\_') + '%')
+    return f"SELECT id, username, email FROM users WHERE {' AND '.join(conditions)} ORDER BY id", params
+
+# Fetch users, one keyset page at a time (?limit=&after_id=&status=&role=&q=), or all of them with ?stream=1
 @admin_bp.route('/admin/users', methods=['GET'])
 @token_required
 @admin_required
 def get_users(current_user):
     try:
+        limit, after_id = page_args()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    query, params = users_page_query(after_id, request.args.get('status'), request.args.get('role'),
+                                     request.args.get('q'))
+
+    try:
+        if wants_stream():
+            return stream_rows(query, params, lambda user: {"username": user[1], "email": user[2]})
         with get_db_connection() as db, db.cursor() as cursor:
-            cursor.execute("SELECT username, email FROM users")
+            cursor.execute(query + " LIMIT %s", params + [limit])
             users = cursor.fetchall()
-        return jsonify([{"username": user[0], "email": user[1]} for user in users]), 200
+        return page_response([{"username": user[1], "email": user[2]} for user in users],
+                             users[-1][0] if users else after_id, limit)
     except Exception as e:
-        current_app.logger.error(f"Error fetching users: {e}")
+        logger.error("Error fetching users: %s", e)
         return jsonify({"error": "An internal error occurred"}), 500
 
 # Update user details
@@ -52,14 +90,17 @@ def update_user(current_user, username):
     try:
         with get_db_connection() as db, db.cursor() as cursor:
             if new_email:
-                cursor.execute("UPDATE users SET email = %s WHERE username = %s", (new_email, username))
+                cursor.execute(UPDATE_EMAIL, (new_email, username))
             if new_password:
-                hashed_password = bcrypt.generate_password_hash(new_password).decode('utf-8')
-                cursor.execute("UPDATE users SET password_hash = %s WHERE username = %s", (hashed_password, username))
+                hashed_password = hash_password(new_password)
+                cursor.execute(UPDATE_PASSWORD_HASH, (hashed_password, username))
             db.commit()
+        invalidate_user(username)
         return jsonify({'message': 'User details updated successfully'}), 200
+    except PasswordPoolBusy:
+        raise
     except Exception as e:
-        current_app.logger.error(f"Error updating user: {e}")
+        logger.error("Error updating user: %s", e)
         return jsonify({"error": "An internal error occurred"}), 500
 
 # Block a user
@@ -69,46 +110,230 @@ def update_user(current_user, username):
 def block_user(current_user, username):
     try:
         with get_db_connection() as db, db.cursor() as cursor:
-            cursor.execute("UPDATE users SET status = 'blocked' WHERE username = %s", (username,))
+            cursor.execute(BLOCK_USER, (username,))
             db.commit()
+        invalidate_user(username)
+        get_revocation_store().revoke_user(username)
         return jsonify({"message": f"User {username} blocked successfully"}), 200
     except Exception as e:
-        current_app.logger.error(f"Error blocking user: {e}")
+        logger.error("Error blocking user: %s", e)
         return jsonify({"error": "An internal error occurred"}), 500
 
-# Fetch active subscriptions
+# Bulk user operations (Admin only). Each takes a JSON body or a CSV upload
+# (multipart field "file" or a text/csv body) and answers with per-row errors.
+def _bulk(current_user, operation, field, apply):
+    try:
+        rows = read_rows(field)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        result = apply(rows)
+    except Exception as e:
+        logger.error("Error in bulk %s: %s", operation, e)
+        return jsonify({"error": "An internal error occurred"}), 500
+    logger.info("Bulk %s by %s: %d of %d rows succeeded",
+                operation, current_user, result.succeeded, result.total)
+    return jsonify(result.to_dict()), 200
+
+# {"usernames": [...]} or CSV with a username column
+@admin_bp.route('/admin/users/bulk/block', methods=['POST'])
+@token_required
+@admin_required
+def bulk_block(current_user):
+    return _bulk(current_user, 'block', 'usernames', lambda rows: set_status(rows, 'blocked'))
+
+@admin_bp.route('/admin/users/bulk/unblock', methods=['POST'])
+@token_required
+@admin_required
+def bulk_unblock(current_user):
+    return _bulk(current_user, 'unblock', 'usernames', lambda rows: set_status(rows, 'active', from_status='blocked'))
+
+# {"users": [{"username", "email"?, "phone_number"?, "role"?, "status"?, "password"?}, ...]} or CSV
+@admin_bp.route('/admin/users/bulk/update', methods=['POST'])
+@token_required
+@admin_required
+def bulk_update(current_user):
+    return _bulk(current_user, 'update', 'users', update_users)
+
+# {"users": [{"username", "email", "password"?, "phone_number"?, "role"?, "status"?}, ...]} or CSV
+@admin_bp.route('/admin/users/bulk/import', methods=['POST'])
+@token_required
+@admin_required
+def bulk_import(current_user):
+    return _bulk(current_user, 'import', 'users', import_users)
+
+# The /admin/subscriptions query after ``after_id`` with the given filters, and its parameters (no LIMIT)
+def subscriptions_page_query(after_id, plan=None, username=None):
+    conditions, params = ["s.id > %s", "s.expires_at > NOW()"], [after_id]
+    if plan:
+        conditions.append("p.name = %s")
+        params.append(plan)
+    if username:
+        conditions.append("u.username = %s")
+        params.append(username)
+    query = f"""
+        SELECT s.id, u.username, p.name, s.expires_at
+        FROM subscriptions s
+        JOIN users u ON u.id = s.user_id
+        JOIN plans p ON p.id = s.plan_id
+        WHERE {' AND '.join(conditions)}
+        ORDER BY s.id
+    """
+    return query, params
+
+# Fetch active subscriptions, paged like /admin/users (?limit=&after_id=&plan=&username=, ?stream=1)
 @admin_bp.route('/admin/subscriptions', methods=['GET'])
 @token_required
 @admin_required
 def admin_subscriptions(current_user):
     try:
+        limit, after_id = page_args()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    query, params = subscriptions_page_query(after_id, request.args.get('plan'), request.args.get('username'))
+
+    def serialize(sub):
+        return {"username": sub[1], "plan": sub[2], "expires_at": sub[3]}
+
+    try:
+        if wants_stream():
+            return stream_rows(query, params, serialize)
         with get_db_connection() as db, db.cursor() as cursor:
-            query = """
-                SELECT u.username, p.name, s.start_at, s.expires_at 
-                FROM subscriptions s
-                JOIN users u ON u.id = s.user_id
-                JOIN plans p ON p.id = s.plan_id
-                WHERE s.expires_at > NOW()
-            """
-            cursor.execute(query)
+            cursor.execute(query + " LIMIT %s", params + [limit])
             subscriptions = cursor.fetchall()
-        if not subscriptions:
+        if not subscriptions and after_id == 0:
             return jsonify({"message": "No active subscriptions found"}), 404
-        return jsonify([
-            {"username": sub[0], "plan": sub[1], "expires_at": sub[3]} for sub in subscriptions
-        ]), 200
+        return page_response([serialize(sub) for sub in subscriptions],
+                             subscriptions[-1][0] if subscriptions else after_id, limit)
     except Exception as e:
-        current_app.logger.error(f"Error fetching subscriptions: {e}")
+        logger.error("Error fetching subscriptions: %s", e)
         return jsonify({"error": "An internal error occurred"}), 500
 
+# The /admin/usage/flagged query after ``after_id``, and its parameters (no LIMIT)
+def flagged_page_query(after_id, reason=None):
+    conditions, params = ["f.id > %s", "s.status = 'active'", "s.expires_at > NOW()"], [after_id]
+    if reason:
+        conditions.append("f.reason = %s")
+        params.append(reason)
+    query = f"""
+        SELECT f.id, u.username, f.subscription_id, f.reason, f.usage_octets, f.flagged_at
+        FROM quota_flags f
+        JOIN subscriptions s ON s.id = f.subscription_id
+        JOIN users u ON u.id = f.user_id
+        WHERE {' AND '.join(conditions)}
+        ORDER BY f.id
+    """
+    return query, params
+
+# Active subscriptions flagged for exceeding their plan's bandwidth_limit, paged (?limit=&after_id=&reason=)
+@admin_bp.route('/admin/usage/flagged', methods=['GET'])
+@token_required
+@admin_required
+def flagged_usage(current_user):
+    try:
+        limit, after_id = page_args()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    query, params = flagged_page_query(after_id, request.args.get('reason'))
+    try:
+        with get_db_connection() as db, db.cursor() as cursor:
+            cursor.execute(query + " LIMIT %s", params + [limit])
+            flags = cursor.fetchall()
+        return page_response(
+            [{"username": row[1], "subscription_id": row[2], "reason": row[3], "usage_octets": row[4],
+              "flagged_at": row[5]} for row in flags],
+            flags[-1][0] if flags else after_id, limit)
+    except Exception as e:
+        logger.error("Error fetching flagged usage: %s", e)
+        return jsonify({"error": "An internal error occurred"}), 500
+
+# Who is online right now: sessions, users, users per plan and sessions per client, from memory
+@admin_bp.route('/admin/sessions', methods=['GET'])
+@token_required
+@admin_required
+def online_sessions(current_user):
+    return jsonify(get_session_registry().counts()), 200
+
+# The same as a server-sent event stream: a "snapshot" event, then a "change" event
+# (counts plus who joined and left) whenever the counts move
+@admin_bp.route('/admin/sessions/stream', methods=['GET'])
+@token_required
+@admin_required
+def stream_sessions(current_user):
+    registry = get_session_registry()
+    # Counted and registered under the registry's lock, so concurrent requests can't overshoot [sessions] max_streams
+    subscriber = registry.subscribe()
+    if subscriber is None:
+        response = jsonify({"error": "Too many open session streams"})
+        response.headers['Retry-After'] = '30'
+        return response, 503
+
+    def generate():
+        try:
+            yield format_event(registry.counts(), 'snapshot')
+            while True:
+                try:
+                    yield format_event(subscriber.get(timeout=STREAM_KEEPALIVE))
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+        finally:
+            registry.unsubscribe(subscriber)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 # Run subscription expiration process (Admin only)
 @admin_bp.route('/admin/expire_subscriptions', methods=['POST'])
 @token_required
 @admin_required
 def run_expiration(current_user):
     try:
-        expired_subscriptions()  
-        return jsonify({"message": "Expired subscriptions processed successfully"}), 200
+        result = expired_subscriptions()
+        if 'error' in result:
+            return jsonify(result), 500
+        result['engine'] = get_expiry_engine().stats()
+        return jsonify(result), 200
     except Exception as e:
-        current_app.logger.error(f"Error processing expired subscriptions: {e}")
+        logger.error("Error processing expired subscriptions: %s", e)
         return jsonify({"error": str(e)}), 500
+
+# Authentication cache statistics (Admin only)
+@admin_bp.route('/admin/cache_stats', methods=['GET'])
+@token_required
+@admin_required
+def cache_stats(current_user):
+    return jsonify({
+        "tokens": token_cache_stats(),
+        "users": user_cache_stats(),
+        "entitlements": get_entitlement_index().stats(),
+        "revocations": get_revocation_store().stats(),
+        "accounting": get_usage_aggregator().stats(),
+        "sessions": get_session_registry().stats(),
+    }), 200
+
+# Background job status (Admin only): this worker's scheduler plus the latest recorded runs
+@admin_bp.route('/admin/jobs', methods=['GET'])
+@token_required
+@admin_required
+def job_status(current_user):
+    try:
+        with get_db_connection() as db, db.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT job_name, scheduled_for, started_at, duration_ms, outcome, error, host, pid
+                FROM job_runs
+                ORDER BY id DESC
+                LIMIT 50
+                """
+            )
+            runs = [
+                {"job": row[0], "scheduled_for": row[1], "started_at": row[2], "duration_ms": row[3],
+                 "outcome": row[4], "error": row[5], "host": row[6], "pid": row[7]}
+                for row in cursor.fetchall()
+            ]
+        return jsonify({"scheduler": get_scheduler().stats(), "recent_runs": runs}), 200
+    except Exception as e:
+        logger.error("Error fetching job runs: %s", e)
+        return jsonify({"error": "An internal error occurred"}), 500
@@ -1,39 +1,26 @@
-from flask import Blueprint, request, jsonify, current_app
-from flask_bcrypt import Bcrypt
+import logging
+from flask import Blueprint, request, jsonify, current_app, g
 from utils.db import get_db_connection
 from MySQLdb import IntegrityError
-import jwt, datetime, secrets, re
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from functools import wraps
+import jwt, datetime, secrets, re, time, uuid
 from blueprints.admin import admin_required
+from utils.auth import token_required
+from utils.audit import get_audit_writer
+from utils.mailer import send_mail
+from utils.passwords import hash_password, check_password, needs_rehash, PasswordPoolBusy, UPDATE_PASSWORD_HASH
+from utils.ratelimit import rate_limit, client_ip, json_field
+from utils.revocation import get_revocation_store
+from utils.user_cache import get_user_record
+
+SELECT_LOGIN = "SELECT id, email, password_hash, status, role FROM users WHERE username = %s"
+SELECT_USERNAME_BY_EMAIL = "SELECT username FROM users WHERE email = %s"
+ACTIVATE_USER = "UPDATE users SET status = 'active' WHERE username = %s"
 
 auth_bp = Blueprint('auth', __name__)
-bcrypt = Bcrypt()
-
-def init_bcrypt(app):
-    bcrypt.init_app(app)
-
-def token_required(f):
-    @wraps(f)
-    def decorated(*args, **kwargs):
-        token = request.headers.get('x-access-token')
-        if not token:
-            return jsonify({'error': 'Token is missing'}), 401
-        
-        try:
-            data = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=['HS256'])
-            current_user = data['username']
-        except jwt.ExpiredSignatureError:
-            return jsonify({'error': 'Token has expired'}), 401
-        except Exception:
-            return jsonify({'error': 'Token is invalid'}), 401
-        
-        return f(current_user, *args, **kwargs)
-    return decorated
+logger = logging.getLogger(__name__)
 
 @auth_bp.route('/register', methods=['POST'])
+@rate_limit(('register_ip', client_ip))
 def register():
     data = request.get_json()
     
@@ -48,7 +35,7 @@ def register():
         return jsonify({'error': 'Password must be at least 8 characters long'}), 400
     
     username, email, password, phone_no = data['username'], data['email'], data['password'], data['phone_no']
-    password_hash = bcrypt.generate_password_hash(password).decode('utf-8')
+    password_hash = hash_password(password)
         
     try:
         with get_db_connection() as db, db.cursor() as cursor:
@@ -77,6 +64,7 @@ def register():
         return jsonify({'message': 'Database error'}), 500
 
 @auth_bp.route('/login', methods=['POST'])
+@rate_limit(('login_ip', client_ip), ('login_user', json_field('username')))
 def login():
     data = request.get_json()
     if not data.get('username') or not data.get('password'):
@@ -86,17 +74,20 @@ def login():
 
     try:
         with get_db_connection() as db, db.cursor() as cursor:
-            cursor.execute("SELECT id, email, password_hash, status, role FROM users WHERE username = %s", (username,))
+            cursor.execute(SELECT_LOGIN, (username,))
             result = cursor.fetchone()
 
-        if not result or not bcrypt.check_password_hash(result[2], password):
+        if not result or not check_password(result[2], password):
             log_login_attempt(result[0] if result else None, result[1] if result else None, request.remote_addr, "Failed")
             return jsonify({'error': {'code': 'invalid_credentials', 'message': 'Invalid username or password'}}), 401
 
-        user_id, email, _, status, role = result
+        user_id, email, password_hash, status, role = result
         if status != 'active':
             return jsonify({'error': 'Account is not active. Please verify your email.'}), 403
 
+        if needs_rehash(password_hash):
+            rehash_password(username, password)
+
         access_token = generate_access_token(username, role)
         refresh_token = generate_refresh_token(username)
 
@@ -104,11 +95,24 @@ def login():
 
         return jsonify({"access_token": access_token, "refresh_token": refresh_token, "role": role}), 200
 
+    except PasswordPoolBusy:
+        raise
     except Exception as e:
-        current_app.logger.error(f"Error in login: {e}")
+        logger.error("Error in login: %s", e)
         return jsonify({'error': {'code': 'internal_error', 'message': 'An internal error occurred.'}}), 500
 
 
+# Brings a stored hash to the configured bcrypt cost after a successful login
+def rehash_password(username, password):
+    try:
+        new_hash = hash_password(password)
+        with get_db_connection() as db, db.cursor() as cursor:
+            cursor.execute(UPDATE_PASSWORD_HASH, (new_hash, username))
+            db.commit()
+    except Exception as e:
+        logger.warning("Could not rehash password for %s: %s", username, e)
+
+
 @auth_bp.route('/refresh', methods=['POST'])
 def refresh():
     data = request.get_json()
@@ -121,14 +125,18 @@ def refresh():
         # Verify refresh token
         decoded = jwt.decode(refresh_token, current_app.config['SECRET_KEY'], algorithms=['HS256'])
         username = decoded['username']
+        if get_revocation_store().is_revoked(decoded):
+            return jsonify({"error": "Refresh token has been revoked, please log in again"}), 401
         
         # Get user role for new access token
-        with get_db_connection() as db, db.cursor() as cursor:
-            cursor.execute("SELECT role FROM users WHERE username = %s", (username,))
-            role = cursor.fetchone()[0]
+        user = get_user_record(username)
+        if not user:
+            return jsonify({"error": "User not found"}), 401
+        if user.status == 'blocked':
+            return jsonify({"error": "Account is blocked. Contact support for assistance."}), 403
         
         # Generate new access token
-        new_access_token = generate_access_token(username, role)
+        new_access_token = generate_access_token(username, user.role)
         
         return jsonify({"access_token": new_access_token}), 200
         
@@ -138,6 +146,7 @@ def refresh():
         return jsonify({"error": f"Token refresh error: {str(e)}"}), 500
 
 @auth_bp.route('/request_reset', methods=['POST'])
+@rate_limit(('reset_ip', client_ip), ('reset_email', json_field('email')))
 def request_password_reset():
     data = request.get_json()
     email = data.get('email')
@@ -147,7 +156,7 @@ def request_password_reset():
     
     # Find user by email
     with get_db_connection() as db, db.cursor() as cursor:
-        cursor.execute("SELECT username FROM users WHERE email = %s", (email,))
+        cursor.execute(SELECT_USERNAME_BY_EMAIL, (email,))
         result = cursor.fetchone()
     
     if not result:
@@ -177,25 +186,40 @@ def reset_password():
         username = decoded['username']
         
         # Update password
-        hashed_password = bcrypt.generate_password_hash(new_password).decode('utf-8')
+        hashed_password = hash_password(new_password)
         with get_db_connection() as db, db.cursor() as cursor:
-            cursor.execute("UPDATE users SET password_hash = %s WHERE username = %s", 
-                          (hashed_password, username))
+            cursor.execute(UPDATE_PASSWORD_HASH, (hashed_password, username))
             db.commit()
+        # Sessions opened with the old password end here
+        get_revocation_store().revoke_user(username)
         
         return jsonify({"message": "Password reset successfully"}), 200
         
     except jwt.ExpiredSignatureError:
         return jsonify({"error": "Reset token has expired"}), 401
+    except PasswordPoolBusy:
+        raise
     except Exception as e:
         return jsonify({"error": f"Error resetting password: {str(e)}"}), 500
 
 @auth_bp.route('/logout', methods=['POST'])
 @token_required
 def logout(current_user):
-    # You could blacklist the token here if you implement a token blacklist
-    # Or track active sessions in a database
-    
+    store = get_revocation_store()
+    if not store.revoke_token(g.token_claims):
+        # Issued before tokens carried a jti; such a token can only be revoked with the user's others
+        store.revoke_user(current_user)
+
+    # Revoke the refresh token too when the client sends it along
+    refresh_token = (request.get_json(silent=True) or {}).get('refresh_token')
+    if refresh_token:
+        try:
+            claims = jwt.decode(refresh_token, current_app.config['SECRET_KEY'], algorithms=['HS256'])
+            if claims.get('username') == current_user:
+                store.revoke_token(claims)
+        except jwt.InvalidTokenError:
+            pass  # expired or invalid, nothing to revoke
+
     return jsonify({"message": "Logged out successfully"}), 200
 
 @auth_bp.route('/protected', methods=['GET'])
@@ -216,7 +240,7 @@ def verify_account(token):
         username = decoded['username']
         
         with get_db_connection() as db, db.cursor() as cursor:
-            cursor.execute("UPDATE users SET status = 'active' WHERE username = %s", (username,))
+            cursor.execute(ACTIVATE_USER, (username,))
             db.commit()
         
         return jsonify({"message": "Account verified successfully"}), 200
@@ -228,12 +252,16 @@ def generate_access_token(username, role):
         'username': username,
         'role': role,
         'exp': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1),
+        'iat': time.time(),
+        'jti': uuid.uuid4().hex,
     }, current_app.config['SECRET_KEY'], algorithm='HS256')
 
 def generate_refresh_token(username):
     return jwt.encode({
         'username': username,
         'exp': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=7),
+        'iat': time.time(),
+        'jti': uuid.uuid4().hex,
     }, current_app.config['SECRET_KEY'], algorithm='HS256')
 
 def generate_reset_token(username):
@@ -249,67 +277,29 @@ def generate_verification_token(username):
     }, current_app.config['SECRET_KEY'], algorithm='HS256')
 
 def send_verification_email(email, token):
-    sender_email = "wiman@gmail.com"
-    sender_password = "wiman-email-password"
-    smtp_server = "smtp.example.com"
-    smtp_port = 587
-
     subject = "Verify your email address"
     verification_link = f"http://wiman-domain.com/verify?token={token}"
     body = f"Please click the following link to verify your email address: {verification_link}"
 
-    msg = MIMEMultipart()
-    msg['From'] = sender_email
-    msg['To'] = email
-    msg['Subject'] = subject
-
-    msg.attach(MIMEText(body, 'plain'))
-
+    # Delivery happens on the mailer thread; the request only spools the message
     try:
-        server = smtplib.SMTP(smtp_server, smtp_port)
-        server.starttls()
-        server.login(sender_email, sender_password)
-        text = msg.as_string()
-        server.sendmail(sender_email, email, text)
-        server.quit()
-        current_app.logger.info(f"Verification email sent to {email}")
+        send_mail(email, subject, body)
+        logger.info("Verification email queued for %s", email)
     except Exception as e:
-        current_app.logger.error(f"Failed to send verification email: {e}")
+        logger.error("Failed to queue verification email: %s", e)
 
 def send_password_reset_email(email, token):
-    sender_email = "wiman@gmail.com"
-    sender_password = "wiman-email-password"
-    smtp_server = "smtp.example.com"
-    smtp_port = 587
-
     subject = "Password Reset Request"
     reset_link = f"http://wiman-domain.com/reset_password?token={token}"
     body = f"Please click the following link to reset your password: {reset_link}"
 
-    msg = MIMEMultipart()
-    msg['From'] = sender_email
-    msg['To'] = email
-    msg['Subject'] = subject
-
-    msg.attach(MIMEText(body, 'plain'))
-
     try:
-        server = smtplib.SMTP(smtp_server, smtp_port)
-        server.starttls()
-        server.login(sender_email, sender_password)
-        text = msg.as_string()
-        server.sendmail(sender_email, email, text)
-        server.quit()
-        current_app.logger.info(f"Password reset email sent to {email}")
+        send_mail(email, subject, body)
+        logger.info("Password reset email queued for %s", email)
     except Exception as e:
-        current_app.logger.error(f"Failed to send password reset email: {e}")
+        logger.error("Failed to queue password reset email: %s", e)
 
-# Logs a login attemp in the database
+# Logs a login attempt; rows are buffered and written in batches off the request path
 def log_login_attempt(user_id, email, ip_address, status):
-    try:
-        with get_db_connection() as db, db.cursor() as cursor:
-            cursor.execute("INSERT INTO login_attempts (user_id, email, ip_address, status) VALUES (%s, %s, %s, %s)", 
-                           (user_id, email, ip_address, status))
-            db.commit()
-    except Exception as e:
-        current_app.logger.error(f"Failed to log login attempt: {e}")
+    if not get_audit_writer().record(user_id, email, ip_address, status):
+        logger.warning("Login attempt from %s dropped: audit buffer full", ip_address)
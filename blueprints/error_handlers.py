@@ -1,11 +1,13 @@
-from flask import jsonify
+from flask import jsonify, request
 from werkzeug.exceptions import HTTPException
 import logging
+from utils.passwords import PasswordPoolBusy
+from utils.ratelimit import RateLimited
 
 logger = logging.getLogger(__name__)
 def handle_generic_error(error):
     """Handles all unexpected errors and logs them"""
-    logging.error(f"Unhandled Error: {error}")  # Save error to wiman.log
+    logging.error("Unhandled Error: %s", error)  # Save error to wiman.log
 
     response = {
         "error": "Internal Server Error",
@@ -17,11 +19,11 @@ def handle_generic_error(error):
 def handle_http_error(error):
     """Handles known HTTP errors"""
     if error.code == 404:
-        logging.info(f"404 Not Found: {error.description}")  # Keep as INFO
+        logging.info("404 Not Found: %s", error.description)  # Keep as INFO
     elif error.code == 500:
-        logging.error(f"500 Internal Server Error: {error.description}")  # Log as ERROR
+        logging.error("500 Internal Server Error: %s", error.description)  # Log as ERROR
     else:
-        logging.warning(f"HTTP Error {error.code}: {error.description}")  # Log others as WARNING
+        logging.warning("HTTP Error %s: %s", error.code, error.description)  # Log others as WARNING
 
     response = {
         "error": error.name,
@@ -33,10 +35,24 @@ def handle_http_error(error):
 def register_error_handlers(app):
     @app.errorhandler(404)
     def not_found(error):
-        logger.error(f"404 Error: {error}")  # Log the error
+        logger.error("404 Error: %s", error)  # Log the error
         return jsonify({"error": "Not Found", "message": "The requested URL was not found on the server."}), 404
 
     @app.errorhandler(500)
     def internal_error(error):
-        logger.error(f"500 Error: {error}", exc_info=True)  # Log full traceback
-        return jsonify({"error": "Internal Server Error", "message": "An unexpected error occurred."}), 500
\ No newline at end of file
+        logger.error("500 Error: %s", error, exc_info=True)  # Log full traceback
+        return jsonify({"error": "Internal Server Error", "message": "An unexpected error occurred."}), 500
+
+    @app.errorhandler(PasswordPoolBusy)
+    def password_pool_busy(error):
+        logger.warning("Rejected request, password hashing pool is full: %s", error)
+        response = jsonify({"error": "Service Unavailable", "message": "Too many requests, please try again shortly."})
+        response.headers['Retry-After'] = '1'
+        return response, 503
+
+    @app.errorhandler(RateLimited)
+    def rate_limited(error):
+        logger.info("Rejected request to %s: %s", request.path, error)
+        response = jsonify({"error": "Too Many Requests", "message": "Too many attempts, please try again later."})
+        response.headers['Retry-After'] = str(error.retry_after)
+        return response, 429
@@ -1,97 +1,106 @@
-import sys
-import os
-sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-import datetime
-import requests
-import json
-import base64
-from flask import Blueprint, request, jsonify, current_app
-from utils.db import get_db_connection
-from blueprints.users import token_required  # if /pay is protected
+import logging
+import re
+from flask import Blueprint, request, jsonify, url_for
+from utils.auth import token_required
+from utils.config import get_section
+from utils.db import close_db
+from utils.payments import get_payment_processor, parse_stk_callback, QueueFullError
+from utils.ratelimit import rate_limit, json_field, token_user
+from utils.stk import get_stk_orchestrator, public_state
+from utils.user_cache import get_user_record
 
 mpesa_bp = Blueprint('mpesa', __name__)
+logger = logging.getLogger(__name__)
 
-# Fetch MPESA details from environment variables or a config file as needed
-MPESA_CONSUMER_KEY = os.getenv("MPESA_CONSUMER_KEY")
-MPESA_CONSUMER_SECRET = os.getenv("MPESA_CONSUMER_SECRET")
-MPESA_PASSKEY = os.getenv("MPESA_PASSKEY")
-MPESA_SHORTCODE = os.getenv("MPESA_SHORTCODE")
-MPESA_CALLBACK_URL = os.getenv("MPESA_CALLBACK_URL")
+# Longest a status request may wait for a change, in seconds
+MAX_STATUS_WAIT = get_section('stk').getfloat('max_wait', 25)
 
-def get_mpesa_token():
-    url = "https://sandbox.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials"
-    response = requests.get(url, auth=(MPESA_CONSUMER_KEY, MPESA_CONSUMER_SECRET))
-    if response.status_code == 200:
-        return response.json().get("access_token")
-    else:
-        current_app.logger.error("Failed to get MPESA access token")
-        return None
-
-def initiate_stk_push(phone_number, amount):
-    access_token = get_mpesa_token()
-    if not access_token:
-        return {"error": "Failed to get access token"}
-    timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-    password = base64.b64encode(f"{MPESA_SHORTCODE}{MPESA_PASSKEY}{timestamp}".encode()).decode()
-    url = "https://sandbox.safaricom.co.ke/mpesa/stkpush/v1/processrequest"
-    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
-    payload = {
-        "BusinessShortCode": MPESA_SHORTCODE,
-        "Password": password,
-        "Timestamp": timestamp,
-        "TransactionType": "CustomerPayBillOnline",
-        "Amount": amount,
-        "PartyA": phone_number,
-        "PartyB": MPESA_SHORTCODE,
-        "PhoneNumber": phone_number,
-        "CallBackURL": MPESA_CALLBACK_URL,
-        "AccountReference": "WIMAN",
-        "TransactionDesc": "Wi-Fi Subscription Payment"
-    }
-    response = requests.post(url, json=payload, headers=headers)
-    return response.json()
-
-# Initiate Payment endpoint (protected)
+# Initiate Payment endpoint (protected): queues the STK push and answers 202 with a handle to poll
 @mpesa_bp.route("/pay", methods=["POST"])
 @token_required
+@rate_limit(('pay_user', token_user), ('pay_phone', json_field('phone_number')))
 def pay(current_user):
-    data = request.get_json()
-    phone_number = data.get("phone_number")
+    data = request.get_json(silent=True) or {}
+    phone_number = str(data.get("phone_number") or '').strip()
     amount = data.get("amount")
     if not phone_number or not amount:
         return jsonify({"error": "Phone number and amount are required"}), 400
-    response = initiate_stk_push(phone_number, amount)
-    return jsonify(response)
+    if not re.fullmatch(r"\d{9,15}", phone_number):
+        return jsonify({"error": "Phone number must be digits only, e.g. 2547XXXXXXXX"}), 400
+    try:
+        amount = int(amount)
+        if amount < 1:
+            raise ValueError
+    except (TypeError, ValueError):
+        return jsonify({"error": "Amount must be a positive whole number"}), 400
+
+    user = get_user_record(current_user)
+    if not user:
+        return jsonify({"error": "User not found"}), 404
+    try:
+        state = get_stk_orchestrator().submit(user.user_id, phone_number, amount)
+    except QueueFullError:
+        response = jsonify({"error": "Too many payments in progress, please try again shortly."})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+
+    response = jsonify(dict(public_state(state), status_url=url_for('mpesa.pay_status', handle=state['handle'])))
+    response.headers['Location'] = url_for('mpesa.pay_status', handle=state['handle'])
+    return response, 202
+
+# Checkout status (protected). ?wait=N long-polls up to N seconds for the status to move on
+# from ?status= (the one the client already has); without wait it answers straight away.
+@mpesa_bp.route("/pay/<handle>", methods=["GET"])
+@token_required
+def pay_status(current_user, handle):
+    try:
+        wait = min(max(float(request.args.get('wait', 0)), 0), MAX_STATUS_WAIT)
+    except ValueError:
+        return jsonify({"error": "wait must be a number of seconds"}), 400
+
+    user = get_user_record(current_user)
+    orchestrator = get_stk_orchestrator()
+    state = orchestrator.get(handle)
+    if state is None or not user or state['user_id'] != user.user_id:
+        return jsonify({"error": "Payment not found"}), 404
+    if wait:
+        # Hand back the connection the auth checks may have taken; the wait reads the pool per poll
+        close_db()
+        try:
+            state = orchestrator.wait(handle, request.args.get('status', state['status']), wait)
+        except QueueFullError:
+            response = jsonify({"error": "Too many status requests waiting, please poll again shortly."})
+            response.headers['Retry-After'] = '2'
+            return response, 503
+    return jsonify(public_state(state)), 200
 
 # MPESA Callback (public endpoint)
 @mpesa_bp.route("/mpesa/callback", methods=["POST"])
 def mpesa_callback():
-    data = request.get_json()
-    current_app.logger.info(f"MPESA CALLBACK RESPONSE: {json.dumps(data, indent=2)}")
-    if data.get("Body", {}).get("stkCallback", {}).get("ResultCode") == 0:
-        transaction_details = data["Body"]["stkCallback"]["CallbackMetadata"]["Item"]
-        
-        phone_number = next(item["Value"] for item in transaction_details if item["Name"] == "PhoneNumber")
-        amount = next(item["Value"] for item in transaction_details if item["Name"] == "Amount")
-        transaction_id = next(item ["value"] for item in transaction_details if item["Name"] == "MpesaReceiptNumber")
-        
-        # Retrieve uder_id and subscription_id from the database
-        with get_db_connection() as db, db.cursor() as cursor:
-            cursor.execute("SELECT user_id, subscription_id FROM users WHERE phone_number = %s", (phone_number))
-            result = cursor.fetchone()
-            if result:
-                user_id, subscription_id = result
-            else:
-                return jsonify({"error": "User not found"}), 404
-        
-        with get_db_connection() as db, db.cursor() as cursor:
-            cursor.execute("INSERT INTO payments (user_id, subscription_id, phone_number, amount, transaction_id, status) VALUES (%s, %s, %s, %s, %s, %s)", 
-                           (user_id, subscription_id, phone_number, amount, transaction_id, "Completed"))
-            db.commit()
-        return jsonify({"message": "Payment successful"}), 200
-    return jsonify({"error": "Payment failed"}), 400
-{
-    "python.analysis.extraPaths": [
-        "./venv/Lib/site-packages"
-    ]
-}
\ No newline at end of file
+    data = request.get_json(silent=True)
+    # The full payload is only rendered when DEBUG is enabled for this module
+    logger.debug("MPESA CALLBACK RESPONSE: %s", data)
+    callback = parse_stk_callback(data)
+    if callback is None:
+        return jsonify({"ResultCode": 1, "ResultDesc": "Invalid callback payload"}), 400
+    logger.info("MPESA callback %s: result %s", callback["checkout_request_id"], callback["result_code"])
+    try:
+        get_stk_orchestrator().on_callback(callback)
+    except Exception as e:
+        # The payment below is still recorded; reconciliation settles the checkout row
+        logger.error("Could not update checkout %s: %s", callback["checkout_request_id"], e)
+
+    if callback["result_code"] == 0:
+        if not callback["receipt_number"] or not callback["phone_number"]:
+            logger.error("Successful callback %s is missing metadata", callback['checkout_request_id'])
+            return jsonify({"ResultCode": 1, "ResultDesc": "Missing callback metadata"}), 400
+        try:
+            # Recorded by the payment workers; we acknowledge straight away
+            get_payment_processor().submit(callback)
+        except QueueFullError:
+            # Not acknowledged, so Safaricom retries once we have caught up
+            return jsonify({"ResultCode": 1, "ResultDesc": "Busy, retry later"}), 503
+    else:
+        logger.info("Payment %s failed: %s", callback['checkout_request_id'], callback['result_desc'])
+
+    return jsonify({"ResultCode": 0, "ResultDesc": "Accepted"}), 200
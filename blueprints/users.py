@@ -1,27 +1,27 @@
-from flask import Blueprint, request, jsonify, current_app
-import jwt, datetime
-from functools import wraps
+import logging
+from flask import Blueprint, request, jsonify, current_app, g
+import time
+from blueprints.auth import generate_access_token
 from utils.db import get_db_connection
-from flask_bcrypt import Bcrypt
+from utils.auth import token_required
+from utils.config import get_section
+from utils.entitlements import get_entitlement_index
+from utils.passwords import hash_password, check_password, PasswordPoolBusy, UPDATE_PASSWORD_HASH
+from utils.plans import get_plan_catalog
+from utils.sessions import get_session_registry, PORTAL
+from utils.subscription_manager import get_expiry_engine
+from utils.user_cache import get_user_record
 
 users_bp = Blueprint('users', __name__)
-bcrypt = Bcrypt()
-
-# Utility: JWT token required decorator
-def token_required(f):
-    @wraps(f)
-    def decorated(*args, **kwargs):
-        token = request.headers.get('x-access-token')
-        if not token:
-            return jsonify({'error': 'Token is missing'}), 401
-        try:
-            data = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=['HS256'])
-            current_user = data['username']
-        except Exception as e:
-            current_app.logger.error(f"Token error: {e}")
-            return jsonify({'error': 'Token is invalid'}), 401
-        return f(current_user, *args, **kwargs)
-    return decorated
+logger = logging.getLogger(__name__)
+
+# How long browsers and proxies may reuse the plan list before revalidating
+PLANS_MAX_AGE = get_section('plans').getint('max_age', 60)
+
+SELECT_LOGIN = "SELECT password_hash, status, role FROM users WHERE username = %s"
+SELECT_PROFILE = "SELECT username, email, phone_number, status FROM users WHERE username = %s"
+SELECT_PASSWORD_HASH = "SELECT password_hash FROM users WHERE username = %s"
+SELECT_USER_ID = "SELECT id FROM users WHERE username = %s"
 
 @users_bp.route('/test_db', methods=['GET'])
 def test_db():
@@ -31,7 +31,7 @@ def test_db():
             database_name = cursor.fetchone()
         return jsonify({"database": database_name[0] if database_name else "No database selected"}), 200
     except Exception as e:
-        current_app.logger.error(f"Database connection error: {e}")
+        logger.error("Database connection error: %s", e)
         return jsonify({"error": str(e)}), 500
 
 # User Registration
@@ -41,7 +41,7 @@ def register():
     username, email, password, phone_number = data.get('username'), data.get('email'), data.get('password'), data.get('phone_number')
     if not username or not email or not password or not phone_number:
         return jsonify({'error': 'Missing required fields'}), 400
-    hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
+    hashed_password = hash_password(password)
     try:
         with get_db_connection() as db, db.cursor() as cursor:
             cursor.execute("INSERT INTO users (username, email, password_hash, phone_number, status) VALUES (%s, %s, %s, %s, 'active')",
@@ -58,10 +58,10 @@ def login():
     username, password = data.get('username'), data.get('password')
     try:
         with get_db_connection() as db, db.cursor() as cursor:
-            cursor.execute("SELECT password_hash, status FROM users WHERE username = %s", (username,))
+            cursor.execute(SELECT_LOGIN, (username,))
             user = cursor.fetchone()
             
-            if not user or not bcrypt.check_password_hash(user[0], password):
+            if not user or not check_password(user[0], password):
                 return jsonify({'error': 'Invalid credentials'}), 401
             
             if user[1] != 'active':
@@ -69,8 +69,11 @@ def login():
             elif user[1] == 'blocked':
                 return jsonify({'error': 'Account is blocked. Contact support for assistance.'}), 403
             
-            token = jwt.encode({'username': username, 'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=24)}, current_app.config['SECRET_KEY'], algorithm='HS256')
+            # Same short-lived token as /auth/login, with the jti and iat logout revokes by
+            token = generate_access_token(username, user[2])
         return jsonify({'token': token}), 200
+    except PasswordPoolBusy:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -79,22 +82,34 @@ def login():
 @token_required
 def protected(current_user):
     try:
-        with get_db_connection() as db, db.cursor() as cursor:
-            cursor.execute("SELECT expires_at, status FROM subscriptions WHERE user_id = (SELECT id FROM users WHERE username = %s)", (current_user,))
-            result = cursor.fetchone()
-        if not result or result[1] != 'active' or result[0] < datetime.datetime.utcnow():
+        user = get_user_record(current_user)
+        if not user or user.status == 'blocked':
+            return jsonify({'error': 'Subscription inactive or expired'}), 403
+        if not get_entitlement_index().is_entitled(user.user_id):
             return jsonify({'error': 'Subscription inactive or expired'}), 403
         return jsonify({'message': f'Hello {current_user}, you have access to protected data!'}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Portal heartbeat: keeps this login online in the admin session view. Send it at least every
+# "timeout" seconds; {"ended": true} takes it offline (logout, tab closed). A "session_id" in
+# the body tells several tabs or devices apart and defaults to the token's id.
+@users_bp.route('/heartbeat', methods=['POST'])
+@token_required
+def heartbeat(current_user):
+    data = request.get_json(silent=True) or {}
+    session_id = str(data.get('session_id') or g.token_claims.get('jti') or 'default')[:64]
+    registry = get_session_registry()
+    registry.heartbeat(f"{PORTAL}:{current_user}:{session_id}", current_user, PORTAL, ended=bool(data.get('ended')))
+    return jsonify({'message': 'ok', 'timeout': registry.timeout}), 200
+
 # Get User Profile
 @users_bp.route('/profile', methods=['GET'])
 @token_required
 def get_profile(current_user):
     try:
         with get_db_connection() as db, db.cursor() as cursor:
-            cursor.execute("SELECT username, email, phone_number, status FROM users WHERE username = %s", (current_user,))
+            cursor.execute(SELECT_PROFILE, (current_user,))
             user = cursor.fetchone()
         return jsonify({'username': user[0], 'email': user[1], 'phone_number': user[2], 'status': user[3]}), 200 if user else jsonify({'error': 'User not found'}), 404
     except Exception as e:
@@ -108,50 +123,29 @@ def change_password(current_user):
     old_password, new_password = data.get('old_password'), data.get('new_password')
     try:
         with get_db_connection() as db, db.cursor() as cursor:
-            cursor.execute("SELECT password_hash FROM users WHERE username = %s", (current_user,))
+            cursor.execute(SELECT_PASSWORD_HASH, (current_user,))
             user = cursor.fetchone()
-            if not user or not bcrypt.check_password_hash(user[0], old_password):
+            if not user or not check_password(user[0], old_password):
                 return jsonify({'error': 'Incorrect current password'}), 400
-            hashed_password = bcrypt.generate_password_hash(new_password).decode('utf-8')
-            cursor.execute("UPDATE users SET password_hash = %s WHERE username = %s", (hashed_password, current_user))
+            hashed_password = hash_password(new_password)
+            cursor.execute(UPDATE_PASSWORD_HASH, (hashed_password, current_user))
             db.commit()
         return jsonify({'message': 'Password changed successfully'}), 200
+    except PasswordPoolBusy:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-# Subscription Plans
+# Subscription Plans (served from the plan catalog; supports If-None-Match)
 @users_bp.route('/subscriptions', methods=['GET'])
 def get_subscriptions():
     try:
-        with get_db_connection() as db, db.cursor() as cursor:
-            cursor.execute("SELECT name, duration_days, price, bandwidth_limit FROM subscription_plans")
-            plans = cursor.fetchall()
-
-        # Structure plans into categories
-        structured_plans = {"BASIC": [], "PREMIUM": [], "ENTERPRISE": []}
-
-        # Define durations mapping
-        duration_mapping = {
-            1: "1 hour",
-            3: "3 hours",
-            12: "12 hours (6PM - 6AM)",
-            7: "1 week",
-            14: "2 weeks",
-            30: "1 month"
-        }
-
-        # Process each plan
-        for name, duration_days, price, bandwidth_limit in plans:
-            plan_category = name.upper()  # Ensure uppercase for consistency
-
-            structured_plans[plan_category].append({
-                "duration": duration_mapping.get(duration_days, f"{duration_days} days"),
-                "price": price,
-                "bandwidth": bandwidth_limit,
-                "devices": 1 if plan_category == "BASIC" else (1 if price ==150 else (2 if price in [300,600] else 4))
-            })
-
-        return jsonify({"plans": structured_plans}), 200
+        catalog = get_plan_catalog().snapshot()
+        response = current_app.response_class(catalog.body, mimetype='application/json')
+        response.set_etag(catalog.etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = PLANS_MAX_AGE
+        return response.make_conditional(request)
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -168,19 +162,18 @@ def subscribe(current_user):
         return jsonify({'error': 'Plan ID is required'}), 400
 
     try:
-        with get_db_connection() as db, db.cursor() as cursor:
-            # Fetch the plan name and duration from the plans table
-            cursor.execute("SELECT name, duration FROM plans WHERE id = %s", (plan_id,))
-            plan = cursor.fetchone()
+        # Fetch the plan name and duration from the plan catalog
+        plan = get_plan_catalog().plan(plan_id)
 
-            if not plan:
-                return jsonify({'error': 'Invalid plan ID'}), 400
+        if not plan:
+            return jsonify({'error': 'Invalid plan ID'}), 400
 
-            name = plan[0]
-            duration_days = plan[1]
-            
+        name = plan.name
+        duration_days = plan.duration
+
+        with get_db_connection() as db, db.cursor() as cursor:
             # Fetch the user_id using the current_user (username)
-            cursor.execute("SELECT id FROM users WHERE username = %s", (current_user,))
+            cursor.execute(SELECT_USER_ID, (current_user,))
             user = cursor.fetchone()
 
             if not user:
@@ -196,9 +189,13 @@ def subscribe(current_user):
                 """,
                 (user_id, plan_id, duration_days)
             )
+            subscription_id = cursor.lastrowid
             db.commit()
 
-        return jsonify({'message': f"{current_user['username']} Subscription to {name} successful"}), 201
+        expires_at = time.time() + duration_days * 86400
+        get_expiry_engine().schedule(subscription_id, user_id, expires_at)
+        get_entitlement_index().record_subscription(user_id, expires_at)
+        return jsonify({'message': f"{current_user} Subscription to {name} successful"}), 201
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -0,0 +1,50 @@
+"""Gunicorn settings for WiMaN: gunicorn -c gunicorn.conf.py wsgi:app
+
+Every setting can be overridden from the environment (WIMAN_BIND,
+WIMAN_WORKERS, ...) without editing this file.
+"""
+import multiprocessing
+import os
+
+bind = os.getenv('WIMAN_BIND', '0.0.0.0:5000')
+
+# gthread: each worker process serves requests from a thread pool. The app
+# is thread-safe (pooled DB connections, locked caches) and most request
+# time is spent waiting on MySQL, bcrypt or Daraja, so a few processes with
+# several threads each use less memory than one process per request slot.
+# gevent also works, but mysqlclient and bcrypt are C extensions that block
+# the event loop, so it only pays off once those are moved off the hub.
+worker_class = os.getenv('WIMAN_WORKER_CLASS', 'gthread')
+workers = int(os.getenv('WIMAN_WORKERS', min(multiprocessing.cpu_count() * 2 + 1, 8)))
+# Payment status long-polls and admin session streams hold a thread each
+# while open; by default each may take a quarter of these ([stk]
+# max_waiters, [sessions] max_streams), read from the same variable
+threads = int(os.getenv('WIMAN_THREADS', 8))
+worker_connections = int(os.getenv('WIMAN_WORKER_CONNECTIONS', 1000))  # gevent only
+
+# Import the app once in the master so workers share its code pages
+# copy-on-write and start in milliseconds. create_app opens no database or
+# HTTP connections, and the one thread it starts (the log writer) is
+# restarted in each worker by utils.logging_config; see wsgi.py. Workers
+# log to stdout rather than rotating the master's log file each on their
+# own, so run gunicorn under something that collects stdout.
+preload_app = True
+
+timeout = int(os.getenv('WIMAN_TIMEOUT', 30))
+graceful_timeout = int(os.getenv('WIMAN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.getenv('WIMAN_KEEPALIVE', 5))
+
+# Recycle workers now and then to cap slow memory growth; the jitter keeps
+# them from all restarting at once
+max_requests = int(os.getenv('WIMAN_MAX_REQUESTS', 10000))
+max_requests_jitter = int(os.getenv('WIMAN_MAX_REQUESTS_JITTER', 1000))
+
+accesslog = os.getenv('WIMAN_ACCESS_LOG')  # off unless set; /metrics has per-endpoint latency
+errorlog = '-'
+
+
+def post_worker_init(worker):
+    """Starts the scheduler in each worker; only the lock holder runs jobs."""
+    from app import start_background_jobs
+
+    start_background_jobs()
@@ -0,0 +1,68 @@
+-- Tables the API reads and writes, as they existed before migrations were tracked.
+-- IF NOT EXISTS lets this run against a database that was set up by hand.
+
+CREATE TABLE IF NOT EXISTS users (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    username VARCHAR(64) NOT NULL,
+    email VARCHAR(255),
+    password_hash VARCHAR(255) NOT NULL,
+    phone_number VARCHAR(20),
+    phone_no VARCHAR(20),
+    status VARCHAR(20) DEFAULT 'inactive',
+    role VARCHAR(20) DEFAULT 'user',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS plans (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    name VARCHAR(64) NOT NULL,
+    duration INT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS subscription_plans (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    name VARCHAR(64) NOT NULL,
+    duration_days INT NOT NULL,
+    price INT NOT NULL,
+    bandwidth_limit VARCHAR(32)
+);
+
+CREATE TABLE IF NOT EXISTS subscriptions (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    user_id INT NOT NULL,
+    plan_id INT,
+    start_date DATETIME DEFAULT CURRENT_TIMESTAMP,
+    end_date DATETIME,
+    expires_at DATETIME,
+    status VARCHAR(20)
+);
+
+CREATE TABLE IF NOT EXISTS users_subscriptions (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    user_id INT NOT NULL,
+    plan_id INT,
+    duration_days INT NOT NULL DEFAULT 1,
+    start_at DATETIME,
+    expires_at DATETIME,
+    status VARCHAR(20)
+);
+
+CREATE TABLE IF NOT EXISTS payments (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    user_id INT,
+    subscription_id INT,
+    phone_number VARCHAR(20),
+    amount DECIMAL(10, 2),
+    transaction_id VARCHAR(64) NOT NULL,
+    status VARCHAR(20),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS login_attempts (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    user_id INT,
+    email VARCHAR(255),
+    ip_address VARCHAR(45),
+    status VARCHAR(20),
+    attempted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,24 @@
+-- Indexes for the lookups every request or job makes.
+
+-- token_required / admin_required / login / profile: WHERE username = %s
+CREATE UNIQUE INDEX uq_users_username ON users (username);
+
+-- request_reset: WHERE email = %s
+CREATE INDEX idx_users_email ON users (email);
+
+-- M-Pesa callback: users matched by the paying phone number
+CREATE INDEX idx_users_phone_number ON users (phone_number);
+
+-- Entitlement lookups (latest subscription of a user) and the payment join on user_id
+CREATE INDEX idx_subscriptions_user_expires ON subscriptions (user_id, expires_at);
+
+-- Expiry engine and sweep: active subscriptions by deadline
+CREATE INDEX idx_subscriptions_status_expires ON subscriptions (status, expires_at);
+
+-- Makes callback inserts idempotent; fails if duplicate receipts are already stored,
+-- which have to be removed by hand first
+CREATE UNIQUE INDEX uq_payments_transaction_id ON payments (transaction_id);
+
+-- Login history per user and per client address
+CREATE INDEX idx_login_attempts_user ON login_attempts (user_id, attempted_at);
+CREATE INDEX idx_login_attempts_ip ON login_attempts (ip_address, attempted_at);
@@ -0,0 +1,15 @@
+-- One row per scheduled job run, written by utils/scheduler.py. Times are UTC.
+
+CREATE TABLE IF NOT EXISTS job_runs (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    job_name VARCHAR(64) NOT NULL,
+    scheduled_for DATETIME(3) NOT NULL,
+    started_at DATETIME(3) NOT NULL,
+    finished_at DATETIME(3),
+    duration_ms INT,
+    outcome VARCHAR(16) NOT NULL,
+    error TEXT,
+    host VARCHAR(255),
+    pid INT,
+    KEY idx_job_runs_job_scheduled (job_name, scheduled_for)
+);
@@ -0,0 +1,13 @@
+-- Revoked access/refresh tokens (kind 'token', subject = jti) and per-user
+-- revocations (kind 'user', subject = username: tokens issued at or before
+-- revoked_at are rejected). Written by utils/revocation.py and polled by
+-- every worker; rows are purged once expires_at has passed.
+
+CREATE TABLE IF NOT EXISTS token_revocations (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    kind VARCHAR(8) NOT NULL,
+    subject VARCHAR(255) NOT NULL,
+    revoked_at DOUBLE NOT NULL,
+    expires_at DOUBLE NOT NULL,
+    KEY idx_token_revocations_expires (expires_at)
+);
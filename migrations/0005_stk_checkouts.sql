@@ -0,0 +1,23 @@
+-- One row per STK push requested through /mpesa/pay, written by utils/stk.py.
+-- status: queued (waiting for a push worker), pending (push accepted, waiting
+-- for the callback), paid, cancelled or failed. The reconciliation job reads
+-- rows left pending.
+
+CREATE TABLE IF NOT EXISTS stk_checkouts (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    handle CHAR(32) NOT NULL,
+    user_id INT NOT NULL,
+    phone_number VARCHAR(20) NOT NULL,
+    amount INT NOT NULL,
+    status VARCHAR(16) NOT NULL,
+    checkout_request_id VARCHAR(64),
+    merchant_request_id VARCHAR(64),
+    result_code INT,
+    result_desc VARCHAR(255),
+    receipt_number VARCHAR(32),
+    created_at DATETIME(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3),
+    updated_at DATETIME(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3) ON UPDATE CURRENT_TIMESTAMP(3),
+    UNIQUE KEY uq_stk_checkouts_handle (handle),
+    UNIQUE KEY uq_stk_checkouts_checkout_request (checkout_request_id),
+    KEY idx_stk_checkouts_status (status, id)
+);
@@ -0,0 +1,11 @@
+-- Links payments to the STK checkout they settle, so the callback and the
+-- reconciliation job (utils/reconcile.py) cannot both record one checkout.
+-- A payment backfilled from an STK query has no receipt yet and stores the
+-- CheckoutRequestID as its transaction_id until the callback supplies one.
+
+ALTER TABLE payments ADD COLUMN checkout_request_id VARCHAR(64) NULL;
+
+CREATE UNIQUE INDEX uq_payments_checkout_request ON payments (checkout_request_id);
+
+-- Reconciliation reads checkouts from a point in time onwards
+CREATE INDEX idx_stk_checkouts_created ON stk_checkouts (created_at);
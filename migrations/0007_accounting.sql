@@ -0,0 +1,28 @@
+-- Usage reported by access points (utils/accounting.py). accounting_sessions
+-- holds the latest cumulative totals of each session, keyed by access point
+-- and Acct-Session-Id; a subscription's usage is the sum over its sessions.
+-- quota_flags records subscriptions that went past their plan's
+-- bandwidth_limit, at most once each.
+
+CREATE TABLE IF NOT EXISTS accounting_sessions (
+    session_key VARCHAR(191) PRIMARY KEY,
+    user_id INT NOT NULL,
+    subscription_id INT,
+    input_octets BIGINT UNSIGNED NOT NULL DEFAULT 0,
+    output_octets BIGINT UNSIGNED NOT NULL DEFAULT 0,
+    started_at DATETIME(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3),
+    updated_at DATETIME(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3) ON UPDATE CURRENT_TIMESTAMP(3),
+    stopped_at DATETIME(3),
+    KEY idx_accounting_sessions_subscription (subscription_id),
+    KEY idx_accounting_sessions_user (user_id, started_at)
+);
+
+CREATE TABLE IF NOT EXISTS quota_flags (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    subscription_id INT NOT NULL,
+    user_id INT NOT NULL,
+    reason VARCHAR(16) NOT NULL,
+    usage_octets BIGINT UNSIGNED NOT NULL,
+    flagged_at DATETIME(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3),
+    UNIQUE KEY uq_quota_flags_subscription (subscription_id)
+);
@@ -0,0 +1,17 @@
+-- Latest heartbeat of every portal and gateway session (utils/sessions.py).
+-- Each worker writes the beats it receives and reads back the rows changed
+-- since its last read, in (updated_at, session_key) order, to keep its
+-- in-memory registry. last_seen is a Unix time, 0 once the session ended;
+-- rows long past it are purged by a scheduled job.
+
+CREATE TABLE IF NOT EXISTS active_sessions (
+    session_key VARCHAR(191) PRIMARY KEY,
+    username VARCHAR(64) NOT NULL,
+    user_id INT NOT NULL,
+    plan VARCHAR(64) NOT NULL,
+    client VARCHAR(16) NOT NULL,
+    last_seen DOUBLE NOT NULL,
+    updated_at DATETIME(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3) ON UPDATE CURRENT_TIMESTAMP(3),
+    KEY idx_active_sessions_updated (updated_at, session_key),
+    KEY idx_active_sessions_last_seen (last_seen)
+);
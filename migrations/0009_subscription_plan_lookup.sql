@@ -0,0 +1,3 @@
+-- Usage aggregator (utils/accounting.py): each active subscription's plan
+-- is matched to its bandwidth_limit on (name, duration_days)
+CREATE INDEX idx_subscription_plans_name_duration ON subscription_plans (name, duration_days);
@@ -0,0 +1,38 @@
+import time
+
+import pytest
+
+from benchmarks.fakes import FakeDaraja, SmtpSink
+from utils.daraja import DarajaClient
+
+
+def wait_for(condition, timeout=5):
+    """Polls ``condition`` until it is true; fails the test after ``timeout`` seconds."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            pytest.fail(f"Timed out after {timeout}s waiting for {condition}")
+        time.sleep(0.01)
+
+
+def make_client(daraja, **settings):
+    """A DarajaClient talking to the fake Daraja."""
+    options = dict(consumer_key='key', consumer_secret='secret', shortcode='174379', passkey='passkey',
+                   callback_url='https://wiman.test/mpesa/mpesa/callback', base_url=daraja.url,
+                   connect_timeout=1, read_timeout=2)
+    options.update(settings)
+    return DarajaClient(**options)
+
+
+@pytest.fixture
+def smtp_sink():
+    sink = SmtpSink().start()
+    yield sink
+    sink.stop()
+
+
+@pytest.fixture
+def fake_daraja():
+    daraja = FakeDaraja(latency=0).start()
+    yield daraja
+    daraja.stop()
@@ -0,0 +1,25 @@
+import pytest
+
+from utils.accounting import RATE, VOLUME, parse_bandwidth_limit
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('5Mbps', (RATE, 625000)),
+    ('5mbps', (RATE, 625000)),
+    ('5MBPS', (RATE, 625000)),
+    ('5 Mb/s', (RATE, 625000)),
+    ('1.5Kbps', (RATE, 187.5)),
+    ('5MBps', (RATE, 5000000)),
+    ('5MB/s', (RATE, 5000000)),
+    ('10GB', (VOLUME, 10 ** 10)),
+    ('10gb', (VOLUME, 10 ** 10)),
+    ('10Gb', (VOLUME, 10 ** 10)),
+    ('500 mB', (VOLUME, 5 * 10 ** 8)),
+])
+def test_units(text, expected):
+    assert parse_bandwidth_limit(text) == expected
+
+
+@pytest.mark.parametrize('text', [None, '', 'unlimited', '10 GiB', '5Mbit', '-5Mbps'])
+def test_unknown_limits(text):
+    assert parse_bandwidth_limit(text) is None
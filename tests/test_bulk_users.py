@@ -0,0 +1,102 @@
+import MySQLdb
+import pytest
+
+from utils import bulk_users
+
+
+class FakeConnection:
+    """Records committed UPDATEs; any row setting ``taken_email`` raises IntegrityError like the unique key.
+
+    ``statuses`` holds the current status of each user; users not in it are active.
+    """
+
+    taken_email = 'taken@test.local'
+
+    def __init__(self):
+        self.statuses = {}
+        self.committed = []
+        self.queries = []
+        self._pending = []
+
+    def existing_users(self, usernames):
+        return {name.lower(): self.statuses.get(name.lower(), 'active') for name in usernames}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def cursor(self):
+        return self
+
+    def begin(self):
+        self._pending = []
+
+    def commit(self):
+        self.committed.extend(self._pending)
+        self._pending = []
+
+    def rollback(self):
+        self._pending = []
+
+    def execute(self, query, params):
+        if self.taken_email in params:
+            raise MySQLdb.IntegrityError(1062, f"Duplicate entry '{self.taken_email}' for key 'email'")
+        self.queries.append((query, list(params)))
+        self._pending.append(params[-1])
+
+    def executemany(self, query, rows):
+        for params in rows:
+            self.execute(query, params)
+
+
+class NoRevocations:
+    def revoke_users(self, usernames):
+        pass
+
+
+@pytest.fixture
+def db(monkeypatch):
+    connection = FakeConnection()
+    monkeypatch.setattr(bulk_users, 'get_db_connection', lambda: connection)
+    monkeypatch.setattr(bulk_users, '_existing_users', connection.existing_users)
+    monkeypatch.setattr(bulk_users, 'invalidate_user', lambda username: None)
+    monkeypatch.setattr(bulk_users, 'get_revocation_store', lambda: NoRevocations())
+    return connection
+
+
+def test_chunk_is_written_in_one_go(db):
+    result = bulk_users.update_users([
+        {'username': 'alice', 'email': 'alice@test.local'},
+        {'username': 'bob', 'role': 'admin'},
+    ])
+
+    assert result.to_dict()['succeeded'] == 2
+    assert sorted(db.committed) == ['alice', 'bob']
+
+
+def test_clashing_row_does_not_fail_the_chunk(db):
+    result = bulk_users.update_users([
+        {'username': 'alice', 'email': 'alice@test.local'},
+        {'username': 'bob', 'email': FakeConnection.taken_email},
+        {'username': 'carol', 'status': 'inactive'},
+    ]).to_dict()
+
+    assert result['succeeded'] == 2
+    assert [error['row'] for error in result['errors']] == [2]
+    assert result['errors'][0]['error'].startswith("Conflicts with another user")
+    assert sorted(db.committed) == ['alice', 'carol']
+
+
+def test_unblock_only_activates_blocked_users(db):
+    db.statuses.update(alice='blocked', bob='inactive')
+
+    result = bulk_users.set_status(['alice', 'bob', 'carol'], 'active', from_status='blocked').to_dict()
+
+    assert result['succeeded'] == 1
+    assert [(error['row'], error['error']) for error in result['errors']] == [
+        (2, "User is inactive, not blocked"), (3, "User is active, not blocked")]
+    query, params = db.queries[-1]
+    assert query.endswith("AND status = %s")
+    assert params == ['active', 'alice', 'blocked']
@@ -0,0 +1,81 @@
+import threading
+import time
+
+import pytest
+
+from benchmarks.fakes import FakeDaraja
+from tests.conftest import make_client
+from utils.daraja import DarajaError
+
+
+def test_token_is_cached(fake_daraja):
+    client = make_client(fake_daraja)
+    for _ in range(5):
+        assert client.stk_push('254700000001', 10)['ResponseCode'] == '0'
+
+    assert fake_daraja.calls['oauth'] == 1
+    assert fake_daraja.calls['stkpush'] == 5
+
+
+def test_token_is_refreshed_before_it_expires():
+    fake_daraja = FakeDaraja(latency=0, expires_in='60').start()
+    client = make_client(fake_daraja, token_refresh_margin=60)
+    try:
+        client.stk_push('254700000001', 10)
+        client.stk_push('254700000001', 10)
+    finally:
+        fake_daraja.stop()
+
+    assert fake_daraja.calls['oauth'] == 2
+
+
+def test_concurrent_callers_share_one_refresh(fake_daraja):
+    fake_daraja.latency = 0.2
+    client = make_client(fake_daraja)
+    tokens = []
+    threads = [threading.Thread(target=lambda: tokens.append(client.access_token())) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert fake_daraja.calls['oauth'] == 1
+    assert len(set(tokens)) == 1
+
+
+def test_rejected_token_is_refreshed_once(fake_daraja):
+    client = make_client(fake_daraja)
+    client.stk_push('254700000001', 10)
+    fake_daraja.revoke_tokens()
+
+    assert client.stk_push('254700000001', 10)['ResponseCode'] == '0'
+    assert fake_daraja.calls['unauthorized'] == 1
+    assert fake_daraja.calls['oauth'] == 2
+
+
+@pytest.mark.parametrize('body', [b'<html><body>502 Bad Gateway</body></html>', b'', b'[]'])
+def test_unreadable_oauth_reply_is_a_daraja_error(fake_daraja, body):
+    fake_daraja.oauth_body = body
+    client = make_client(fake_daraja)
+
+    with pytest.raises(DarajaError):
+        client.stk_push('254700000001', 10)
+    assert client.token_fetches == 0
+
+
+def test_read_timeout_is_a_daraja_error(fake_daraja):
+    fake_daraja.latency = 1
+    client = make_client(fake_daraja, read_timeout=0.1)
+    started = time.monotonic()
+
+    with pytest.raises(DarajaError):
+        client.stk_query('ws_CO_1')
+    assert time.monotonic() - started < 1
+
+
+def test_unreachable_daraja_is_a_daraja_error(fake_daraja):
+    client = make_client(fake_daraja)
+    fake_daraja.stop()
+
+    with pytest.raises(DarajaError):
+        client.stk_push('254700000001', 10)
@@ -0,0 +1,53 @@
+import logging
+import sys
+
+from blueprints import mpesa
+from utils.config import get_section
+from utils.logging_config import JsonFormatter, SamplingFilter, SizedTimedRotatingFileHandler
+from utils.logging_config import _parse_pairs, _worker_handlers
+
+
+class Capture(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def test_callback_logs_are_sampled_as_configured():
+    rates = {name: int(rate) for name, rate in _parse_pairs(get_section('logging').get('sample', '')).items()}
+    capture = Capture()
+    capture.addFilter(SamplingFilter(rates))
+    mpesa.logger.setLevel(logging.INFO)
+    mpesa.logger.addHandler(capture)
+    try:
+        for index in range(10):
+            mpesa.logger.info("MPESA callback %s: result %s", f"ws_CO_{index}", 0)
+        mpesa.logger.error("Could not update checkout %s: %s", 'ws_CO_1', 'boom')
+    finally:
+        mpesa.logger.removeHandler(capture)
+        mpesa.logger.setLevel(logging.NOTSET)
+
+    assert rates[mpesa.logger.name] == 5
+    assert [record.levelno for record in capture.records] == [logging.INFO] * 2 + [logging.ERROR]
+
+
+def test_workers_drop_the_shared_log_file(tmp_path):
+    log_file = SizedTimedRotatingFileHandler(str(tmp_path / 'wiman.log'), max_bytes=1024, backup_count=1)
+    log_file.setFormatter(JsonFormatter())
+
+    handlers = _worker_handlers([log_file])
+
+    assert len(handlers) == 1
+    assert handlers[0].stream is sys.stdout
+    assert isinstance(handlers[0].formatter, JsonFormatter)
+    assert log_file.stream is None
+
+
+def test_workers_keep_one_console_handler(tmp_path):
+    log_file = SizedTimedRotatingFileHandler(str(tmp_path / 'wiman.log'), max_bytes=1024, backup_count=1)
+    console = logging.StreamHandler(sys.stdout)
+
+    assert _worker_handlers([log_file, console]) == [console]
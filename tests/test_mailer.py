@@ -0,0 +1,147 @@
+import json
+import os
+
+import pytest
+
+from tests.conftest import wait_for
+from utils.mailer import Mailer
+
+
+@pytest.fixture
+def make_mailer(smtp_sink, tmp_path):
+    """Builds mailers sharing one spool and delivering to the SMTP sink; stops them afterwards."""
+    mailers = []
+
+    def make(**settings):
+        options = dict(host='127.0.0.1', port=smtp_sink.port, sender='wiman@test.local', use_tls=False,
+                       spool_dir=str(tmp_path / 'spool'), retry_backoff=0.05, idle_timeout=1)
+        options.update(settings)
+        mailer = Mailer(**options)
+        mailers.append(mailer)
+        return mailer
+
+    yield make
+    for mailer in mailers:
+        mailer.stop()
+
+
+def spooled(mailer, folder):
+    return sorted(os.listdir(os.path.join(mailer.spool_dir, folder)))
+
+
+def leave_in_cur(spool_dir, owner, count):
+    """Writes messages claimed by ``owner`` as if its process had died holding them."""
+    for name in ('cur', 'locks'):
+        os.makedirs(os.path.join(spool_dir, name), exist_ok=True)
+    open(os.path.join(spool_dir, 'locks', f"{owner}.lock"), 'w').close()
+    for index in range(count):
+        with open(os.path.join(spool_dir, 'cur', f"{owner}-{index}.json"), 'w') as f:
+            json.dump({'to': f"user{index}@test.local", 'subject': 'Hi', 'body': 'Hello', 'attempts': 0}, f)
+
+
+def test_batches_share_one_connection(make_mailer, smtp_sink):
+    mailer = make_mailer(batch_size=20)
+    for index in range(50):
+        mailer.enqueue(f"user{index}@test.local", 'Welcome', 'Hello')
+    mailer.start()
+
+    wait_for(lambda: mailer.sent == 50)
+    assert smtp_sink.messages == 50
+    assert smtp_sink.connections == 1
+    assert spooled(mailer, 'cur') == []
+
+
+def test_transient_failure_is_retried_with_backoff(make_mailer, smtp_sink):
+    smtp_sink.rejects.extend(['451 Try again later'] * 2)
+    mailer = make_mailer()
+    mailer.enqueue('user@test.local', 'Welcome', 'Hello')
+    mailer.start()
+
+    wait_for(lambda: mailer.sent == 1)
+    assert smtp_sink.messages == 1
+    assert mailer.failed == 0
+
+
+def test_retry_backoff_doubles(make_mailer, smtp_sink, monkeypatch):
+    smtp_sink.rejects.extend(['451 Try again later'] * 3)
+    mailer = make_mailer(retry_backoff=10)
+    delays = []
+    monkeypatch.setattr('utils.mailer.heapq.heappush', lambda heap, item: delays.append(item))
+    path = mailer._claimed_path('message.json')
+    mailer._write(path, {'to': 'user@test.local', 'subject': 'Hi', 'body': 'Hello', 'attempts': 0})
+    for _ in range(3):
+        mailer._send_batch([path])
+
+    gaps = [ready_at for ready_at, _ in delays]
+    assert [round(b - a) for a, b in zip(gaps, gaps[1:])] == [10, 20]
+    with open(path) as f:
+        assert json.load(f)['attempts'] == 3
+
+
+def test_permanent_failure_moves_to_failed(make_mailer, smtp_sink):
+    smtp_sink.rejects.append('550 No such user')
+    mailer = make_mailer()
+    mailer.enqueue('nobody@test.local', 'Welcome', 'Hello')
+    mailer.start()
+
+    wait_for(lambda: mailer.failed == 1)
+    assert len(spooled(mailer, 'failed')) == 1
+    assert spooled(mailer, 'cur') == []
+    assert smtp_sink.messages == 0
+
+
+def test_gives_up_after_max_retries(make_mailer, smtp_sink):
+    smtp_sink.rejects.extend(['421 Busy'] * 3)
+    mailer = make_mailer(max_retries=2)
+    mailer.enqueue('user@test.local', 'Welcome', 'Hello')
+    mailer.start()
+
+    wait_for(lambda: mailer.failed == 1)
+    assert smtp_sink.messages == 0
+    assert len(spooled(mailer, 'failed')) == 1
+
+
+def test_unreachable_server_keeps_mail_spooled(make_mailer, smtp_sink):
+    port = smtp_sink.port
+    smtp_sink.stop()
+    mailer = make_mailer(port=port, timeout=0.5)
+    mailer.enqueue('user@test.local', 'Welcome', 'Hello')
+    mailer.start()
+
+    wait_for(lambda: mailer._connect_failures >= 2)
+    assert mailer.failed == 0
+    assert len(spooled(mailer, 'cur')) == 1
+
+
+def test_recovers_mail_of_a_dead_owner_on_start(make_mailer, smtp_sink, tmp_path):
+    # The owner's pid is a live process (ours), as after pid reuse; only its lock decides
+    leave_in_cur(str(tmp_path / 'spool'), f"{os.getpid()}.deadbeef0000", 3)
+    mailer = make_mailer()
+    assert mailer.pending() == 3
+    mailer.start()
+
+    wait_for(lambda: mailer.sent == 3)
+    assert smtp_sink.messages == 3
+    assert spooled(mailer, 'locks') == [f"{mailer.owner}.lock"]
+
+
+def test_leaves_mail_of_a_running_owner_alone(make_mailer):
+    first = make_mailer()
+    first.enqueue('user@test.local', 'Welcome', 'Hello')
+    second = make_mailer()
+
+    assert second.pending() == 0
+    assert len(spooled(first, 'cur')) == 1
+
+
+def test_recovers_while_running(make_mailer, smtp_sink):
+    stopped = make_mailer()
+    stopped.enqueue('user@test.local', 'Welcome', 'Hello')
+    survivor = make_mailer(recover_interval=0.1)
+    survivor.start()
+    assert survivor.pending() == 0
+
+    stopped.stop()  # releases its lock like a process that died
+    wait_for(lambda: survivor.sent == 1)
+    assert smtp_sink.messages == 1
+    assert spooled(survivor, 'cur') == []
@@ -0,0 +1,38 @@
+import pytest
+from flask import Flask
+
+from utils import metrics
+
+
+@pytest.fixture
+def make_client(monkeypatch):
+    def make(allow_ips='', token=None):
+        if token:
+            monkeypatch.setenv('METRICS_TOKEN', token)
+        else:
+            monkeypatch.delenv('METRICS_TOKEN', raising=False)
+        app = Flask(__name__)
+        metrics.init_metrics(app)
+        monkeypatch.setattr(metrics, '_scraper_networks', metrics._parse_networks(allow_ips))
+        return app.test_client()
+    return make
+
+
+def test_metrics_are_not_public(make_client):
+    assert make_client().get('/metrics').status_code == 403
+
+
+def test_scraper_with_the_token(make_client):
+    client = make_client(token='scrape-secret')
+
+    assert client.get('/metrics', headers={'Authorization': 'Bearer scrape-secret'}).status_code == 200
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 403
+
+
+@pytest.mark.parametrize('allow_ips, status', [
+    ('127.0.0.1', 200), ('127.0.0.0/8, 10.0.0.0/8', 200), ('10.0.0.0/8', 403), ('not-an-ip, 127.0.0.1', 200),
+])
+def test_allowed_networks(make_client, allow_ips, status):
+    response = make_client(allow_ips=allow_ips).get('/metrics', environ_base={'REMOTE_ADDR': '127.0.0.1'})
+
+    assert response.status_code == status
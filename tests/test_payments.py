@@ -0,0 +1,54 @@
+import pytest
+
+from utils.payments import parse_stk_callback
+
+
+def stk_callback(result_code=0, items=None):
+    callback = {
+        'MerchantRequestID': '29115-34620561-1',
+        'CheckoutRequestID': 'ws_CO_191220191020363925',
+        'ResultCode': result_code,
+        'ResultDesc': 'The service request is processed successfully.',
+    }
+    if items is not None:
+        callback['CallbackMetadata'] = {'Item': items}
+    return {'Body': {'stkCallback': callback}}
+
+
+def test_reads_callback_metadata():
+    callback = parse_stk_callback(stk_callback(items=[
+        {'Name': 'Amount', 'Value': 1.0},
+        {'Name': 'MpesaReceiptNumber', 'Value': 'NLJ7RT61SV'},
+        {'Name': 'Balance'},
+        {'Name': 'TransactionDate', 'Value': 20191219102115},
+        {'Name': 'PhoneNumber', 'Value': 254708374149},
+    ]))
+
+    assert callback['result_code'] == 0
+    assert callback['checkout_request_id'] == 'ws_CO_191220191020363925'
+    assert callback['receipt_number'] == 'NLJ7RT61SV'
+    assert callback['amount'] == 1.0
+    assert callback['phone_number'] == 254708374149
+
+
+def test_failed_payment_has_no_metadata():
+    callback = parse_stk_callback(stk_callback(result_code=1032))
+
+    assert callback['result_code'] == 1032
+    assert callback['receipt_number'] is None
+
+
+@pytest.mark.parametrize('data', [
+    None, [], ['Body'], 'Body', 42,
+    {}, {'Body': []}, {'Body': 'stkCallback'}, {'Body': {'stkCallback': ['ResultCode']}},
+])
+def test_rejects_bodies_that_are_not_callbacks(data):
+    assert parse_stk_callback(data) is None
+
+
+@pytest.mark.parametrize('metadata', [None, [], 'Item', {'Item': 'x'}, {'Item': ['x', 1]}])
+def test_ignores_malformed_metadata(metadata):
+    data = stk_callback()
+    data['Body']['stkCallback']['CallbackMetadata'] = metadata
+
+    assert parse_stk_callback(data)['receipt_number'] is None
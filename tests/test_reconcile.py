@@ -0,0 +1,205 @@
+import threading
+
+import pytest
+
+from tests.conftest import make_client
+from utils import payments, reconcile
+from utils.payments import DUPLICATE, record_payment
+from utils.reconcile import Reconciler
+from utils.stk import QUEUED, PENDING, PAID, CANCELLED, FAILED
+
+RECEIPT = 'NLJ7RT61SV'
+
+
+class FakeStore:
+    """In-memory stk_checkouts, payments and users, answering the queries reconcile and record_payment run.
+
+    INSERT_PAYMENT follows MySQL's ON DUPLICATE KEY UPDATE on the unique
+    transaction_id and checkout_request_id keys, rowcount included (1 for an
+    insert, 2 for a changed row, 0 for an unchanged one).
+    """
+
+    def __init__(self):
+        self.users = {}
+        self.checkouts = []
+        self.payments = []
+        self.lock = threading.Lock()
+
+    def add_user(self, phone_number):
+        self.users[len(self.users) + 1] = phone_number
+        return len(self.users)
+
+    def add_checkout(self, user_id, status, checkout_request_id, receipt_number=None):
+        self.checkouts.append({
+            'id': len(self.checkouts) + 1, 'user_id': user_id, 'phone_number': self.users[user_id],
+            'amount': 10, 'status': status, 'checkout_request_id': checkout_request_id,
+            'receipt_number': receipt_number, 'result_code': None,
+        })
+
+    def status(self, checkout_request_id):
+        return next(row['status'] for row in self.checkouts if row['checkout_request_id'] == checkout_request_id)
+
+    def connection(self):
+        return FakeConnection(self)
+
+    def run(self, query, params):
+        """Returns (rows, rowcount)."""
+        if query == reconcile.SELECT_FIRST_ID:
+            return [(row['id'],) for row in self.checkouts[:1]], 1
+        if query == reconcile.SELECT_UNSETTLED:
+            after_id, _, queued, pending, paid, limit = params
+            paid_checkouts = {payment['checkout_request_id'] for payment in self.payments}
+            rows = [(row['id'], row['user_id'], row['phone_number'], row['amount'], row['status'],
+                     row['checkout_request_id'], row['receipt_number'])
+                    for row in self.checkouts if row['id'] > after_id and (
+                        row['status'] in (queued, pending)
+                        or row['status'] == paid and row['checkout_request_id'] not in paid_checkouts)]
+            return rows[:limit], len(rows[:limit])
+        if query == reconcile.SETTLE_OPEN_CHECKOUT:
+            status, result_code, _, row_id, *open_states = params
+            row = self.checkouts[row_id - 1]
+            if row['status'] not in open_states:
+                return [], 0
+            row.update(status=status, result_code=result_code)
+            return [], 1
+        if query == payments.SELECT_PAYER.format(column='u.id'):
+            return [(params[0], None)] if params[0] in self.users else [], 1
+        if query == payments.SELECT_PAYER.format(column='u.phone_number'):
+            return [(user_id, None) for user_id, phone in self.users.items() if phone == params[0]][:1], 1
+        if query.startswith('SHOW INDEX FROM payments'):
+            return [('payments', 0, 'transaction_id')], 1
+        if query == payments.INSERT_PAYMENT:
+            return [], self._insert_payment(*params)
+        raise AssertionError(f"Unexpected query: {query}")
+
+    def _insert_payment(self, user_id, subscription_id, phone_number, amount, receipt, checkout_request_id, status):
+        for payment in self.payments:
+            if payment['transaction_id'] == receipt or (
+                    checkout_request_id and payment['checkout_request_id'] == checkout_request_id):
+                before = dict(payment)
+                if payment['transaction_id'] == payment['checkout_request_id']:
+                    payment['transaction_id'] = receipt
+                if payment['checkout_request_id'] is None:
+                    payment['checkout_request_id'] = checkout_request_id
+                return 2 if payment != before else 0
+        self.payments.append({'user_id': user_id, 'transaction_id': receipt,
+                              'checkout_request_id': checkout_request_id, 'amount': amount})
+        return 1
+
+
+class FakeConnection:
+    def __init__(self, store):
+        self.store = store
+        self.rows = []
+        self.rowcount = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def cursor(self):
+        return self
+
+    def begin(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def execute(self, query, params=None):
+        with self.store.lock:
+            self.rows, self.rowcount = self.store.run(query, params)
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return list(self.rows)
+
+
+class NoEntitlements:
+    def invalidate(self, user_id):
+        pass
+
+
+@pytest.fixture
+def store(monkeypatch):
+    store = FakeStore()
+    monkeypatch.setattr(reconcile, 'get_db_connection', store.connection)
+    monkeypatch.setattr(payments, 'get_db_connection', store.connection)
+    monkeypatch.setattr(payments, 'get_entitlement_index', NoEntitlements)
+    monkeypatch.setattr(payments, '_receipt_key', None)
+    return store
+
+
+@pytest.fixture
+def reconciler(fake_daraja):
+    client = make_client(fake_daraja)
+    return Reconciler(workers=4, chunk_size=2, client_factory=lambda: client)
+
+
+def seed_lost_callbacks(store, daraja):
+    """One checkout per outcome, as if every callback had been lost."""
+    user_id = store.add_user('254700000001')
+    for checkout_request_id, result_code in (('ws_CO_paid', 0), ('ws_CO_cancelled', 1032),
+                                             ('ws_CO_failed', 1), ('ws_CO_waiting', None)):
+        store.add_checkout(user_id, PENDING, checkout_request_id)
+        daraja.results[checkout_request_id] = result_code
+    store.add_checkout(user_id, PAID, 'ws_CO_unrecorded', receipt_number=RECEIPT)
+    store.add_checkout(user_id, QUEUED, None)
+
+
+def test_settles_lost_callbacks(store, reconciler, fake_daraja):
+    seed_lost_callbacks(store, fake_daraja)
+
+    summary = reconciler.run()
+
+    assert summary['checked'] == 6
+    assert (summary['backfilled'], summary['cancelled'], summary['failed'], summary['never_pushed'],
+            summary['still_pending']) == (2, 1, 1, 1, 1)
+    assert [row['status'] for row in store.checkouts] == [PAID, CANCELLED, FAILED, PENDING, PAID, FAILED]
+    assert sorted((payment['checkout_request_id'], payment['transaction_id']) for payment in store.payments) == [
+        ('ws_CO_paid', 'ws_CO_paid'), ('ws_CO_unrecorded', RECEIPT)]
+
+
+def test_second_run_backfills_nothing(store, reconciler, fake_daraja):
+    seed_lost_callbacks(store, fake_daraja)
+    reconciler.run()
+
+    summary = reconciler.run()
+
+    assert summary['backfilled'] == 0
+    assert summary['checked'] == 1  # the checkout Daraja still reports as processing
+    assert len(store.payments) == 2
+
+
+def test_late_callback_only_swaps_in_the_receipt(store, reconciler, fake_daraja):
+    user_id = store.add_user('254700000001')
+    store.add_checkout(user_id, PENDING, 'ws_CO_late')
+    reconciler.run()
+    assert store.payments[0]['transaction_id'] == 'ws_CO_late'
+
+    outcome = record_payment({'phone_number': '254700000001', 'amount': 10, 'receipt_number': RECEIPT,
+                              'checkout_request_id': 'ws_CO_late'})
+
+    assert outcome == DUPLICATE
+    assert store.payments == [{'user_id': user_id, 'transaction_id': RECEIPT,
+                               'checkout_request_id': 'ws_CO_late', 'amount': 10}]
+
+
+def test_backfill_after_the_callback_is_a_no_op(store, reconciler, fake_daraja):
+    user_id = store.add_user('254700000001')
+    store.add_checkout(user_id, PENDING, 'ws_CO_on_time')
+    record_payment({'phone_number': '254700000001', 'amount': 10, 'receipt_number': RECEIPT,
+                    'checkout_request_id': 'ws_CO_on_time'})
+
+    summary = reconciler.run()
+
+    assert summary['duplicates'] == 1
+    assert store.status('ws_CO_on_time') == PAID
+    assert [payment['transaction_id'] for payment in store.payments] == [RECEIPT]
@@ -0,0 +1,33 @@
+import threading
+
+from utils.sessions import SessionRegistry
+
+
+def test_concurrent_subscribers_never_exceed_the_cap():
+    registry = SessionRegistry(max_subscribers=2)
+    barrier = threading.Barrier(20)
+    subscribers = []
+
+    def subscribe():
+        barrier.wait()
+        subscribers.append(registry.subscribe())
+
+    threads = [threading.Thread(target=subscribe) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    accepted = [subscriber for subscriber in subscribers if subscriber is not None]
+    assert len(accepted) == 2
+    assert registry.stats()['subscribers'] == 2
+
+
+def test_unsubscribing_frees_a_slot():
+    registry = SessionRegistry(max_subscribers=1)
+    first = registry.subscribe()
+    assert registry.subscribe() is None
+
+    registry.unsubscribe(first)
+
+    assert registry.subscribe() is not None
@@ -0,0 +1,63 @@
+import threading
+import time
+
+import pytest
+
+from tests.conftest import wait_for
+from utils import stk
+from utils.payments import QueueFullError
+
+
+def track(orchestrator, handle, status=stk.PENDING):
+    orchestrator._states.set(handle, {'handle': handle, 'user_id': 1, 'status': status, 'checked_at': time.monotonic()})
+
+
+def test_waiters_past_the_cap_are_turned_away():
+    orchestrator = stk.StkOrchestrator(workers=0, poll_interval=60, max_waiters=1)
+    track(orchestrator, 'h1')
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(orchestrator.wait('h1', stk.PENDING, 5)))
+    waiter.start()
+    wait_for(lambda: orchestrator.waiting == 1)
+
+    with pytest.raises(QueueFullError):
+        orchestrator.wait('h1', stk.PENDING, 5)
+
+    with orchestrator._cond:
+        orchestrator._states.get('h1')['status'] = stk.PAID
+        orchestrator._cond.notify_all()
+    waiter.join(5)
+    assert results[0]['status'] == stk.PAID
+    assert orchestrator.waiting == 0
+
+
+class FakeConnection:
+    def __init__(self, row):
+        self.row = row
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.closed = True
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, params):
+        pass
+
+    def fetchone(self):
+        return self.row
+
+
+def test_reload_does_not_use_the_request_connection(monkeypatch):
+    row = ('h1', 1, '254700000001', 10, stk.PAID, 'ws_CO_1', 'm1', 0, 'Paid', 'NLJ7RT61SV')
+    connection = FakeConnection(row)
+    monkeypatch.setattr(stk, 'get_pooled_connection', lambda: connection)
+    monkeypatch.setattr(stk, 'get_db_connection', lambda: pytest.fail("held the request connection"))
+    orchestrator = stk.StkOrchestrator(workers=0, poll_interval=0)
+
+    assert orchestrator.wait('h1', stk.PENDING, 1)['receipt_number'] == 'NLJ7RT61SV'
+    assert connection.closed
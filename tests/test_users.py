@@ -0,0 +1,47 @@
+import jwt
+import pytest
+from flask import Flask
+
+from blueprints import users
+
+SECRET_KEY = 'test-secret-key-of-at-least-32-bytes'
+
+
+class FakeConnection:
+    def __init__(self, row):
+        self.row = row
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, params):
+        assert query == users.SELECT_LOGIN
+
+    def fetchone(self):
+        return self.row
+
+
+@pytest.fixture
+def client(monkeypatch):
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = SECRET_KEY
+    app.register_blueprint(users.users_bp, url_prefix='/users')
+    monkeypatch.setattr(users, 'get_db_connection', lambda: FakeConnection(('hash', 'active', 'user')))
+    monkeypatch.setattr(users, 'check_password', lambda password_hash, password: True)
+    return app.test_client()
+
+
+def test_login_issues_a_revocable_token(client):
+    response = client.post('/users/login', json={'username': 'alice', 'password': 'secret123'})
+
+    assert response.status_code == 200
+    claims = jwt.decode(response.get_json()['token'], SECRET_KEY, algorithms=['HS256'])
+    assert claims['username'] == 'alice'
+    assert claims['jti']
+    assert claims['exp'] - claims['iat'] == pytest.approx(3600, abs=5)
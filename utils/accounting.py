@@ -0,0 +1,427 @@
+import atexit
+import logging
+import re
+import threading
+import time
+from collections import namedtuple
+
+from utils.config import get_section
+from utils.db import get_db_connection
+from utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Acct-Status-Type values
+START = 'Start'
+INTERIM = 'Interim-Update'
+STOP = 'Stop'
+
+# Why a subscription was flagged
+VOLUME = 'volume'  # used more data than the plan's quota
+RATE = 'rate'      # a session ran faster than the plan's rate, i.e. the access point isn't shaping it
+
+# "5Mbps" is a rate, "10GB" a volume; decimal multiples, see parse_bandwidth_limit for the units
+LIMIT_PATTERN = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)(bps|b/s|b)\s*$', re.IGNORECASE)
+MULTIPLIERS = {'': 1, 'k': 10 ** 3, 'm': 10 ** 6, 'g': 10 ** 9, 't': 10 ** 12}
+
+# What the aggregator knows about a user: their active subscription and its limit
+Limit = namedtuple('Limit', ['user_id', 'subscription_id', 'kind', 'value', 'loaded_at'])
+
+# Each user's active subscription, its plan's bandwidth_limit and any flag on it
+SELECT_LIMITS = """
+    SELECT u.username, u.id, s.id, sp.bandwidth_limit, f.reason
+    FROM users u
+    LEFT JOIN subscriptions s ON s.user_id = u.id AND s.status = 'active' AND s.expires_at > NOW()
+    LEFT JOIN plans p ON p.id = s.plan_id
+    LEFT JOIN subscription_plans sp ON sp.name = p.name AND sp.duration_days = p.duration
+    LEFT JOIN quota_flags f ON f.subscription_id = s.id
+    WHERE u.username IN ({usernames})
+    ORDER BY s.expires_at
+"""
+SELECT_USAGE = """
+    SELECT subscription_id, SUM(input_octets + output_octets)
+    FROM accounting_sessions
+    WHERE subscription_id IN ({ids})
+    GROUP BY subscription_id
+"""
+
+updates_total = registry.counter(
+    'wiman_accounting_updates_total', 'Accounting updates received, by outcome.', ('outcome',))
+flags_total = registry.counter(
+    'wiman_accounting_flags_total', 'Subscriptions flagged for exceeding their plan.', ('reason',))
+
+_aggregator = None
+_aggregator_lock = threading.Lock()
+
+
+class AccountingOverloaded(Exception):
+    """Raised when too many sessions are waiting to be written; the access point should resend later."""
+
+
+def parse_bandwidth_limit(text):
+    """Parses subscription_plans.bandwidth_limit into (RATE, bytes per second) or (VOLUME, bytes).
+
+    A volume is always in bytes: data is sold by the gigabyte, so "10GB",
+    "10Gb" and "10gb" all mean the same. A rate is in bits per second
+    ("5Mbps", "5mbps", "5MBPS", "5Mb/s") unless written with a capital B
+    and a lower-case rest ("5MBps", "5MB/s"), which is bytes per second.
+    Returns None if the limit is missing or not understood.
+    """
+    match = LIMIT_PATTERN.match(text or '')
+    if not match:
+        return None
+    number, prefix, unit = match.groups()
+    value = float(number) * MULTIPLIERS[prefix.lower()]
+    if unit.lower() == 'b':
+        return VOLUME, int(value)
+    if unit in ('Bps', 'B/s'):
+        return RATE, value
+    return RATE, value / 8
+
+
+def _attribute(raw, name, default=None):
+    """Reads a RADIUS attribute given either as a plain value or FreeRADIUS rlm_rest style, {"value": [...]}."""
+    value = raw.get(name, default)
+    if isinstance(value, dict):
+        value = value.get('value', default)
+    if isinstance(value, list):
+        value = value[0] if value else default
+    return value
+
+
+def _octets(raw, direction):
+    """Total octets in one direction; Acct-*-Gigawords counts the times the 32-bit counter wrapped."""
+    octets = int(_attribute(raw, f'Acct-{direction}-Octets', 0))
+    gigawords = int(_attribute(raw, f'Acct-{direction}-Gigawords', 0))
+    if octets < 0 or gigawords < 0:
+        raise ValueError(f"Acct-{direction}-Octets must not be negative")
+    return (gigawords << 32) + octets
+
+
+def parse_update(raw):
+    """Normalizes one accounting request from an access point, keyed by RADIUS attribute names.
+
+    Returns None for Accounting-On/Off, which carry no session. Raises
+    ValueError if a required attribute is missing or malformed.
+    """
+    if not isinstance(raw, dict):
+        raise ValueError("Update must be an object")
+    status = _attribute(raw, 'Acct-Status-Type')
+    if status in ('Accounting-On', 'Accounting-Off'):
+        return None
+    if status not in (START, INTERIM, STOP):
+        raise ValueError("Acct-Status-Type must be Start, Interim-Update or Stop")
+    session_id = _attribute(raw, 'Acct-Session-Id')
+    username = _attribute(raw, 'User-Name')
+    if not session_id or not username:
+        raise ValueError("Acct-Session-Id and User-Name are required")
+    try:
+        input_octets, output_octets = _octets(raw, 'Input'), _octets(raw, 'Output')
+        session_time = int(_attribute(raw, 'Acct-Session-Time', 0))
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid counter: {e}")
+    # Session ids are only unique per access point
+    nas = _attribute(raw, 'NAS-Identifier') or _attribute(raw, 'NAS-IP-Address') or ''
+    return {
+        'session_key': f"{nas}:{session_id}"[:191],
+        'session_id': session_id,
+        'username': str(username),
+        'status': status,
+        'input_octets': input_octets,
+        'output_octets': output_octets,
+        'session_time': session_time,
+    }
+
+
+class UsageAggregator:
+    """Collects interim accounting from access points and writes it to MySQL in batches.
+
+    Access points report cumulative totals per session, so an update only
+    replaces the session's latest totals in memory; however often a session
+    reports, it is written once per ``flush_interval`` by a background
+    thread, as one multi-row upsert into accounting_sessions. The upsert
+    keeps the larger of the stored and reported totals, so updates for one
+    session can land on any node, arrive twice or out of order.
+
+    After each flush the subscriptions just written are summed in one query
+    and those past a volume quota are flagged in quota_flags; so is a session
+    seen running faster than a rate-limited plan allows, as soon as its
+    update arrives. Flags are kept per subscription, so a renewal clears them.
+    """
+
+    def __init__(self, flush_interval=2, limits_ttl=60, session_timeout=900, max_pending=200000,
+                 rate_tolerance=1.1, min_rate_interval=30):
+        self.flush_interval = flush_interval
+        self.limits_ttl = limits_ttl
+        self.session_timeout = session_timeout
+        self.max_pending = max_pending
+        self.rate_tolerance = rate_tolerance
+        self.min_rate_interval = min_rate_interval
+        self.flushes = 0
+        self.rows_written = 0
+        self.flush_failures = 0
+        self.unknown_users = 0
+        self.last_flush_seconds = 0.0
+        self._pending = {}   # session key -> [username, input_octets, output_octets, stopped]
+        self._samples = {}   # session key -> (input_octets, output_octets, session_time, last seen)
+        self._limits = {}    # username -> Limit
+        self._flagged = {}   # subscription_id -> reason
+        self._new_flags = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='accounting', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5):
+        """Stops the flush thread after writing what is still pending."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def ingest(self, updates):
+        """Applies a batch of normalized updates; returns the session ids whose subscription is flagged.
+
+        Each update is a dict with session_key, session_id, username,
+        status, input_octets, output_octets and session_time. Raises
+        AccountingOverloaded, before applying any of them, if the batch
+        would take the pending sessions past ``max_pending``.
+        """
+        now = time.monotonic()
+        disconnect = []
+        with self._lock:
+            if len(self._pending) + len(updates) > self.max_pending:
+                updates_total.inc('rejected', amount=len(updates))
+                raise AccountingOverloaded(f"{len(self._pending)} sessions waiting to be written")
+            for update in updates:
+                key = update['session_key']
+                entry = self._pending.get(key)
+                if entry is None:
+                    self._pending[key] = [update['username'], update['input_octets'], update['output_octets'],
+                                          update['status'] == STOP]
+                else:
+                    entry[1] = max(entry[1], update['input_octets'])
+                    entry[2] = max(entry[2], update['output_octets'])
+                    entry[3] = entry[3] or update['status'] == STOP
+
+                limit = self._limits.get(update['username'])
+                if limit is None or limit.subscription_id is None:
+                    continue
+                if limit.kind == RATE:
+                    self._check_rate(key, update, limit, now)
+                if limit.subscription_id in self._flagged:
+                    disconnect.append(update['session_id'])
+        updates_total.inc('accepted', amount=len(updates))
+        return disconnect
+
+    def _check_rate(self, key, update, limit, now):
+        """Flags the subscription if the session moved data faster than the plan's rate since its last sample."""
+        if update['status'] == STOP:
+            sample = self._samples.pop(key, None)
+        else:
+            sample = self._samples.get(key)
+            if sample is None or update['session_time'] - sample[2] >= self.min_rate_interval:
+                self._samples[key] = (update['input_octets'], update['output_octets'], update['session_time'], now)
+        # Short intervals are skipped: bursts the shaper allows would look like overruns
+        if sample is None or update['session_time'] - sample[2] < self.min_rate_interval:
+            return
+        moved = max(update['input_octets'] - sample[0], update['output_octets'] - sample[1])
+        if moved / (update['session_time'] - sample[2]) > limit.value * self.rate_tolerance \
+                and limit.subscription_id not in self._flagged:
+            self._flagged[limit.subscription_id] = RATE
+            self._new_flags.append((limit.subscription_id, limit.user_id, RATE, update['input_octets']
+                                    + update['output_octets']))
+
+    # -- Flushing ---------------------------------------------------------------
+
+    def _load_limits(self, usernames):
+        """Reads each user's active subscription, its plan limit and any flag on it, in one query.
+
+        Returns ({username: Limit}, {subscription_id: reason}); flags set by
+        other nodes reach this one this way.
+        """
+        placeholders = ', '.join(['%s'] * len(usernames))
+        with get_db_connection() as db, db.cursor() as cursor:
+            cursor.execute(SELECT_LIMITS.format(usernames=placeholders), list(usernames))
+            rows = cursor.fetchall()
+        now = time.monotonic()
+        limits, flags = {}, {}
+        for username, user_id, subscription_id, bandwidth_limit, reason in rows:
+            # Ordered by expiry, so the subscription running longest wins
+            kind, value = parse_bandwidth_limit(bandwidth_limit) or (None, None)
+            limits[username] = Limit(user_id, subscription_id, kind, value, now)
+            if reason:
+                flags[subscription_id] = reason
+        return limits, flags
+
+    def _write(self, rows):
+        """Upserts the latest totals of many sessions in one statement."""
+        with get_db_connection() as db, db.cursor() as cursor:
+            cursor.executemany(
+                """
+                INSERT INTO accounting_sessions
+                    (session_key, user_id, subscription_id, input_octets, output_octets, stopped_at)
+                VALUES (%s, %s, %s, %s, %s, IF(%s, NOW(3), NULL))
+                ON DUPLICATE KEY UPDATE
+                    input_octets = GREATEST(input_octets, VALUES(input_octets)),
+                    output_octets = GREATEST(output_octets, VALUES(output_octets)),
+                    stopped_at = COALESCE(stopped_at, VALUES(stopped_at))
+                """,
+                rows
+            )
+            db.commit()
+
+    def _usage(self, subscription_ids):
+        placeholders = ', '.join(['%s'] * len(subscription_ids))
+        with get_db_connection() as db, db.cursor() as cursor:
+            cursor.execute(SELECT_USAGE.format(ids=placeholders), list(subscription_ids))
+            return {row[0]: int(row[1]) for row in cursor.fetchall()}
+
+    def _save_flags(self, flags):
+        with get_db_connection() as db, db.cursor() as cursor:
+            cursor.executemany(
+                """
+                INSERT IGNORE INTO quota_flags (subscription_id, user_id, reason, usage_octets)
+                VALUES (%s, %s, %s, %s)
+                """,
+                flags
+            )
+            db.commit()
+
+    def flush(self):
+        """Writes the pending sessions and flags what they pushed over quota; returns how many were written."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        try:
+            now = time.monotonic()
+            stale = {entry[0] for entry in pending.values()
+                     if entry[0] not in self._limits or now - self._limits[entry[0]].loaded_at > self.limits_ttl}
+            if stale:
+                loaded, loaded_flags = self._load_limits(stale)
+                self.unknown_users += len(stale) - len(loaded)
+                with self._lock:
+                    self._limits.update(loaded)
+                    self._flagged.update(loaded_flags)
+                    for username in stale - loaded.keys():
+                        self._limits.pop(username, None)
+
+            rows = []
+            quotas = {}
+            for key, (username, input_octets, output_octets, stopped) in pending.items():
+                limit = self._limits.get(username)
+                if limit is None:
+                    continue  # not one of our users
+                rows.append((key, limit.user_id, limit.subscription_id, input_octets, output_octets, stopped))
+                if limit.kind == VOLUME and limit.subscription_id not in self._flagged:
+                    quotas[limit.subscription_id] = limit
+            if rows:
+                self._write(rows)
+        except Exception:
+            # Put them back; anything newer that arrived meanwhile wins
+            with self._lock:
+                for key, entry in pending.items():
+                    current = self._pending.get(key)
+                    if current is None:
+                        self._pending[key] = entry
+                    else:
+                        current[1] = max(current[1], entry[1])
+                        current[2] = max(current[2], entry[2])
+                        current[3] = current[3] or entry[3]
+            raise
+
+        flags = []
+        if quotas:
+            for subscription_id, usage in self._usage(list(quotas)).items():
+                limit = quotas[subscription_id]
+                if usage >= limit.value:
+                    flags.append((subscription_id, limit.user_id, VOLUME, usage))
+        with self._lock:
+            for subscription_id, _, reason, _ in flags:
+                self._flagged[subscription_id] = reason
+            flags.extend(self._new_flags)
+            self._new_flags = []
+        if flags:
+            try:
+                self._save_flags(flags)
+            except Exception:
+                with self._lock:
+                    self._new_flags.extend(flags)  # saved on the next flush; INSERT IGNORE makes that safe
+                raise
+            for _, user_id, reason, usage in flags:
+                flags_total.inc(reason)
+                logger.info("Flagged user %s for exceeding their plan (%s, %d bytes used)", user_id, reason, usage)
+
+        self.flushes += 1
+        self.rows_written += len(rows)
+        return len(rows)
+
+    def prune(self):
+        """Forgets sessions that stopped reporting without a Stop, and users not heard from since."""
+        cutoff = time.monotonic() - self.session_timeout
+        with self._lock:
+            stale = [key for key, sample in self._samples.items() if sample[3] < cutoff]
+            for key in stale:
+                del self._samples[key]
+            # Limits and flags are reloaded when the user reports again
+            self._limits = {name: limit for name, limit in self._limits.items() if limit.loaded_at >= cutoff}
+            active = {limit.subscription_id for limit in self._limits.values()}
+            self._flagged = {sid: reason for sid, reason in self._flagged.items() if sid in active}
+        return len(stale)
+
+    def _run(self):
+        next_prune = time.monotonic() + 60
+        while True:
+            stopping = self._stop.wait(self.flush_interval)
+            started = time.perf_counter()
+            try:
+                self.flush()
+            except Exception as e:
+                self.flush_failures += 1
+                logger.error("Error writing accounting updates: %s", e)
+            self.last_flush_seconds = round(time.perf_counter() - started, 3)
+            if stopping:
+                return
+            if time.monotonic() >= next_prune:
+                next_prune = time.monotonic() + 60
+                self.prune()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending_sessions': len(self._pending),
+                'tracked_sessions': len(self._samples),
+                'known_users': len(self._limits),
+                'flagged_subscriptions': len(self._flagged),
+                'flushes': self.flushes,
+                'rows_written': self.rows_written,
+                'flush_failures': self.flush_failures,
+                'unknown_users': self.unknown_users,
+                'last_flush_seconds': self.last_flush_seconds,
+            }
+
+
+def get_usage_aggregator():
+    """Returns the process-wide aggregator configured from [accounting], starting its flush thread on first use."""
+    global _aggregator
+    if _aggregator is None:
+        with _aggregator_lock:
+            if _aggregator is None:
+                settings = get_section('accounting')
+                aggregator = UsageAggregator(
+                    flush_interval=settings.getfloat('flush_interval', 2),
+                    limits_ttl=settings.getfloat('limits_ttl', 60),
+                    session_timeout=settings.getfloat('session_timeout', 900),
+                    max_pending=settings.getint('max_pending', 200000),
+                    rate_tolerance=settings.getfloat('rate_tolerance', 1.1),
+                    min_rate_interval=settings.getfloat('min_rate_interval', 30),
+                )
+                aggregator.start()
+                atexit.register(aggregator.stop)
+                _aggregator = aggregator
+    return _aggregator
@@ -0,0 +1,135 @@
+import atexit
+import logging
+import threading
+import time
+
+from utils.config import get_section
+from utils.db import get_db_connection
+
+logger = logging.getLogger(__name__)
+
+INSERT_LOGIN_ATTEMPT = "INSERT INTO login_attempts (user_id, email, ip_address, status) VALUES (%s, %s, %s, %s)"
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+class LoginAuditWriter:
+    """Buffers login_attempts rows in memory and writes them in batches.
+
+    A background thread flushes the buffer with one executemany() whenever it
+    holds ``batch_size`` rows or ``flush_interval`` seconds have passed. The
+    buffer never grows past ``max_buffer`` rows: with the ``drop`` policy new
+    rows are discarded (and counted) once it is full, with ``block`` the
+    caller waits up to ``block_timeout`` seconds for the next flush first.
+    """
+
+    def __init__(self, batch_size=100, flush_interval=2.0, max_buffer=10000,
+                 overflow='drop', block_timeout=0.5):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.written = 0
+        self.dropped = 0
+        self._buffer = []
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='login-audit', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10):
+        """Stops the flush thread and writes whatever is still buffered."""
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
+
+    def record(self, user_id, email, ip_address, status):
+        """Buffers one attempt; returns False if it was dropped because the buffer is full."""
+        with self._cond:
+            if len(self._buffer) >= self.max_buffer and self.overflow == 'block':
+                self._cond.notify_all()
+                self._cond.wait_for(lambda: len(self._buffer) < self.max_buffer, self.block_timeout)
+            if len(self._buffer) >= self.max_buffer:
+                self.dropped += 1
+                return False
+            self._buffer.append((user_id, email, ip_address, status))
+            if len(self._buffer) >= self.batch_size:
+                self._cond.notify_all()
+        return True
+
+    def flush(self):
+        with self._flush_lock:
+            with self._cond:
+                rows, self._buffer = self._buffer, []
+                self._cond.notify_all()
+            if not rows:
+                return 0
+            try:
+                with get_db_connection() as db, db.cursor() as cursor:
+                    cursor.executemany(INSERT_LOGIN_ATTEMPT, rows)
+                    db.commit()
+            except Exception as e:
+                self._requeue(rows, e)
+                return 0
+            self.written += len(rows)
+            return len(rows)
+
+    def _requeue(self, rows, error):
+        # Put the failed batch back in front of newer rows, within the buffer bound
+        with self._cond:
+            room = max(0, self.max_buffer - len(self._buffer))
+            kept = rows[-room:] if room else []
+            self._buffer[:0] = kept
+            self.dropped += len(rows) - len(kept)
+        logger.error("Failed to write %d login attempts, %d kept for retry: %s", len(rows), len(kept), error)
+
+    def _run(self):
+        deadline = time.monotonic() + self.flush_interval
+        while not self._stop.is_set():
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._stop.is_set() or len(self._buffer) >= self.batch_size,
+                    max(0.0, deadline - time.monotonic()),
+                )
+            if self._stop.is_set():
+                return
+            self.flush()
+            deadline = time.monotonic() + self.flush_interval
+
+    def stats(self):
+        return {
+            'buffered': len(self._buffer),
+            'written': self.written,
+            'dropped': self.dropped,
+        }
+
+
+def get_audit_writer():
+    """Returns the process-wide writer configured from [audit], starting it on first use."""
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                settings = get_section('audit')
+                writer = LoginAuditWriter(
+                    batch_size=settings.getint('batch_size', 100),
+                    flush_interval=settings.getfloat('flush_interval', 2.0),
+                    max_buffer=settings.getint('max_buffer', 10000),
+                    overflow=settings.get('overflow', 'drop'),
+                    block_timeout=settings.getfloat('block_timeout', 0.5),
+                )
+                writer.start()
+                atexit.register(writer.stop)
+                _writer = writer
+    return _writer
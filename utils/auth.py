@@ -0,0 +1,65 @@
+import hashlib
+import time
+from functools import wraps
+
+import jwt
+from flask import request, jsonify, current_app, g
+
+from utils.cache import TTLCache
+from utils.config import get_section
+from utils.revocation import get_revocation_store
+
+_settings = get_section('cache')
+# Verified claims keyed by the SHA-256 digest of the raw token
+_tokens = TTLCache(maxsize=_settings.getint('token_maxsize', 50000))
+
+
+def decode_token(token):
+    """Verifies an access token and returns its claims.
+
+    A token that verified once is served from the cache until its own ``exp``,
+    so clients that poll with the same token skip the HMAC check and claim
+    parsing. Tokens without an ``exp`` are never cached.
+    """
+    key = hashlib.sha256(token.encode('utf-8')).digest()
+    claims = _tokens.get(key)
+    if claims is not None:
+        return claims
+
+    claims = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=['HS256'])
+    exp = claims.get('exp')
+    if exp is not None:
+        remaining = exp - time.time()
+        if remaining > 0:
+            _tokens.set(key, claims, expires_at=time.monotonic() + remaining)
+    return claims
+
+
+def token_cache_stats():
+    return _tokens.stats()
+
+
+# Utility: JWT token required decorator
+def token_required(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        token = request.headers.get('x-access-token')
+        if not token:
+            return jsonify({'error': 'Token is missing'}), 401
+
+        try:
+            claims = decode_token(token)
+            current_user = claims['username']
+        except jwt.ExpiredSignatureError:
+            return jsonify({'error': 'Token has expired'}), 401
+        except Exception as e:
+            current_app.logger.error("Token error: %s", e)
+            return jsonify({'error': 'Token is invalid'}), 401
+
+        # Checked on every request, cached claims included; answered from memory
+        if get_revocation_store().is_revoked(claims):
+            return jsonify({'error': 'Token has been revoked'}), 401
+
+        g.token_claims = claims
+        return f(current_user, *args, **kwargs)
+    return decorated
@@ -0,0 +1,386 @@
+import csv
+import io
+import logging
+import re
+import secrets
+
+import MySQLdb
+from flask import request
+
+from utils.config import get_section
+from utils.db import get_db_connection
+from utils.passwords import hash_passwords, PasswordPoolBusy
+from utils.revocation import get_revocation_store
+from utils.user_cache import invalidate_user
+
+logger = logging.getLogger(__name__)
+
+_settings = get_section('bulk')
+CHUNK_SIZE = _settings.getint('chunk_size', 500)
+MAX_ROWS = _settings.getint('max_rows', 2000)
+# Each password costs a bcrypt hash (~250ms at 12 rounds) inside the request
+MAX_PASSWORDS = _settings.getint('max_passwords', 100)
+
+EMAIL_PATTERN = re.compile(r"[^@]+@[^@]+\.[^@]+")
+PHONE_PATTERN = re.compile(r"\+?\d{9,15}")
+ROLES = ('user', 'admin')
+STATUSES = ('active', 'inactive', 'blocked')
+# Columns a bulk update may change besides the password
+UPDATABLE = ('email', 'phone_number', 'role', 'status')
+
+
+class BulkResult:
+    """Outcome of a bulk operation; rows are numbered from 1 in the order they were sent."""
+
+    def __init__(self, total):
+        self.total = total
+        self.succeeded = 0
+        self.errors = []
+
+    def fail(self, index, username, error):
+        self.errors.append({'row': index + 1, 'username': username, 'error': error})
+
+    def to_dict(self):
+        return {
+            'processed': self.total,
+            'succeeded': self.succeeded,
+            'failed': len(self.errors),
+            'errors': sorted(self.errors, key=lambda error: error['row']),
+        }
+
+
+def read_rows(field):
+    """Reads the rows of a bulk request.
+
+    Accepts a CSV file (multipart field ``file``, or the body itself with
+    Content-Type text/csv) whose header names the columns, or a JSON body
+    with the rows under ``field``. Raises ValueError if there are no rows,
+    more than MAX_ROWS, or more than MAX_PASSWORDS rows carrying a password:
+    the import runs inside the request, so larger password sets have to be
+    sent in several requests.
+    """
+    upload = request.files.get('file')
+    if upload is not None or request.mimetype == 'text/csv':
+        text = upload.read().decode('utf-8-sig') if upload is not None else request.get_data(as_text=True)
+        rows = [
+            {key.strip().lower(): (value or '').strip() for key, value in row.items() if key}
+            for row in csv.DictReader(io.StringIO(text))
+        ]
+    else:
+        data = request.get_json(silent=True)
+        rows = data.get(field) if isinstance(data, dict) else None
+        if not isinstance(rows, list):
+            raise ValueError(f"Expected a CSV upload or a JSON body with a '{field}' list")
+    if not rows:
+        raise ValueError("No rows to process")
+    if len(rows) > MAX_ROWS:
+        raise ValueError(f"At most {MAX_ROWS} rows can be processed per request")
+    passwords = sum(1 for row in rows if isinstance(row, dict) and str(row.get('password') or '').strip())
+    if passwords > MAX_PASSWORDS:
+        raise ValueError(f"At most {MAX_PASSWORDS} rows with a password can be processed per request")
+    return rows
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _clean(row):
+    """Returns (row with blank values dropped, error or None); a blank CSV cell means "not given"."""
+    if not isinstance(row, dict):
+        return None, "Row must be an object"
+    row = {key: str(value).strip() for key, value in row.items() if value is not None and str(value).strip()}
+    if not row.get('username'):
+        return row, "Username is required"
+    if 'email' in row and not EMAIL_PATTERN.match(row['email']):
+        return row, "Invalid email format"
+    if 'password' in row and len(row['password']) < 8:
+        return row, "Password must be at least 8 characters long"
+    if 'phone_number' in row and not PHONE_PATTERN.fullmatch(row['phone_number']):
+        return row, "Invalid phone number"
+    if row.get('role', 'user') not in ROLES:
+        return row, f"Role must be one of {', '.join(ROLES)}"
+    if row.get('status', 'active') not in STATUSES:
+        return row, f"Status must be one of {', '.join(STATUSES)}"
+    return row, None
+
+
+def _validate(rows, result, check=None):
+    """Cleans rows and drops invalid or repeated ones; returns [(index, row)] for the rest."""
+    valid = []
+    seen = set()
+    for index, raw in enumerate(rows):
+        if isinstance(raw, str):
+            raw = {'username': raw}
+        row, error = _clean(raw)
+        username = (row or {}).get('username')
+        if not error and username.lower() in seen:
+            error = "Username appears more than once"
+        if not error and check:
+            error = check(row)
+        if error:
+            result.fail(index, username, error)
+            continue
+        seen.add(username.lower())
+        valid.append((index, row))
+    return valid
+
+
+def _existing_users(usernames):
+    """Returns {lower-cased username: status} for the users among ``usernames`` that exist."""
+    placeholders = ', '.join(['%s'] * len(usernames))
+    with get_db_connection() as db, db.cursor() as cursor:
+        cursor.execute(f"SELECT username, status FROM users WHERE username IN ({placeholders})", usernames)
+        return {row[0].lower(): row[1] for row in cursor.fetchall()}
+
+
+def _hash_chunk(chunk, result):
+    """Sets password_hash on rows that carry a password, hashing the chunk in parallel.
+
+    If the pool stays saturated the chunk's rows are reported as failed and
+    False is returned, so the rows can be sent again later.
+    """
+    with_password = [row for _, row in chunk if 'password' in row]
+    try:
+        hashes = hash_passwords([row['password'] for row in with_password])
+    except PasswordPoolBusy:
+        for index, row in chunk:
+            result.fail(index, row['username'], "Password hashing is busy, retry this row")
+        return False
+    for row, password_hash in zip(with_password, hashes):
+        row['password_hash'] = password_hash
+    return True
+
+
+def _fail_chunk(chunk, result, error):
+    logger.error("Bulk user chunk rolled back: %s", error)
+    for index, row in chunk:
+        result.fail(index, row['username'], "Database error, row not saved")
+
+
+def set_status(usernames, status, from_status=None):
+    """Sets status on many users, one UPDATE ... IN and one commit per chunk.
+
+    With ``from_status`` only users currently in that status are changed
+    and the others are reported as failed rows, so unblocking never
+    activates an account that has not verified its email. Blocking also
+    revokes every token the users hold.
+    """
+    result = BulkResult(len(usernames))
+    valid = _validate(usernames, result)
+    changed = []
+    for chunk in _chunks(valid, CHUNK_SIZE):
+        names = [row['username'] for _, row in chunk]
+        try:
+            existing = _existing_users(names)
+            found = [name for name in names
+                     if name.lower() in existing and from_status in (None, existing[name.lower()])]
+            if found:
+                placeholders = ', '.join(['%s'] * len(found))
+                query = f"UPDATE users SET status = %s WHERE username IN ({placeholders})"
+                params = [status] + found
+                if from_status:
+                    query += " AND status = %s"
+                    params.append(from_status)
+                with get_db_connection() as db, db.cursor() as cursor:
+                    cursor.execute(query, params)
+                    db.commit()
+        except MySQLdb.Error as e:
+            _fail_chunk(chunk, result, e)
+            continue
+        for index, row in chunk:
+            current = existing.get(row['username'].lower())
+            if current is None:
+                result.fail(index, row['username'], "User not found")
+            elif from_status and current != from_status:
+                result.fail(index, row['username'], f"User is {current}, not {from_status}")
+            else:
+                result.succeeded += 1
+                changed.append(row['username'])
+
+    for username in changed:
+        invalidate_user(username)
+    if status == 'blocked':
+        get_revocation_store().revoke_users(changed)
+    return result
+
+
+def update_users(rows):
+    """Applies per-row changes (email, phone_number, role, status, password) to existing users.
+
+    Each chunk checks which users exist, hashes the new passwords in
+    parallel, then writes the changes with _update_rows. Users whose
+    password changed or who were blocked lose their tokens.
+    """
+    result = BulkResult(len(rows))
+    valid = _validate(rows, result, lambda row: None if set(row) & set(UPDATABLE + ('password',))
+                      else "Nothing to update")
+    changed = []
+    revoke = []
+    for chunk in _chunks(valid, CHUNK_SIZE):
+        try:
+            existing = _existing_users([row['username'] for _, row in chunk])
+        except MySQLdb.Error as e:
+            _fail_chunk(chunk, result, e)
+            continue
+        found = []
+        for index, row in chunk:
+            if row['username'].lower() in existing:
+                found.append((index, row))
+            else:
+                result.fail(index, row['username'], "User not found")
+        if not found or not _hash_chunk(found, result):
+            continue
+
+        try:
+            failed = _update_rows([row for _, row in found])
+        except MySQLdb.Error as e:
+            _fail_chunk(found, result, e)
+            continue
+        for index, row in found:
+            if row['username'] in failed:
+                result.fail(index, row['username'], failed[row['username']])
+                continue
+            result.succeeded += 1
+            changed.append(row['username'])
+            if 'password_hash' in row or row.get('status') == 'blocked':
+                revoke.append(row['username'])
+
+    for username in changed:
+        invalidate_user(username)
+    get_revocation_store().revoke_users(revoke)
+    return result
+
+
+def _update_rows(rows):
+    """Updates rows in one transaction: one executemany per set of changed columns, or row by row if one clashes.
+
+    Returns {username: error} for the rows that could not be updated, e.g.
+    an email or phone number already taken by another user.
+    """
+    groups = {}
+    for row in rows:
+        columns = tuple(column for column in UPDATABLE + ('password_hash',) if column in row)
+        groups.setdefault(columns, []).append(row)
+    statements = []
+    for columns, group in groups.items():
+        assignments = ', '.join(f"{column} = %s" for column in columns)
+        statements.append((f"UPDATE users SET {assignments} WHERE username = %s",
+                           [[row[column] for column in columns] + [row['username']] for row in group]))
+    with get_db_connection() as db, db.cursor() as cursor:
+        try:
+            db.begin()
+            for query, values in statements:
+                cursor.executemany(query, values)
+            db.commit()
+            return {}
+        except MySQLdb.IntegrityError:
+            db.rollback()
+
+        # One of the rows takes a unique value another user already has
+        failed = {}
+        db.begin()
+        for query, values in statements:
+            for value in values:
+                try:
+                    cursor.execute(query, value)
+                except MySQLdb.IntegrityError as e:
+                    failed[value[-1]] = f"Conflicts with another user ({e.args[-1]})"
+        db.commit()
+        return failed
+
+
+def _insert_rows(rows):
+    """Inserts rows in one transaction: a single multi-row INSERT, or row by row if one of them clashes.
+
+    Returns {username: error} for the rows that could not be inserted.
+    """
+    query = ("INSERT INTO users (username, email, password_hash, phone_number, status, role) "
+             "VALUES (%s, %s, %s, %s, %s, %s)")
+    values = [(row['username'], row['email'], row['password_hash'], row.get('phone_number'),
+               row.get('status', 'active'), row.get('role', 'user')) for row in rows]
+    with get_db_connection() as db, db.cursor() as cursor:
+        try:
+            db.begin()
+            cursor.executemany(query, values)
+            db.commit()
+            return {}
+        except MySQLdb.IntegrityError:
+            db.rollback()
+
+        # Another request created one of these users since the duplicate check
+        failed = {}
+        db.begin()
+        for value in values:
+            try:
+                cursor.execute(query, value)
+            except MySQLdb.IntegrityError as e:
+                failed[value[0]] = f"Already exists ({e.args[-1]})"
+        db.commit()
+        return failed
+
+
+def import_users(rows):
+    """Creates users from rows of username, email and optionally password, phone_number, role, status.
+
+    Rows clashing with an existing username or email are reported, not
+    inserted. A row without a password gets an unusable hash, so that user
+    signs in through the password reset flow.
+    """
+    result = BulkResult(len(rows))
+    seen_emails = set()
+
+    def check(row):
+        if 'email' not in row:
+            return "Email is required"
+        if row['email'].lower() in seen_emails:
+            return "Email appears more than once"
+        seen_emails.add(row['email'].lower())
+        return None
+
+    valid = _validate(rows, result, check)
+    for chunk in _chunks(valid, CHUNK_SIZE):
+        usernames = [row['username'] for _, row in chunk]
+        emails = [row['email'] for _, row in chunk]
+        try:
+            with get_db_connection() as db, db.cursor() as cursor:
+                cursor.execute(
+                    f"""
+                    SELECT username, email FROM users
+                    WHERE username IN ({', '.join(['%s'] * len(usernames))})
+                    OR email IN ({', '.join(['%s'] * len(emails))})
+                    """,
+                    usernames + emails
+                )
+                taken = cursor.fetchall()
+        except MySQLdb.Error as e:
+            _fail_chunk(chunk, result, e)
+            continue
+        taken_usernames = {row[0].lower() for row in taken}
+        taken_emails = {row[1].lower() for row in taken if row[1]}
+
+        fresh = []
+        for index, row in chunk:
+            if row['username'].lower() in taken_usernames:
+                result.fail(index, row['username'], "Username already exists")
+            elif row['email'].lower() in taken_emails:
+                result.fail(index, row['username'], "Email already exists")
+            else:
+                fresh.append((index, row))
+        if not fresh or not _hash_chunk(fresh, result):
+            continue
+        for _, row in fresh:
+            row.setdefault('password_hash', '!' + secrets.token_hex(16))
+
+        try:
+            failed = _insert_rows([row for _, row in fresh])
+        except MySQLdb.Error as e:
+            _fail_chunk(fresh, result, e)
+            continue
+        for index, row in fresh:
+            if row['username'] in failed:
+                result.fail(index, row['username'], failed[row['username']])
+            else:
+                result.succeeded += 1
+    return result
@@ -0,0 +1,56 @@
+import configparser
+import os
+import threading
+
+# WIMAN_CONFIG points at an alternative file (benchmarks, staging)
+CONFIG_FILE = os.getenv('WIMAN_CONFIG', 'config.ini')
+
+_config = None
+_lock = threading.Lock()
+
+
+def get_config():
+    """Returns config.ini parsed once per process."""
+    global _config
+    if _config is None:
+        with _lock:
+            if _config is None:
+                config = configparser.ConfigParser()
+                config.read(CONFIG_FILE)
+                _config = config
+    return _config
+
+
+def load_config(path=None, overrides=None):
+    """Replaces the process config with ``path`` (config.ini by default) plus ``overrides``.
+
+    overrides maps section names to {key: value}. Modules that read settings
+    when they are imported only see the new values if they are imported
+    afterwards, which is why create_app() calls this before loading the
+    blueprints.
+    """
+    global _config
+    config = configparser.ConfigParser()
+    config.read(path or CONFIG_FILE)
+    for section, values in (overrides or {}).items():
+        if not config.has_section(section):
+            config.add_section(section)
+        config[section].update({key: str(value) for key, value in values.items()})
+    with _lock:
+        _config = config
+    return config
+
+
+def request_threads():
+    """Request threads per worker process, as gunicorn.conf.py sets them from WIMAN_THREADS."""
+    return int(os.getenv('WIMAN_THREADS', 8))
+
+
+def get_section(name):
+    """Returns a config section; missing sections come back empty so callers can rely on fallbacks."""
+    config = get_config()
+    if config.has_section(name):
+        return config[name]
+    empty = configparser.ConfigParser()
+    empty.add_section(name)
+    return empty[name]
@@ -0,0 +1,174 @@
+import base64
+import datetime
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from utils.config import get_section
+from utils.metrics import observe_outbound
+
+BASE_URLS = {
+    'sandbox': "https://sandbox.safaricom.co.ke",
+    'production': "https://api.safaricom.co.ke",
+}
+
+_client = None
+_client_lock = threading.Lock()
+
+
+class DarajaError(Exception):
+    """Raised when Safaricom's Daraja API cannot be reached or rejects a call."""
+
+
+class DarajaClient:
+    """Client for the Daraja (M-Pesa) API.
+
+    The OAuth access token is cached until ``token_refresh_margin`` seconds
+    before it expires. Refreshes are single-flight: when it runs out, one
+    caller fetches a new token while concurrent callers wait for it instead of
+    each hitting the OAuth endpoint. All calls go through one pooled
+    keep-alive requests.Session with explicit connect/read timeouts.
+    """
+
+    def __init__(self, consumer_key, consumer_secret, shortcode, passkey, callback_url,
+                 base_url=BASE_URLS['sandbox'], connect_timeout=3.05, read_timeout=15,
+                 pool_size=10, token_refresh_margin=60):
+        self.consumer_key = consumer_key
+        self.consumer_secret = consumer_secret
+        self.shortcode = shortcode
+        self.passkey = passkey
+        self.callback_url = callback_url
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.token_refresh_margin = token_refresh_margin
+        self.token_fetches = 0
+        self._token = None
+        self._token_expires_at = 0.0
+        self._token_lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def access_token(self):
+        token = self._token
+        if token and time.monotonic() < self._token_expires_at:
+            return token
+        with self._token_lock:
+            # Another thread may have refreshed it while we waited for the lock
+            if self._token and time.monotonic() < self._token_expires_at:
+                return self._token
+            return self._fetch_token()
+
+    def invalidate_token(self):
+        with self._token_lock:
+            self._token = None
+            self._token_expires_at = 0.0
+
+    def _fetch_token(self):
+        try:
+            with observe_outbound('daraja', '/oauth/v1/generate'):
+                response = self.session.get(
+                    f"{self.base_url}/oauth/v1/generate",
+                    params={'grant_type': 'client_credentials'},
+                    auth=(self.consumer_key, self.consumer_secret),
+                    timeout=self.timeout,
+                )
+        except requests.RequestException as e:
+            raise DarajaError(f"OAuth request failed: {e}") from e
+        if response.status_code != 200:
+            raise DarajaError(f"OAuth request failed with HTTP {response.status_code}")
+
+        try:
+            data = response.json()
+            token = data.get('access_token') if isinstance(data, dict) else None
+            if not token:
+                raise DarajaError("OAuth response did not include an access token")
+            expires_in = float(data.get('expires_in', 3599))
+        except (ValueError, TypeError) as e:
+            # An HTML error page or an empty body from a proxy in front of Daraja
+            raise DarajaError(f"Invalid OAuth response (HTTP {response.status_code})") from e
+        self._token = token
+        self._token_expires_at = time.monotonic() + max(0.0, expires_in - self.token_refresh_margin)
+        self.token_fetches += 1
+        return self._token
+
+    def post(self, path, payload):
+        """POSTs a JSON payload with the bearer token, refreshing it once if Daraja rejects it."""
+        for attempt in range(2):
+            headers = {"Authorization": f"Bearer {self.access_token()}"}
+            try:
+                with observe_outbound('daraja', path):
+                    response = self.session.post(f"{self.base_url}{path}", json=payload,
+                                                 headers=headers, timeout=self.timeout)
+            except requests.RequestException as e:
+                raise DarajaError(f"Request to {path} failed: {e}") from e
+            if response.status_code == 401 and attempt == 0:
+                self.invalidate_token()
+                continue
+            try:
+                data = response.json()
+            except ValueError as e:
+                raise DarajaError(f"Invalid response from {path} (HTTP {response.status_code})") from e
+            if not isinstance(data, dict):
+                raise DarajaError(f"Invalid response from {path} (HTTP {response.status_code})")
+            return data
+
+    def password(self, timestamp):
+        return base64.b64encode(f"{self.shortcode}{self.passkey}{timestamp}".encode()).decode()
+
+    def stk_push(self, phone_number, amount, account_reference="WIMAN",
+                 description="Wi-Fi Subscription Payment"):
+        timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+        payload = {
+            "BusinessShortCode": self.shortcode,
+            "Password": self.password(timestamp),
+            "Timestamp": timestamp,
+            "TransactionType": "CustomerPayBillOnline",
+            "Amount": amount,
+            "PartyA": phone_number,
+            "PartyB": self.shortcode,
+            "PhoneNumber": phone_number,
+            "CallBackURL": self.callback_url,
+            "AccountReference": account_reference,
+            "TransactionDesc": description
+        }
+        return self.post("/mpesa/stkpush/v1/processrequest", payload)
+
+    def stk_query(self, checkout_request_id):
+        """Asks for the outcome of an STK push; a push still awaiting the customer answers with an errorCode."""
+        timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+        payload = {
+            "BusinessShortCode": self.shortcode,
+            "Password": self.password(timestamp),
+            "Timestamp": timestamp,
+            "CheckoutRequestID": checkout_request_id,
+        }
+        return self.post("/mpesa/stkpushquery/v1/query", payload)
+
+
+def get_daraja_client():
+    """Returns the process-wide client built from MPESA_* environment variables and [daraja]."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                settings = get_section('daraja')
+                environment = os.getenv("MPESA_ENV", "sandbox").split('#')[0].strip()
+                _client = DarajaClient(
+                    consumer_key=os.getenv("MPESA_CONSUMER_KEY"),
+                    consumer_secret=os.getenv("MPESA_CONSUMER_SECRET"),
+                    shortcode=os.getenv("MPESA_SHORTCODE"),
+                    passkey=os.getenv("MPESA_PASSKEY"),
+                    callback_url=os.getenv("MPESA_CALLBACK_URL"),
+                    base_url=os.getenv("MPESA_BASE_URL") or BASE_URLS.get(environment, BASE_URLS['sandbox']),
+                    connect_timeout=settings.getfloat('connect_timeout', 3.05),
+                    read_timeout=settings.getfloat('read_timeout', 15),
+                    pool_size=settings.getint('pool_size', 10),
+                    token_refresh_margin=settings.getfloat('token_refresh_margin', 60),
+                )
+    return _client
@@ -1,23 +1,306 @@
-import configparser
+import logging
+import os
+import threading
+import time
+from collections import deque
+
 import MySQLdb
+from flask import g, has_app_context
+
+from utils.config import get_config
+from utils.metrics import db_checkout_wait, record_query
 
 REQUIRED_KEYS = ['host', 'user', 'password', 'database', 'autocommit']
 
-def get_db_connection():
-    config = configparser.ConfigParser()
-    config.read('config.ini')
-    db_config = config['database']
-    
-    missing_keys = [key for key in REQUIRED_KEYS if key not in db_config]
-    if missing_keys:
-        raise ValueError(f"Missing configuration keys: {', '.join(missing_keys)}")
-    
-    autocommit = db_config.getboolean('autocommit', True)
-    
+# Pool defaults, overridable from the [database] section of config.ini
+DEFAULT_POOL_SIZE = 10
+DEFAULT_POOL_TIMEOUT = 5      # seconds to wait for a free connection
+DEFAULT_POOL_RECYCLE = 300    # seconds a connection may sit idle before it is replaced
+
+logger = logging.getLogger(__name__)
+
+_db_config = None
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class PoolTimeoutError(Exception):
+    """Raised when no pooled connection becomes free within pool_timeout."""
+
+
+def load_db_config():
+    """Validates the [database] section once and caches the result for the process."""
+    global _db_config
+    if _db_config is None:
+        db_config = get_config()['database']
+
+        missing_keys = [key for key in REQUIRED_KEYS if key not in db_config]
+        if missing_keys:
+            raise ValueError(f"Missing configuration keys: {', '.join(missing_keys)}")
+
+        _db_config = {
+            'host': db_config['host'],
+            'port': db_config.getint('port', 3306),
+            'user': db_config['user'],
+            'password': db_config['password'],
+            'database': db_config['database'],
+            'autocommit': db_config.getboolean('autocommit', True),
+            'pool_size': db_config.getint('pool_size', DEFAULT_POOL_SIZE),
+            'pool_timeout': db_config.getfloat('pool_timeout', DEFAULT_POOL_TIMEOUT),
+            'pool_recycle': db_config.getfloat('pool_recycle', DEFAULT_POOL_RECYCLE),
+        }
+    return _db_config
+
+
+def _connect(db_config):
     return MySQLdb.connect(
         host=db_config['host'],
+        port=db_config['port'],
         user=db_config['user'],
         password=db_config['password'],
         database=db_config['database'],
-        autocommit=autocommit
+        autocommit=db_config['autocommit']
     )
+
+
+class TimedCursor:
+    """Cursor proxy that reports the duration of every statement to utils.metrics."""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._cursor.close()
+
+    def _timed(self, method, *args):
+        started = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            record_query(time.perf_counter() - started)
+
+    def execute(self, query, args=None):
+        return self._timed(self._cursor.execute, query, args)
+
+    def executemany(self, query, args):
+        return self._timed(self._cursor.executemany, query, args)
+
+    def callproc(self, procname, args=()):
+        return self._timed(self._cursor.callproc, procname, args)
+
+
+class PooledConnection:
+    """Proxy around a raw MySQLdb connection checked out of a ConnectionPool.
+
+    It behaves like the connection itself (cursor, commit, rollback, ...), but
+    close() and leaving a ``with`` block hand the connection back to the pool
+    instead of tearing down the socket.
+    """
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._raw = raw
+
+    def __getattr__(self, name):
+        if self._raw is None:
+            raise MySQLdb.InterfaceError("Connection has been returned to the pool")
+        return getattr(self._raw, name)
+
+    def __enter__(self):
+        return self
+
+    def cursor(self, *args, **kwargs):
+        return TimedCursor(self.__getattr__('cursor')(*args, **kwargs))
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self._rollback_quietly()
+        self.close()
+
+    def _rollback_quietly(self):
+        try:
+            self._raw.rollback()
+        except MySQLdb.Error:
+            pass
+
+    def close(self):
+        raw, self._raw = self._raw, None
+        if raw is not None:
+            self._pool.release(raw)
+
+
+class RequestConnection(PooledConnection):
+    """Connection shared by every decorator and handler of one Flask request.
+
+    ``with get_db_connection() as db`` blocks inside a request reuse it, so
+    leaving the block (or calling close()) keeps it checked out; the teardown
+    handler registered by init_db returns it to the pool once the request ends.
+    """
+
+    def close(self):
+        pass
+
+    def release(self):
+        PooledConnection.close(self)
+
+
+class ConnectionPool:
+    """Bounded pool of MySQLdb connections.
+
+    Idle connections are kept LIFO so the warmest socket is reused first, are
+    pinged on checkout and are replaced once they have been idle longer than
+    ``recycle`` seconds.
+    """
+
+    def __init__(self, db_config, size=DEFAULT_POOL_SIZE, timeout=DEFAULT_POOL_TIMEOUT,
+                 recycle=DEFAULT_POOL_RECYCLE, connect=_connect):
+        self.db_config = db_config
+        self.size = size
+        self.timeout = timeout
+        self.recycle = recycle
+        self._connect = connect
+        self._idle = deque()  # (raw connection, returned_at)
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        started = time.perf_counter()
+        acquired = self._slots.acquire(timeout=self.timeout)
+        db_checkout_wait.observe(time.perf_counter() - started)
+        if not acquired:
+            raise PoolTimeoutError(f"No database connection available within {self.timeout}s")
+        try:
+            return self._checkout()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                raw, returned_at = self._idle.pop()
+
+            if time.monotonic() - returned_at > self.recycle:
+                self._discard(raw)
+                continue
+            try:
+                raw.ping()
+                return raw
+            except MySQLdb.Error as e:
+                logger.warning("Discarding dead pooled connection: %s", e)
+                self._discard(raw)
+
+        return self._connect(self.db_config)
+
+    def release(self, raw):
+        try:
+            if not self.db_config['autocommit']:
+                raw.rollback()
+            with self._lock:
+                self._idle.append((raw, time.monotonic()))
+        except MySQLdb.Error as e:
+            logger.warning("Dropping connection that failed on release: %s", e)
+            self._discard(raw)
+        finally:
+            self._slots.release()
+
+    def _discard(self, raw):
+        try:
+            raw.close()
+        except MySQLdb.Error:
+            pass
+
+    def close_idle(self):
+        """Closes every idle connection (used on shutdown and in tests)."""
+        with self._lock:
+            idle, self._idle = self._idle, deque()
+        for raw, _ in idle:
+            self._discard(raw)
+
+
+def get_pool():
+    """Returns the process-wide pool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                db_config = load_db_config()
+                _pool = ConnectionPool(
+                    db_config,
+                    size=db_config['pool_size'],
+                    timeout=db_config['pool_timeout'],
+                    recycle=db_config['pool_recycle'],
+                )
+    return _pool
+
+
+def get_db_connection():
+    """Returns a pooled connection.
+
+    Inside a Flask app context the same connection is handed out for the whole
+    request and released by close_db; elsewhere (scheduler jobs, scripts) the
+    caller owns it until it calls close() or leaves its ``with`` block.
+    """
+    if has_app_context():
+        if 'db' not in g:
+            g.db = RequestConnection(get_pool(), get_pool().acquire())
+        return g.db
+    return get_pooled_connection()
+
+
+def get_pooled_connection():
+    """Checks out a connection owned by the caller, even inside a request.
+
+    Needed by code that must hand the connection back before the request
+    ends; release it with close() or a ``with`` block.
+    """
+    return PooledConnection(get_pool(), get_pool().acquire())
+
+
+def open_connection():
+    """Opens a dedicated connection outside the pool.
+
+    For session-scoped state the pool must not hand to anyone else, such as
+    the scheduler's GET_LOCK, and for scripts; the caller closes it.
+    """
+    return _connect(load_db_config())
+
+
+def close_db(exception=None):
+    db = g.pop('db', None)
+    if db is not None:
+        if exception is not None:
+            db._rollback_quietly()
+        db.release()
+
+
+def _forget_pool_after_fork():
+    """Gives a forked worker its own pool instead of the parent's sockets.
+
+    The inherited connections are kept referenced, not closed: closing them
+    would end the parent's MySQL sessions on the shared sockets.
+    """
+    global _pool, _pool_lock
+    if _pool is not None:
+        _inherited_pools.append(_pool)
+    _pool = None
+    _pool_lock = threading.Lock()
+
+
+_inherited_pools = []
+os.register_at_fork(after_in_child=_forget_pool_after_fork)
+
+
+def init_db(app):
+    app.teardown_appcontext(close_db)
@@ -0,0 +1,111 @@
+import threading
+import time
+from collections import OrderedDict
+
+from utils.config import get_section
+from utils.db import get_db_connection
+
+# A user's latest subscription, with the seconds left measured on the database clock
+SELECT_LATEST_SUBSCRIPTION = """
+    SELECT status, TIMESTAMPDIFF(MICROSECOND, NOW(), expires_at) / 1000000
+    FROM subscriptions
+    WHERE user_id = %s
+    ORDER BY expires_at DESC
+    LIMIT 1
+"""
+
+_index = None
+_index_lock = threading.Lock()
+
+
+class EntitlementIndex:
+    """In-memory user_id -> (status, expires_at) index behind the access check.
+
+    is_entitled() answers from memory; a user is loaded from MySQL only the
+    first time they are checked or once their entry is older than
+    ``max_staleness`` seconds, which bounds how long a change made by another
+    worker can go unseen. Changes made in this process (subscribe, payments,
+    expiry) update or drop the entry straight away. expires_at is kept as a
+    time.time() timestamp computed against the database clock.
+    """
+
+    def __init__(self, max_staleness=30, maxsize=100000):
+        self.max_staleness = max_staleness
+        self.maxsize = maxsize
+        self.hits = 0
+        self.loads = 0
+        self._entries = OrderedDict()  # user_id -> (status, expires_at, loaded_at)
+        self._lock = threading.Lock()
+
+    def is_entitled(self, user_id):
+        status, expires_at = self.get(user_id)
+        return status == 'active' and expires_at is not None and expires_at > time.time()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and time.monotonic() - entry[2] <= self.max_staleness:
+                self.hits += 1
+                return entry[0], entry[1]
+        return self.load(user_id)
+
+    def load(self, user_id):
+        """Reads the user's latest subscription from MySQL and stores it."""
+        with get_db_connection() as db, db.cursor() as cursor:
+            cursor.execute(SELECT_LATEST_SUBSCRIPTION, (user_id,))
+            row = cursor.fetchone()
+        self.loads += 1
+        if row is None or row[1] is None:
+            status, expires_at = (row[0] if row else None), None
+        else:
+            status, expires_at = row[0], time.time() + float(row[1])
+        self._store(user_id, status, expires_at)
+        return status, expires_at
+
+    def record_subscription(self, user_id, expires_at, status='active'):
+        """Applies a subscription written by this process, keeping the later expiry."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+        if entry is not None and entry[0] == 'active' and entry[1] is not None and entry[1] > expires_at:
+            return
+        self._store(user_id, status, expires_at)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def _store(self, user_id, status, expires_at):
+        with self._lock:
+            self._entries[user_id] = (status, expires_at, time.monotonic())
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            ages = [now - entry[2] for entry in self._entries.values()]
+            hits, loads = self.hits, self.loads
+        return {
+            'size': len(ages),
+            'maxsize': self.maxsize,
+            'max_staleness_seconds': self.max_staleness,
+            'oldest_entry_age_seconds': round(max(ages), 3) if ages else 0,
+            'mean_entry_age_seconds': round(sum(ages) / len(ages), 3) if ages else 0,
+            'hits': hits,
+            'loads': loads,
+        }
+
+
+def get_entitlement_index():
+    """Returns the process-wide index configured from [entitlements]."""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                settings = get_section('entitlements')
+                _index = EntitlementIndex(
+                    max_staleness=settings.getfloat('max_staleness', 30),
+                    maxsize=settings.getint('maxsize', 100000),
+                )
+    return _index
@@ -0,0 +1,254 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from utils.config import get_section
+
+# Attributes every LogRecord has; anything else was passed with ``extra=`` and goes into the JSON line
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_ROTATION_INTERVALS = {'S': 1, 'M': 60, 'H': 3600, 'D': 86400, 'MIDNIGHT': 86400}
+
+_listener = None
+_configure_lock = threading.Lock()
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, msg, plus any ``extra`` fields and the traceback."""
+
+    def format(self, record):
+        entry = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'thread': record.threadName,
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class SizedTimedRotatingFileHandler(RotatingFileHandler):
+    """Rotates when the file passes ``max_bytes`` or when ``when`` has elapsed, whichever comes first.
+
+    Backups are numbered like RotatingFileHandler's (wiman.log.1, .2, ...)
+    so ``backup_count`` bounds disk use under both triggers.
+    """
+
+    def __init__(self, filename, max_bytes, backup_count, when='MIDNIGHT', encoding='utf-8'):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding=encoding)
+        self.when = when.upper()
+        self.interval = _ROTATION_INTERVALS[self.when]
+        self.rollover_at = self._next_rollover(time.time())
+
+    def _next_rollover(self, now):
+        if self.when == 'MIDNIGHT':
+            local = time.localtime(now)
+            seconds_today = local.tm_hour * 3600 + local.tm_min * 60 + local.tm_sec
+            return now - seconds_today + self.interval
+        return now + self.interval
+
+    def shouldRollover(self, record):
+        if time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = self._next_rollover(time.time())
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps one in ``rate`` records per (logger, message template) for noisy loggers.
+
+    ``rates`` maps a logger name prefix to N. Warnings and above are never
+    sampled out. Because calls use %-style arguments the template is stable
+    across calls, so e.g. every "Email %r sent to %s" line shares one counter.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self.dropped = 0
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def _rate(self, name):
+        while name:
+            if name in self.rates:
+                return self.rates[name]
+            name = name.rpartition('.')[0]
+        return 1
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self._rate(record.name)
+        if rate <= 1:
+            return True
+        key = (record.name, record.msg)
+        with self._lock:
+            seen = self._seen.get(key, 0)
+            self._seen[key] = seen + 1
+            if seen % rate == 0:
+                return True
+            self.dropped += 1
+            return False
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """QueueHandler that never blocks the calling thread and defers formatting to the writer.
+
+    The stock prepare() formats the message on the caller's thread so the
+    record can be pickled; here the queue never leaves the process, so the
+    record is queued as is. When the queue is full the record is dropped and
+    counted rather than stalling the request.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _parse_pairs(value):
+    """Parses "name:value, name:value" into a dict."""
+    pairs = {}
+    for item in value.split(','):
+        if ':' in item:
+            name, _, setting = item.strip().rpartition(':')
+            pairs[name.strip()] = setting.strip()
+    return pairs
+
+
+def configure_logging():
+    """Installs the queue-based logging pipeline configured from [logging]; safe to call more than once.
+
+    Every logger writes into a bounded in-memory queue; a QueueListener
+    thread formats the records and writes them to the rotating file and to
+    stdout, so request threads never touch the disk. Processes forked from
+    this one (gunicorn workers under preload_app) log to stdout only.
+
+    Only the first call reads [logging]; later calls, including a second
+    create_app() with different settings, return the running listener.
+    """
+    global _listener
+    with _configure_lock:
+        if _listener is not None:
+            return _listener
+
+        settings = get_section('logging')
+        log_file = settings.get('file', 'logs/wiman.log')
+        log_dir = os.path.dirname(log_file)
+        if log_dir and not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+
+        if settings.get('format', 'json') == 'json':
+            formatter = JsonFormatter()
+        else:
+            formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(name)s - %(message)s")
+
+        handlers = [SizedTimedRotatingFileHandler(
+            log_file,
+            max_bytes=settings.getint('max_bytes', 10 * 1024 * 1024),
+            backup_count=settings.getint('backup_count', 7),
+            when=settings.get('rotate_when', 'midnight'),
+        )]
+        if settings.getboolean('console', True):
+            handlers.append(logging.StreamHandler(sys.stdout))
+        for handler in handlers:
+            handler.setFormatter(formatter)
+
+        queue_handler = NonBlockingQueueHandler(queue.Queue(settings.getint('queue_size', 10000)))
+        rates = {name: int(rate) for name, rate in _parse_pairs(settings.get('sample', '')).items()}
+        if rates:
+            queue_handler.addFilter(SamplingFilter(rates))
+
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        root.addHandler(queue_handler)
+        root.setLevel(settings.get('level', 'INFO').upper())
+        for name, level in _parse_pairs(settings.get('levels', '')).items():
+            logging.getLogger(name).setLevel(level.upper())
+
+        _listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(stop_logging)
+        return _listener
+
+
+def _worker_handlers(handlers):
+    """The handlers a forked worker writes to: the parent's, minus the rotating log file.
+
+    Every worker would inherit the same SizedTimedRotatingFileHandler and
+    roll wiman.log over on its own schedule, renaming the file under the
+    others and losing or interleaving lines. Workers log to stdout instead,
+    which gunicorn's workers share with the master; the master keeps the
+    file for its own records.
+    """
+    kept = [handler for handler in handlers if not isinstance(handler, RotatingFileHandler)]
+    if len(kept) == len(handlers):
+        return kept
+    for handler in handlers:
+        if isinstance(handler, RotatingFileHandler):
+            # Closes only this process's copy of the descriptor
+            handler.close()
+    if not any(isinstance(handler, logging.StreamHandler) and handler.stream is sys.stdout for handler in kept):
+        console = logging.StreamHandler(sys.stdout)
+        console.setFormatter(handlers[0].formatter)
+        kept.append(console)
+    return kept
+
+
+def _restart_after_fork():
+    """Starts a writer thread in a forked worker; the parent's thread does not survive the fork.
+
+    The worker gets a fresh queue too, since the inherited one may have been
+    locked by the parent's writer at the moment of the fork, and writes to
+    stdout rather than the shared log file (see _worker_handlers).
+    """
+    global _listener, _configure_lock
+    _configure_lock = threading.Lock()
+    if _listener is None:
+        return
+    fresh = queue.Queue(_listener.queue.maxsize)
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, NonBlockingQueueHandler):
+            handler.queue = fresh
+    _listener = QueueListener(fresh, *_worker_handlers(_listener.handlers), respect_handler_level=True)
+    _listener.start()
+
+
+os.register_at_fork(after_in_child=_restart_after_fork)
+
+
+def stop_logging():
+    """Flushes whatever is still queued and stops the writer thread."""
+    global _listener
+    with _configure_lock:
+        listener, _listener = _listener, None
+    if listener is not None:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
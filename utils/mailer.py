@@ -0,0 +1,392 @@
+import atexit
+import heapq
+import json
+import logging
+import os
+import queue
+import smtplib
+import threading
+import time
+import uuid
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+try:
+    import fcntl
+except ImportError:  # Windows: the dev server runs a single process
+    fcntl = None
+
+from utils.config import get_section
+from utils.metrics import observe_outbound
+
+logger = logging.getLogger(__name__)
+
+# A connection idle for longer than this is checked with NOOP before reuse
+NOOP_AFTER_IDLE = 5
+
+_mailer = None
+_mailer_lock = threading.Lock()
+
+
+class Mailer:
+    """Background SMTP dispatcher with a durable on-disk spool.
+
+    enqueue() only writes the message to the spool and returns; a single
+    daemon thread drains the queue in batches over one authenticated SMTP
+    connection that is kept open between batches and re-established when the
+    server drops it. Transient failures are retried with exponential backoff,
+    permanent ones are moved to ``<spool_dir>/failed``.
+
+    The spool is laid out like a maildir so several worker processes can share
+    it: ``tmp/`` holds partial writes, ``new/`` unclaimed messages and
+    ``cur/<owner>-<name>`` messages claimed by a running mailer. Each mailer
+    holds an exclusive lock on ``locks/<owner>.lock`` for as long as it runs;
+    the kernel drops the lock when its process dies, however it dies, so a
+    lock that can be taken means its owner is gone. Messages left in ``cur/``
+    by such an owner are picked up when a Mailer is created and again every
+    ``recover_interval`` seconds, so surviving workers resend the mail of one
+    that crashed without waiting for a restart.
+    """
+
+    def __init__(self, host, port, sender, username=None, password=None, use_tls=True,
+                 timeout=10, spool_dir='spool/mail', batch_size=20, max_retries=5,
+                 retry_backoff=2.0, idle_timeout=30, recover_interval=60):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.timeout = timeout
+        self.spool_dir = spool_dir
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.idle_timeout = idle_timeout
+        self.recover_interval = recover_interval
+        self.sent = 0
+        self.failed = 0
+        self._queue = queue.Queue()
+        self._retries = []  # heap of (ready_at, path)
+        self._smtp = None
+        self._last_used = 0.0
+        self._connect_failures = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._recovered_at = 0.0
+        for name in ('tmp', 'new', 'cur', 'failed', 'locks'):
+            os.makedirs(os.path.join(spool_dir, name), exist_ok=True)
+        # The owner id is never reused, unlike a pid after a restart
+        self.owner = f"{os.getpid()}.{uuid.uuid4().hex[:12]}"
+        self._owner_lock = self._lock_owner(self.owner, blocking=True)
+        self._recover_spool()
+
+    # -- public API ---------------------------------------------------------
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='mailer', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        """Stops after the batch in flight; anything still queued stays in the spool.
+
+        The owner lock is released too, so other processes resend what is left.
+        """
+        self._stop.set()
+        self._queue.put(None)
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self._disconnect()
+        lock, self._owner_lock = self._owner_lock, None
+        if lock is not None:
+            lock.close()
+
+    def enqueue(self, to, subject, body):
+        message = {'to': to, 'subject': subject, 'body': body, 'attempts': 0}
+        name = f"{time.time_ns()}-{uuid.uuid4().hex}.json"
+        tmp_path = os.path.join(self.spool_dir, 'tmp', name)
+        path = self._claimed_path(name)
+        self._write(tmp_path, message)
+        os.replace(tmp_path, path)
+        self._queue.put(path)
+        return name
+
+    def pending(self):
+        return self._queue.qsize() + len(self._retries)
+
+    # -- spool --------------------------------------------------------------
+
+    def _claimed_path(self, name):
+        return os.path.join(self.spool_dir, 'cur', f"{self.owner}-{name}")
+
+    def _lock_path(self, owner):
+        return os.path.join(self.spool_dir, 'locks', f"{owner}.lock")
+
+    def _lock_owner(self, owner, blocking=False):
+        """Locks ``owner``'s lock file; returns the open file, or None if another process holds it."""
+        lock = open(self._lock_path(owner), 'a')
+        if fcntl is None:
+            return lock
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            return None
+        return lock
+
+    def _owner_gone(self, owner):
+        if owner == self.owner:
+            return False
+        if not os.path.exists(self._lock_path(owner)):
+            return True  # claimed before lock files existed, or already recovered
+        if fcntl is None:
+            return True  # without flock only one process uses the spool
+        lock = self._lock_owner(owner)
+        if lock is None:
+            return False
+        with lock:
+            try:
+                os.remove(self._lock_path(owner))
+            except FileNotFoundError:
+                pass
+        return True
+
+    @staticmethod
+    def _write(path, message):
+        with open(path, 'w') as f:
+            json.dump(message, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _recover_spool(self):
+        """Claims unclaimed messages and those of owners that are gone."""
+        self._recovered_at = time.monotonic()
+        cur_dir = os.path.join(self.spool_dir, 'cur')
+        new_dir = os.path.join(self.spool_dir, 'new')
+        gone = {}
+        for entry in os.listdir(cur_dir):
+            owner, _, name = entry.partition('-')
+            if owner not in gone:
+                gone[owner] = self._owner_gone(owner)
+            if gone[owner]:
+                try:
+                    os.replace(os.path.join(cur_dir, entry), os.path.join(new_dir, name))
+                except FileNotFoundError:
+                    pass  # another process recovered it first
+
+        recovered = 0
+        for name in sorted(os.listdir(new_dir)):
+            path = self._claimed_path(name)
+            try:
+                os.replace(os.path.join(new_dir, name), path)
+            except FileNotFoundError:
+                continue  # claimed by another process
+            self._queue.put(path)
+            recovered += 1
+        if recovered:
+            logger.info("Recovered %d spooled emails", recovered)
+
+    # -- worker -------------------------------------------------------------
+
+    def _run(self):
+        while not self._stop.is_set():
+            if time.monotonic() - self._recovered_at >= self.recover_interval:
+                try:
+                    self._recover_spool()
+                except OSError as e:
+                    logger.error("Could not recover the mail spool: %s", e)
+            batch = self._next_batch()
+            if batch is None:
+                self._disconnect()  # idle: don't hold the server's connection slot
+                continue
+            if batch:
+                self._send_batch(batch)
+
+    def _next_batch(self):
+        """Waits for work, at most until the next spool recovery is due.
+
+        Returns None once the connection has been unused for idle_timeout
+        with nothing to send.
+        """
+        batch = []
+        now = time.monotonic()
+        while self._retries and self._retries[0][0] <= now and len(batch) < self.batch_size:
+            batch.append(heapq.heappop(self._retries)[1])
+
+        if not batch:
+            wait = min(self.idle_timeout, max(0.0, self._recovered_at + self.recover_interval - now))
+            if self._retries:
+                wait = min(wait, max(0.0, self._retries[0][0] - now))
+            try:
+                item = self._queue.get(timeout=wait)
+            except queue.Empty:
+                if self._retries or time.monotonic() - self._last_used < self.idle_timeout:
+                    return []
+                return None
+            if item is None:
+                return []
+            batch.append(item)
+
+        while len(batch) < self.batch_size:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                batch.append(item)
+        return batch
+
+    def _send_batch(self, batch):
+        try:
+            smtp = self._connection()
+        except (smtplib.SMTPException, OSError) as e:
+            self._defer(batch, e)
+            return
+        self._connect_failures = 0
+
+        for index, path in enumerate(batch):
+            try:
+                with open(path) as f:
+                    message = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.error("Dropping unreadable spooled email %s: %s", path, e)
+                continue
+
+            try:
+                with observe_outbound('smtp', 'sendmail'):
+                    smtp.sendmail(self.sender, message['to'], self._render(message))
+            except smtplib.SMTPRecipientsRefused as e:
+                self._fail(path, message, e)
+            except smtplib.SMTPResponseException as e:
+                if 500 <= e.smtp_code < 600:
+                    self._fail(path, message, e)
+                else:
+                    self._retry(path, message, e)
+            except (smtplib.SMTPException, OSError) as e:
+                # The connection is gone; retry this message and requeue the
+                # rest of the batch instead of failing each against a dead socket.
+                self._disconnect()
+                self._retry(path, message, e)
+                for rest in batch[index + 1:]:
+                    self._queue.put(rest)
+                return
+            else:
+                self.sent += 1
+                self._last_used = time.monotonic()
+                os.remove(path)
+                logger.info("Email %r sent to %s", message['subject'], message['to'])
+
+    def _defer(self, batch, error):
+        """Server unreachable: park the whole batch without spending retry attempts."""
+        self._connect_failures += 1
+        delay = self.retry_backoff * 2 ** min(self._connect_failures - 1, 6)
+        ready_at = time.monotonic() + delay
+        for path in batch:
+            heapq.heappush(self._retries, (ready_at, path))
+        logger.warning("SMTP server unavailable (%s), retrying %d emails in %.0fs", error, len(batch), delay)
+
+    def _render(self, message):
+        msg = MIMEMultipart()
+        msg['From'] = self.sender
+        msg['To'] = message['to']
+        msg['Subject'] = message['subject']
+        msg.attach(MIMEText(message['body'], 'plain'))
+        return msg.as_string()
+
+    def _retry(self, path, message, error):
+        message['attempts'] += 1
+        if message['attempts'] > self.max_retries:
+            self._fail(path, message, error)
+            return
+        self._write(path, message)
+        delay = self.retry_backoff * 2 ** (message['attempts'] - 1)
+        heapq.heappush(self._retries, (time.monotonic() + delay, path))
+        logger.warning("Email to %s failed (%s), retry %d in %.0fs", message['to'], error, message['attempts'], delay)
+
+    def _fail(self, path, message, error):
+        self.failed += 1
+        os.replace(path, os.path.join(self.spool_dir, 'failed', os.path.basename(path)))
+        logger.error("Failed to send email %r to %s: %s", message['subject'], message['to'], error)
+
+    # -- SMTP connection ----------------------------------------------------
+
+    def _connection(self):
+        if self._smtp is not None:
+            if time.monotonic() - self._last_used < NOOP_AFTER_IDLE:
+                return self._smtp
+            # Servers drop idle clients; check before reusing a quiet connection
+            try:
+                if self._smtp.noop()[0] == 250:
+                    self._last_used = time.monotonic()
+                    return self._smtp
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._disconnect()
+
+        with observe_outbound('smtp', 'connect'):
+            smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            try:
+                if self.use_tls:
+                    smtp.starttls()
+                if self.username:
+                    smtp.login(self.username, self.password)
+            except Exception:
+                smtp.close()
+                raise
+        self._smtp = smtp
+        self._last_used = time.monotonic()
+        return smtp
+
+    def _disconnect(self):
+        smtp, self._smtp = self._smtp, None
+        if smtp is not None:
+            try:
+                smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                smtp.close()
+
+
+def get_mailer():
+    """Returns the process-wide mailer configured from [smtp], starting it on first use."""
+    global _mailer
+    if _mailer is None:
+        with _mailer_lock:
+            if _mailer is None:
+                settings = get_section('smtp')
+                mailer = Mailer(
+                    host=settings.get('host', 'localhost'),
+                    port=settings.getint('port', 25),
+                    sender=settings.get('sender', 'wiman@localhost'),
+                    username=settings.get('username') or None,
+                    password=settings.get('password') or None,
+                    use_tls=settings.getboolean('use_tls', True),
+                    timeout=settings.getfloat('timeout', 10),
+                    spool_dir=settings.get('spool_dir', 'spool/mail'),
+                    batch_size=settings.getint('batch_size', 20),
+                    max_retries=settings.getint('max_retries', 5),
+                    retry_backoff=settings.getfloat('retry_backoff', 2.0),
+                    idle_timeout=settings.getfloat('idle_timeout', 30),
+                    recover_interval=settings.getfloat('recover_interval', 60),
+                )
+                mailer.start()
+                atexit.register(mailer.stop)
+                _mailer = mailer
+    return _mailer
+
+
+def send_mail(to, subject, body):
+    """Queues an email for background delivery."""
+    return get_mailer().enqueue(to, subject, body)
+
+
+def _forget_mailer_after_fork():
+    """Gives a forked worker its own mailer; the parent's thread did not survive the fork."""
+    global _mailer, _mailer_lock
+    _mailer = None
+    _mailer_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_mailer_after_fork)
@@ -0,0 +1,252 @@
+import bisect
+import hmac
+import ipaddress
+import logging
+import os
+import threading
+import time
+
+from flask import Response, g, jsonify, request, has_app_context
+
+from utils.config import get_section
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from sub-millisecond cache hits to slow upstream calls
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{value}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for label_values, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {_format_number(value)}")
+        return lines
+
+
+class Histogram:
+    """Fixed-bucket histogram; observe() is a bisect and three additions under a lock."""
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 3)
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((key, list(series)) for key, series in self._series.items())
+        for label_values, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series):
+                cumulative += count
+                labels = _format_labels(self.labels, label_values, [('le', _format_number(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {_format_number(float(series[-2]))}")
+            lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+
+class Gauge:
+    """Gauge whose value is read from a callback when /metrics is scraped."""
+
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def render(self):
+        try:
+            value = self.read()
+        except Exception:
+            return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge",
+                f"{self.name} {_format_number(value)}"]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, read):
+        return self.register(Gauge(name, help, read))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+http_requests = registry.counter(
+    'wiman_http_requests_total', 'HTTP requests by endpoint, method and status.', ('endpoint', 'method', 'status'))
+http_errors = registry.counter(
+    'wiman_http_errors_total', 'HTTP requests answered with a 5xx status.', ('endpoint',))
+http_latency = registry.histogram(
+    'wiman_http_request_duration_seconds', 'Time spent handling a request.', ('endpoint',))
+db_queries_per_request = registry.histogram(
+    'wiman_db_queries_per_request', 'Database statements executed per request.', ('endpoint',), COUNT_BUCKETS)
+db_time_per_request = registry.histogram(
+    'wiman_db_time_per_request_seconds', 'Time spent in database statements per request.', ('endpoint',))
+db_query_latency = registry.histogram(
+    'wiman_db_query_duration_seconds', 'Duration of individual database statements.')
+db_checkout_wait = registry.histogram(
+    'wiman_db_pool_checkout_wait_seconds', 'Time spent waiting for a pooled connection.')
+outbound_latency = registry.histogram(
+    'wiman_outbound_request_duration_seconds', 'Latency of calls to external services.', ('service', 'operation'))
+outbound_errors = registry.counter(
+    'wiman_outbound_errors_total', 'Failed calls to external services.', ('service', 'operation'))
+
+
+def record_query(elapsed):
+    """Called by utils.db for every statement; attributes it to the current request if there is one."""
+    db_query_latency.observe(elapsed)
+    if has_app_context() and 'metrics_start' in g:
+        g.metrics_db_queries += 1
+        g.metrics_db_time += elapsed
+
+
+class observe_outbound:
+    """Context manager timing one call to an external service (Daraja, SMTP)."""
+
+    __slots__ = ('service', 'operation', 'started')
+
+    def __init__(self, service, operation):
+        self.service = service
+        self.operation = operation
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        outbound_latency.observe(time.perf_counter() - self.started, self.service, self.operation)
+        if exc_type is not None:
+            outbound_errors.inc(self.service, self.operation)
+
+
+def _start_request():
+    g.metrics_start = time.perf_counter()
+    g.metrics_db_queries = 0
+    g.metrics_db_time = 0.0
+
+
+def _finish_request(response):
+    started = g.get('metrics_start')
+    if started is None:
+        return response
+    endpoint = request.endpoint or 'unmatched'
+    http_latency.observe(time.perf_counter() - started, endpoint)
+    http_requests.inc(endpoint, request.method, response.status_code)
+    if response.status_code >= 500:
+        http_errors.inc(endpoint)
+    db_queries_per_request.observe(g.metrics_db_queries, endpoint)
+    db_time_per_request.observe(g.metrics_db_time, endpoint)
+    return response
+
+
+# Networks allowed to scrape /metrics without a token, from [metrics] allow_ips
+_scraper_networks = ()
+
+
+def _parse_networks(value):
+    """Parses "10.0.0.5, 10.1.0.0/16" into ip_network objects, skipping (and logging) bad entries."""
+    networks = []
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            networks.append(ipaddress.ip_network(item, strict=False))
+        except ValueError:
+            logger.error("Ignoring invalid [metrics] allow_ips entry %r", item)
+    return tuple(networks)
+
+
+def _scraper_allowed():
+    """True if the caller sends METRICS_TOKEN as a bearer token or comes from an allowed network."""
+    token = os.getenv('METRICS_TOKEN')
+    if token and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return True
+    try:
+        address = ipaddress.ip_address(request.remote_addr or '')
+    except ValueError:
+        return False
+    return any(address in network for network in _scraper_networks)
+
+
+def metrics_view():
+    # Per-endpoint traffic and pool and queue internals are not for the public
+    if not _scraper_allowed():
+        return jsonify({"error": "Not allowed to read metrics"}), 403
+    return Response(registry.render(), mimetype=None, content_type=CONTENT_TYPE)
+
+
+def init_metrics(app):
+    """Times every request and serves /metrics to scrapers holding METRICS_TOKEN or listed in [metrics] allow_ips."""
+    global _scraper_networks
+    _scraper_networks = _parse_networks(get_section('metrics').get('allow_ips', ''))
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -0,0 +1,282 @@
+"""Versioned schema migrations and query-plan checks.
+
+Usage:
+    python -m utils.migrate status
+    python -m utils.migrate upgrade [--to VERSION]
+    python -m utils.migrate check [--strict]
+
+Migrations are the NNNN_name.sql files in migrations/, applied in version
+order and recorded in schema_migrations together with a checksum of the
+file. ``check`` runs EXPLAIN on every query in hot_queries() and fails if
+any of them reads a whole table.
+
+Run ``check`` against a database holding realistic data, such as a staging
+copy or the load test's seeded database. On an empty or tiny table MySQL's
+optimizer prefers a full scan to any index, so EXPLAIN reports type ALL
+whatever indexes exist and the check fails for reasons that say nothing
+about production plans.
+"""
+import argparse
+import hashlib
+import os
+import re
+import sys
+
+import MySQLdb
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations')
+MIGRATION_FILE = re.compile(r'^(\d{4})_(\w+)\.sql$')
+
+# "Table exists", "Duplicate column name", "Duplicate key name": the change is
+# already there, typically on a database created before migrations existed
+ALREADY_APPLIED_ERRORS = {1050, 1060, 1061}
+
+
+def hot_queries():
+    """The queries the blueprints and jobs issue, with representative parameters.
+
+    Each is the statement constant (or query builder) its call site uses,
+    so the check EXPLAINs the SQL that actually runs. Returns (name, query,
+    params, full_scan_ok) tuples; full_scan_ok marks reads of a whole (small)
+    catalog table that are meant to scan it. The modules are imported here,
+    not at the top, so running migrations does not load the app.
+    """
+    from blueprints import admin, auth, users
+    from utils import (accounting, entitlements, passwords, payments, plans, reconcile, revocation,
+                       scheduler, sessions, stk, subscription_manager as expiry, user_cache)
+
+    def ids(count):
+        return ', '.join(['%s'] * count)
+
+    def page(builder, *args):
+        query, params = builder(*args)
+        return query + " LIMIT %s", tuple(params) + (100,)
+
+    return [
+        ('user_cache.get_user_record (token_required, admin_required, protected)',
+         user_cache.SELECT_USER_RECORD, ('bench_user_1',), False),
+        ('auth.login', auth.SELECT_LOGIN, ('bench_user_1',), False),
+        ('auth.rehash_password / reset_password / users.change_password / admin.update_user',
+         passwords.UPDATE_PASSWORD_HASH, ('x', 'bench_user_1'), False),
+        ('auth.request_reset', auth.SELECT_USERNAME_BY_EMAIL, ('user1@bench.local',), False),
+        ('auth.verify_email', auth.ACTIVATE_USER, ('bench_user_1',), False),
+        ('users.login', users.SELECT_LOGIN, ('bench_user_1',), False),
+        ('users.get_profile', users.SELECT_PROFILE, ('bench_user_1',), False),
+        ('users.change_password', users.SELECT_PASSWORD_HASH, ('bench_user_1',), False),
+        ('users.subscribe', users.SELECT_USER_ID, ('bench_user_1',), False),
+        ('admin.get_users', *page(admin.users_page_query, 0), False),
+        ('admin.get_users (status, role, q)', *page(admin.users_page_query, 0, 'active', 'user', 'bench_user'),
+         False),
+        ('admin.update_user', admin.UPDATE_EMAIL, ('x', 'bench_user_1'), False),
+        ('admin.block_user', admin.BLOCK_USER, ('bench_user_1',), False),
+        ('admin.admin_subscriptions', *page(admin.subscriptions_page_query, 0), False),
+        ('admin.admin_subscriptions (plan, username)',
+         *page(admin.subscriptions_page_query, 0, 'Basic', 'bench_user_1'), False),
+        ('admin.flagged_usage', *page(admin.flagged_page_query, 0, 'volume'), False),
+        ('entitlements.load (protected)', entitlements.SELECT_LATEST_SUBSCRIPTION, (1,), False),
+        ('payments.record_payment (mpesa_callback)',
+         payments.SELECT_PAYER.format(column='u.phone_number'), ('254700000001',), False),
+        ('payments.record_payment (reconciliation)', payments.SELECT_PAYER.format(column='u.id'), (1,), False),
+        ('plans.plan', plans.SELECT_PLAN, (1,), False),
+        ('plans._build (subscription_plans)', plans.SELECT_SUBSCRIPTION_PLANS, (), True),
+        ('plans._build (plans)', plans.SELECT_PLANS, (), True),
+        ('expired_subscriptions (active past expires_at)', expiry.SELECT_LAPSED, (0, 500), False),
+        ('expired_subscriptions (pending past end_date)', expiry.SELECT_PENDING_PAST_END, (0, 500), False),
+        ('expired_subscriptions (users_subscriptions dates)', expiry.SELECT_UNDATED, (0, 500), False),
+        ('ExpiryEngine.refresh', expiry.SELECT_UPCOMING, (0, 1800, 500), False),
+        ('ExpiryEngine._expire', expiry.SELECT_DUE.format(ids=ids(2)), (1, 2), False),
+        ('RevocationStore.poll', revocation.SELECT_REVOCATIONS, (0, 1000), False),
+        ('purge_expired_revocations', revocation.PURGE_REVOCATIONS, (0, 1000), False),
+        ('StkOrchestrator._update', stk.UPDATE_CHECKOUT.format(assignments='status = %s'), ('pending', 'x'), False),
+        ('StkOrchestrator.on_callback', stk.SETTLE_CHECKOUT,
+         ('paid', 0, 'x', 'x', 'x', stk.QUEUED, stk.PENDING), False),
+        ('StkOrchestrator._load', stk.SELECT_CHECKOUT, ('x',), False),
+        ('Reconciler._first_id', reconcile.SELECT_FIRST_ID, (24,), False),
+        ('Reconciler._chunk', reconcile.SELECT_UNSETTLED, (0, 300, stk.QUEUED, stk.PENDING, stk.PAID, 500), False),
+        ('Reconciler._settle', reconcile.SETTLE_OPEN_CHECKOUT, ('paid', 0, 'x', 1, stk.QUEUED, stk.PENDING), False),
+        ('UsageAggregator._load_limits', accounting.SELECT_LIMITS.format(usernames=ids(2)),
+         ('bench_user_1', 'bench_user_2'), False),
+        ('UsageAggregator._usage', accounting.SELECT_USAGE.format(ids=ids(2)), (1, 2), False),
+        ('SessionRegistry._load_plans', sessions.SELECT_PLANS.format(usernames=ids(2)),
+         ('bench_user_1', 'bench_user_2'), False),
+        ('SessionRegistry.poll', sessions.SELECT_CHANGED,
+         ('2024-01-01 00:00:00', '2024-01-01 00:00:00', '', 1000), False),
+        ('purge_stale_sessions', sessions.PURGE_SESSIONS, (0, 1000), False),
+        ('Scheduler._last_scheduled', scheduler.SELECT_LAST_SCHEDULED, ('expire_subscriptions',), False),
+    ]
+
+
+class MigrationError(Exception):
+    """Raised when a migration cannot be applied or an applied one was edited afterwards."""
+
+
+class Migration:
+    def __init__(self, version, name, path):
+        self.version = version
+        self.name = name
+        self.path = path
+        with open(path, 'rb') as f:
+            raw = f.read()
+        self.sql = raw.decode('utf-8')
+        self.checksum = hashlib.sha256(raw).hexdigest()
+
+    def statements(self):
+        """The file's statements: ``--`` comment lines dropped, split on a ``;`` that ends a line."""
+        lines = [line for line in self.sql.splitlines() if not line.lstrip().startswith('--')]
+        return [s.strip() for s in re.split(r';\s*$', '\n'.join(lines), flags=re.M) if s.strip()]
+
+
+def load_migrations(directory=MIGRATIONS_DIR):
+    migrations = []
+    for filename in sorted(os.listdir(directory)):
+        match = MIGRATION_FILE.match(filename)
+        if match:
+            migrations.append(Migration(int(match.group(1)), match.group(2), os.path.join(directory, filename)))
+    versions = [m.version for m in migrations]
+    if len(versions) != len(set(versions)):
+        raise MigrationError("Two migration files share a version number")
+    return migrations
+
+
+def ensure_migrations_table(db):
+    with db.cursor() as cursor:
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INT PRIMARY KEY,
+                name VARCHAR(255) NOT NULL,
+                checksum CHAR(64) NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+    db.commit()
+
+
+def applied_migrations(db):
+    """Returns {version: checksum} for every migration recorded in schema_migrations."""
+    ensure_migrations_table(db)
+    with db.cursor() as cursor:
+        cursor.execute("SELECT version, checksum FROM schema_migrations")
+        return dict(cursor.fetchall())
+
+
+def status(db, migrations=None):
+    """Returns (migration, state) pairs; state is 'applied', 'pending' or 'changed'."""
+    migrations = migrations if migrations is not None else load_migrations()
+    applied = applied_migrations(db)
+    states = []
+    for migration in migrations:
+        if migration.version not in applied:
+            states.append((migration, 'pending'))
+        elif applied[migration.version] != migration.checksum:
+            states.append((migration, 'changed'))
+        else:
+            states.append((migration, 'applied'))
+    return states
+
+
+def upgrade(db, target=None, migrations=None, log=print):
+    """Applies pending migrations up to ``target`` (all of them by default); returns the versions applied.
+
+    MySQL commits DDL as it goes, so a migration is recorded only after all of
+    its statements succeeded; statements that fail because their change is
+    already present are skipped, which makes re-running a half-applied
+    migration safe.
+    """
+    states = status(db, migrations)
+    changed = [m for m, state in states if state == 'changed']
+    if changed:
+        raise MigrationError(
+            f"Applied migrations were modified afterwards: {', '.join(f'{m.version:04d}_{m.name}' for m in changed)}")
+
+    done = []
+    for migration, state in states:
+        if state != 'pending' or (target is not None and migration.version > target):
+            continue
+        log(f"Applying {migration.version:04d}_{migration.name}")
+        with db.cursor() as cursor:
+            for statement in migration.statements():
+                try:
+                    cursor.execute(statement)
+                except MySQLdb.Error as e:
+                    if e.args[0] not in ALREADY_APPLIED_ERRORS:
+                        raise MigrationError(f"{migration.version:04d}_{migration.name} failed: {e}") from e
+                    log(f"  already present, skipped: {e.args[1]}")
+            cursor.execute(
+                "INSERT INTO schema_migrations (version, name, checksum) VALUES (%s, %s, %s)",
+                (migration.version, migration.name, migration.checksum)
+            )
+        db.commit()
+        done.append(migration.version)
+    return done
+
+
+def explain(db, query, params):
+    """Returns EXPLAIN's rows for query as dicts."""
+    with db.cursor() as cursor:
+        cursor.execute("EXPLAIN " + query, params)
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def check(db, strict=False, queries=None, log=print):
+    """EXPLAINs every hot query; returns the names of those that scan a whole table.
+
+    A plan step of type ALL is a full table scan. With ``strict`` a full
+    index scan (type index) counts as well. The plans are only meaningful
+    on a database with realistic row counts; see the module docstring.
+    """
+    bad_types = {'ALL', 'index'} if strict else {'ALL'}
+    failures = []
+    for name, query, params, full_scan_ok in (queries if queries is not None else hot_queries()):
+        plan = explain(db, query, params)
+        scans = [step for step in plan if step.get('type') in bad_types]
+        if scans and not full_scan_ok:
+            failures.append(name)
+            for step in scans:
+                log(f"FAIL  {name}: {step['type']} scan of {step['table']} "
+                    f"(possible keys: {step.get('possible_keys') or 'none'})")
+        else:
+            access = ', '.join(f"{step['table']}:{step['type']}/{step.get('key') or '-'}" for step in plan)
+            log(f"ok    {name}: {access}")
+    return failures
+
+
+def main():
+    from utils.db import open_connection
+
+    parser = argparse.ArgumentParser(description="Schema migrations for the WiMaN database")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('status', help='list migrations and whether they are applied')
+    upgrade_parser = commands.add_parser('upgrade', help='apply pending migrations')
+    upgrade_parser.add_argument('--to', type=int, help='stop after this version')
+    check_parser = commands.add_parser(
+        'check', help='EXPLAIN the hot queries and fail on full table scans; needs a database with realistic data, '
+                      'as tiny tables are always scanned')
+    check_parser.add_argument('--strict', action='store_true', help='fail on full index scans too')
+    args = parser.parse_args()
+
+    db = open_connection()
+    try:
+        if args.command == 'status':
+            for migration, state in status(db):
+                print(f"{migration.version:04d}  {state:<8}  {migration.name}")
+        elif args.command == 'upgrade':
+            applied = upgrade(db, target=args.to)
+            print(f"Applied {len(applied)} migration(s)" if applied else "Database is up to date")
+        else:
+            failures = check(db, strict=args.strict)
+            if failures:
+                print(f"\n{len(failures)} queries scan a whole table")
+                sys.exit(1)
+            print("\nAll hot queries use an index")
+    except MigrationError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+from urllib.parse import urlencode
+
+from flask import Response, current_app, request, stream_with_context
+from MySQLdb.cursors import SSCursor
+
+from utils.db import get_db_connection
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+STREAM_FETCH_SIZE = 500
+
+
+def page_args():
+    """Reads ``limit`` and ``after_id`` from the query string; raises ValueError if they are malformed."""
+    limit = int(request.args.get('limit', DEFAULT_LIMIT))
+    after_id = int(request.args.get('after_id', 0))
+    if limit < 1 or after_id < 0:
+        raise ValueError("limit must be positive and after_id non-negative")
+    return min(limit, MAX_LIMIT), after_id
+
+
+def wants_stream():
+    return request.args.get('stream', '').lower() in ('1', 'true', 'yes')
+
+
+def page_response(items, last_id, limit):
+    """JSON array of one page; when the page is full the cursor for the next one is sent in headers."""
+    response = current_app.json.response(items)
+    if len(items) == limit:
+        args = request.args.to_dict()
+        args['after_id'] = last_id
+        response.headers['X-Next-After-Id'] = str(last_id)
+        response.headers['Link'] = f'<{request.path}?{urlencode(args)}>; rel="next"'
+    return response
+
+
+def stream_rows(query, params, serialize):
+    """Streams every row of query as one JSON array, reading through a server-side cursor.
+
+    Rows are pulled STREAM_FETCH_SIZE at a time and written out as they
+    arrive, so memory stays flat however many rows match. stream_with_context
+    keeps the request context, and with it g.db, alive until the last row is
+    sent, so the stream reads through the request's own connection (the one
+    admin_required may already hold) and teardown releases it afterwards.
+    """
+    def generate():
+        db = get_db_connection()
+        cursor = db.cursor(SSCursor)
+        try:
+            cursor.execute(query, params)
+            yield '['
+            first = True
+            while True:
+                rows = cursor.fetchmany(STREAM_FETCH_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    yield ('' if first else ',') + current_app.json.dumps(serialize(row))
+                    first = False
+            yield ']'
+        finally:
+            cursor.close()
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
@@ -0,0 +1,162 @@
+import atexit
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import bcrypt
+
+from utils.config import get_section
+
+# bcrypt only looks at the first 72 bytes; truncating keeps hashes made by Flask-Bcrypt valid
+MAX_PASSWORD_BYTES = 72
+
+# Stores a new hash: password reset and change, admin edits and rehash on login
+UPDATE_PASSWORD_HASH = "UPDATE users SET password_hash = %s WHERE username = %s"
+
+_hasher = None
+_hasher_lock = threading.Lock()
+
+
+class PasswordPoolBusy(Exception):
+    """Raised when too many hash/verify jobs are already queued; callers answer 503."""
+
+
+def _encode(password):
+    return password.encode('utf-8')[:MAX_PASSWORD_BYTES]
+
+
+# Module-level so a process pool can pickle them
+def _hash(password, rounds):
+    return bcrypt.hashpw(_encode(password), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _check(password_hash, password):
+    try:
+        return bcrypt.checkpw(_encode(password), password_hash.encode('utf-8'))
+    except (ValueError, AttributeError):
+        return False  # malformed or missing stored hash
+
+
+def hash_cost(password_hash):
+    """Returns the cost factor of a bcrypt hash ($2b$<cost>$...), or None if it isn't one."""
+    try:
+        return int(password_hash.split('$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+class PasswordHasher:
+    """Runs bcrypt hashing and verification on a bounded worker pool.
+
+    At most ``workers + max_queue`` jobs are admitted at once; beyond that
+    submit raises PasswordPoolBusy straight away instead of letting a login
+    burst queue up every other request behind it. With the default
+    ``executor = thread`` the pool is threads: the bcrypt library releases the
+    GIL while hashing, so they run on all cores without forking the app.
+    ``executor = process`` uses a process pool instead.
+    """
+
+    def __init__(self, rounds=12, workers=None, max_queue=64, executor='thread', timeout=30, bulk_workers=None):
+        self.rounds = rounds
+        self.workers = workers or os.cpu_count() or 1
+        self.bulk_workers = bulk_workers or max(1, self.workers // 2)
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.rejected = 0
+        self._slots = threading.BoundedSemaphore(self.workers + max_queue)
+        if executor == 'process':
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='bcrypt')
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise PasswordPoolBusy("Password hashing queue is full")
+        try:
+            return self._executor.submit(fn, *args).result(timeout=self.timeout)
+        finally:
+            self._slots.release()
+
+    def hash(self, password, rounds=None):
+        return self._run(_hash, password, rounds or self.rounds)
+
+    def check(self, password_hash, password):
+        return self._run(_check, password_hash, password)
+
+    def hash_many(self, passwords, max_in_flight=None):
+        """Hashes a batch in parallel, waiting up to ``timeout`` for queue slots as they free up.
+
+        ``max_in_flight`` caps how many of the batch's hashes are queued at
+        once, so a bulk job leaves the rest of the pool to interactive logins.
+        """
+        in_flight = threading.BoundedSemaphore(max_in_flight or self.workers + self.max_queue)
+        futures = []
+
+        def done(_):
+            self._slots.release()
+            in_flight.release()
+
+        try:
+            for password in passwords:
+                if not in_flight.acquire(timeout=self.timeout):
+                    raise PasswordPoolBusy("Password hashing queue is full")
+                if not self._slots.acquire(timeout=self.timeout):
+                    in_flight.release()
+                    self.rejected += 1
+                    raise PasswordPoolBusy("Password hashing queue is full")
+                future = self._executor.submit(_hash, password, self.rounds)
+                future.add_done_callback(done)
+                futures.append(future)
+            return [future.result(timeout=self.timeout) for future in futures]
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    def needs_rehash(self, password_hash):
+        return hash_cost(password_hash) != self.rounds
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def get_password_hasher():
+    """Returns the process-wide hasher configured from [security]."""
+    global _hasher
+    if _hasher is None:
+        with _hasher_lock:
+            if _hasher is None:
+                settings = get_section('security')
+                hasher = PasswordHasher(
+                    rounds=settings.getint('bcrypt_rounds', 12),
+                    workers=settings.getint('bcrypt_workers', 0) or None,
+                    max_queue=settings.getint('bcrypt_max_queue', 64),
+                    executor=settings.get('bcrypt_executor', 'thread'),
+                    bulk_workers=settings.getint('bcrypt_bulk_workers', 0) or None,
+                )
+                atexit.register(hasher.shutdown)
+                _hasher = hasher
+    return _hasher
+
+
+def hash_password(password):
+    return get_password_hasher().hash(password)
+
+
+def hash_passwords(passwords):
+    """Hashes a batch (bulk imports), using at most bcrypt_bulk_workers of the pool at a time."""
+    hasher = get_password_hasher()
+    return hasher.hash_many(passwords, max_in_flight=hasher.bulk_workers)
+
+
+def check_password(password_hash, password):
+    return get_password_hasher().check(password_hash, password)
+
+
+def needs_rehash(password_hash):
+    return get_password_hasher().needs_rehash(password_hash)
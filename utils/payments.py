@@ -0,0 +1,221 @@
+import atexit
+import logging
+import queue
+import threading
+
+from utils.cache import TTLCache
+from utils.config import get_section
+from utils.db import get_db_connection
+from utils.entitlements import get_entitlement_index
+
+logger = logging.getLogger(__name__)
+
+# Receipt numbers seen recently; Safaricom retries land here before touching MySQL
+RECENT_RECEIPT_TTL = 24 * 3600
+
+# The payer and their latest subscription, by u.phone_number or, for reconciled payments, u.id
+SELECT_PAYER = """
+    SELECT u.id, s.id
+    FROM users u
+    LEFT JOIN subscriptions s ON s.user_id = u.id
+    WHERE {column} = %s
+    ORDER BY s.id DESC
+    LIMIT 1
+"""
+INSERT_PAYMENT = """
+    INSERT INTO payments (user_id, subscription_id, phone_number, amount, transaction_id,
+                          checkout_request_id, status)
+    VALUES (%s, %s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        transaction_id = IF(transaction_id = checkout_request_id, VALUES(transaction_id), transaction_id),
+        checkout_request_id = IFNULL(checkout_request_id, VALUES(checkout_request_id))
+"""
+
+# Outcomes of record_payment
+RECORDED = 'recorded'
+DUPLICATE = 'duplicate'
+UNMATCHED = 'unmatched'
+
+_processor = None
+_processor_lock = threading.Lock()
+# Whether payments.transaction_id has its UNIQUE key; looked up once per process
+_receipt_key = None
+
+
+class QueueFullError(Exception):
+    """Raised when the payment queue is full; the callback should be retried later."""
+
+
+def parse_stk_callback(data):
+    """Flattens an STK callback body into one dict, reading CallbackMetadata in a single pass.
+
+    Returns None if the body is not an STK callback.
+    """
+    body = data.get("Body") if isinstance(data, dict) else None
+    callback = body.get("stkCallback") if isinstance(body, dict) else None
+    if not isinstance(callback, dict):
+        return None
+    # Failed payments carry no CallbackMetadata
+    callback_metadata = callback.get("CallbackMetadata")
+    items = callback_metadata.get("Item") if isinstance(callback_metadata, dict) else None
+    if not isinstance(items, list):
+        items = []
+    metadata = {item["Name"]: item.get("Value") for item in items if isinstance(item, dict) and "Name" in item}
+    return {
+        "result_code": callback.get("ResultCode"),
+        "result_desc": callback.get("ResultDesc"),
+        "merchant_request_id": callback.get("MerchantRequestID"),
+        "checkout_request_id": callback.get("CheckoutRequestID"),
+        "phone_number": metadata.get("PhoneNumber"),
+        "amount": metadata.get("Amount"),
+        "receipt_number": metadata.get("MpesaReceiptNumber"),
+        "transaction_date": metadata.get("TransactionDate"),
+    }
+
+
+def _has_receipt_key(cursor):
+    global _receipt_key
+    if _receipt_key is None:
+        cursor.execute("SHOW INDEX FROM payments WHERE Column_name = 'transaction_id' AND Non_unique = 0")
+        _receipt_key = cursor.fetchone() is not None
+        if not _receipt_key:
+            logger.error("payments.transaction_id has no UNIQUE key, so receipts are locked one by one; "
+                         "run python -m utils.migrate upgrade and restart")
+    return _receipt_key
+
+
+def record_payment(payment):
+    """Stores one successful payment in a single transaction.
+
+    Returns RECORDED, DUPLICATE if the receipt or the checkout is already
+    stored (the UNIQUE keys on payments.transaction_id and
+    payments.checkout_request_id make the insert idempotent) or UNMATCHED
+    if no user has the paying phone number. The payer is looked up by
+    ``user_id`` instead when the payment carries one. A payment that the
+    reconciliation job stored without a receipt gets it from the callback.
+    On a database that predates the transaction_id key (migration 0002) the
+    receipt is looked up FOR UPDATE first, so retries still insert once.
+    """
+    column, key = ('u.id', payment['user_id']) if payment.get('user_id') else ('u.phone_number', payment['phone_number'])
+    with get_db_connection() as db, db.cursor() as cursor:
+        db.begin()
+        cursor.execute(SELECT_PAYER.format(column=column), (key,))
+        user = cursor.fetchone()
+        if not user:
+            db.rollback()
+            logger.warning("Payment %s from unknown phone number %s", payment['receipt_number'], payment['phone_number'])
+            return UNMATCHED
+
+        user_id, subscription_id = user
+        if not _has_receipt_key(cursor):
+            cursor.execute("SELECT id FROM payments WHERE transaction_id = %s FOR UPDATE",
+                           (payment["receipt_number"],))
+            if cursor.fetchone():
+                db.rollback()
+                return DUPLICATE
+        cursor.execute(
+            INSERT_PAYMENT,
+            (user_id, subscription_id, payment["phone_number"], payment["amount"],
+             payment["receipt_number"], payment.get("checkout_request_id"), "Completed")
+        )
+        inserted = cursor.rowcount == 1
+        db.commit()
+    if inserted:
+        get_entitlement_index().invalidate(user_id)
+    return RECORDED if inserted else DUPLICATE
+
+
+class PaymentProcessor:
+    """Records STK callback payments on background threads.
+
+    The callback endpoint only validates and enqueues, so Safaricom gets its
+    acknowledgement without waiting on MySQL. Receipts are de-duplicated in
+    memory first, then by the database on insert, so retried callbacks never
+    create a second payments row. A payment that is acknowledged but not yet
+    written is lost if the process dies; the Daraja reconciliation job is what
+    backfills those.
+    """
+
+    def __init__(self, workers=2, max_queue=1000):
+        self.workers = workers
+        self.recorded = 0
+        self.duplicates = 0
+        self.unmatched = 0
+        self.failed = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._recent = TTLCache(maxsize=max(max_queue * 10, 10000), ttl=RECENT_RECEIPT_TTL)
+        self._threads = []
+
+    def start(self):
+        if self._threads:
+            return
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'payments-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=10):
+        """Finishes the payments already queued, then stops the worker threads."""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def submit(self, payment):
+        """Queues a parsed successful payment; returns False if its receipt was already seen."""
+        receipt = payment["receipt_number"]
+        if self._recent.get(receipt) is not None:
+            self.duplicates += 1
+            return False
+        try:
+            self._queue.put_nowait(payment)
+        except queue.Full:
+            raise QueueFullError("Payment queue is full")
+        self._recent.set(receipt, True)
+        return True
+
+    def _run(self):
+        while True:
+            payment = self._queue.get()
+            if payment is None:
+                return
+            try:
+                outcome = record_payment(payment)
+                if outcome == RECORDED:
+                    self.recorded += 1
+                elif outcome == DUPLICATE:
+                    self.duplicates += 1
+                else:
+                    self.unmatched += 1
+            except Exception as e:
+                self.failed += 1
+                # Let a Safaricom retry (or reconciliation) try this receipt again
+                self._recent.pop(payment["receipt_number"])
+                logger.error("Failed to record payment %s: %s", payment['receipt_number'], e)
+
+    def stats(self):
+        return {
+            'queued': self._queue.qsize(),
+            'recorded': self.recorded,
+            'duplicates': self.duplicates,
+            'unmatched': self.unmatched,
+            'failed': self.failed,
+        }
+
+
+def get_payment_processor():
+    """Returns the process-wide processor configured from [payments], starting it on first use."""
+    global _processor
+    if _processor is None:
+        with _processor_lock:
+            if _processor is None:
+                settings = get_section('payments')
+                processor = PaymentProcessor(
+                    workers=settings.getint('workers', 2),
+                    max_queue=settings.getint('max_queue', 1000),
+                )
+                processor.start()
+                atexit.register(processor.stop)
+                _processor = processor
+    return _processor
@@ -0,0 +1,115 @@
+import hashlib
+import threading
+import time
+from collections import namedtuple
+
+from flask import current_app
+
+from utils.config import get_section
+from utils.db import get_db_connection
+
+# Define durations mapping
+DURATION_LABELS = {
+    1: "1 hour",
+    3: "3 hours",
+    12: "12 hours (6PM - 6AM)",
+    7: "1 week",
+    14: "2 weeks",
+    30: "1 month"
+}
+
+# One built version of the catalog
+CatalogSnapshot = namedtuple('CatalogSnapshot', ['body', 'etag', 'plans', 'built_at'])
+Plan = namedtuple('Plan', ['id', 'name', 'duration'])
+
+SELECT_PLAN = "SELECT id, name, duration FROM plans WHERE id = %s"
+# The catalogs are small and read whole
+SELECT_SUBSCRIPTION_PLANS = "SELECT name, duration_days, price, bandwidth_limit FROM subscription_plans"
+SELECT_PLANS = "SELECT id, name, duration FROM plans"
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def _device_count(category, price):
+    if category == "BASIC":
+        return 1
+    return 1 if price == 150 else (2 if price in [300, 600] else 4)
+
+
+class PlanCatalog:
+    """Precomputed subscription plan catalog.
+
+    The public /users/subscriptions body is built and serialized once, together
+    with its strong ETag and the id -> plan map subscribe uses, and rebuilt
+    after ``ttl`` seconds. Plans are edited directly in MySQL, not through
+    the API, so that expiry is how changes arrive: a new plan or price is
+    served (with a new ETag) within ``ttl`` seconds, and clients holding the
+    old body revalidate after the response's max-age. A plan id missing from
+    the snapshot is still looked up, so subscribing to a new plan works
+    straight away.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.builds = 0
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    def snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() - snapshot.built_at < self.ttl:
+            return snapshot
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None or time.monotonic() - snapshot.built_at >= self.ttl:
+                snapshot = self._build()
+                self._snapshot = snapshot
+        return snapshot
+
+    def plan(self, plan_id):
+        """Returns the Plan with this id, or None; ids added since the last build are read from MySQL."""
+        try:
+            plan_id = int(plan_id)
+        except (TypeError, ValueError):
+            return None
+        plan = self.snapshot().plans.get(plan_id)
+        if plan is None:
+            with get_db_connection() as db, db.cursor() as cursor:
+                cursor.execute(SELECT_PLAN, (plan_id,))
+                row = cursor.fetchone()
+            plan = Plan(*row) if row else None
+        return plan
+
+    def _build(self):
+        with get_db_connection() as db, db.cursor() as cursor:
+            cursor.execute(SELECT_SUBSCRIPTION_PLANS)
+            subscription_plans = cursor.fetchall()
+            cursor.execute(SELECT_PLANS)
+            plans = {row[0]: Plan(*row) for row in cursor.fetchall()}
+
+        # Structure plans into categories
+        structured_plans = {"BASIC": [], "PREMIUM": [], "ENTERPRISE": []}
+        for name, duration_days, price, bandwidth_limit in subscription_plans:
+            plan_category = name.upper()  # Ensure uppercase for consistency
+            structured_plans.setdefault(plan_category, []).append({
+                "duration": DURATION_LABELS.get(duration_days, f"{duration_days} days"),
+                "price": price,
+                "bandwidth": bandwidth_limit,
+                "devices": _device_count(plan_category, price)
+            })
+
+        body = current_app.json.dumps({"plans": structured_plans}).encode('utf-8')
+        etag = hashlib.sha256(body).hexdigest()[:32]
+        self.builds += 1
+        return CatalogSnapshot(body, etag, plans, time.monotonic())
+
+
+def get_plan_catalog():
+    """Returns the process-wide catalog configured from [plans]."""
+    global _catalog
+    if _catalog is None:
+        with _catalog_lock:
+            if _catalog is None:
+                _catalog = PlanCatalog(ttl=get_section('plans').getfloat('ttl', 300))
+    return _catalog
@@ -0,0 +1,240 @@
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import g, request
+
+from utils.config import get_section
+from utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Rules used when [ratelimit] doesn't set them, as "requests/seconds"
+DEFAULT_RULES = {
+    'login_ip': '20/60',
+    'login_user': '5/60',
+    'register_ip': '5/3600',
+    'reset_ip': '5/3600',
+    'reset_email': '3/3600',
+    'pay_user': '5/60',
+    'pay_phone': '3/300',
+}
+
+rejections = registry.counter(
+    'wiman_ratelimit_rejections_total', 'Requests rejected by a rate limit rule.', ('rule',))
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+class RateLimited(Exception):
+    """Raised by RateLimiter.hit when a rule's budget is spent; answered with 429 and Retry-After."""
+
+    def __init__(self, rule, retry_after):
+        super().__init__(f"Rate limit {rule} exceeded, retry in {retry_after}s")
+        self.rule = rule
+        self.retry_after = retry_after
+
+
+class Rule:
+    def __init__(self, name, limit, window):
+        if limit < 1 or window <= 0:
+            raise ValueError(f"Rate limit {name} needs a positive limit and window")
+        self.name = name
+        self.limit = limit
+        self.window = window
+
+    @classmethod
+    def parse(cls, name, spec):
+        """Parses "requests/seconds", e.g. "5/60"."""
+        limit, _, window = spec.partition('/')
+        return cls(name, int(limit), float(window))
+
+
+def _decide(prev, curr, fraction, limit, window):
+    """Sliding-window decision for one more request; returns (allowed, retry_after seconds).
+
+    The window is approximated from two fixed windows: the previous one's
+    count weighs in proportionally to how much of it still overlaps the
+    sliding window, so ``prev * (1 - fraction) + curr`` estimates the
+    requests made in the last ``window`` seconds.
+    """
+    if prev * (1 - fraction) + curr + 1 <= limit:
+        return True, 0
+    if curr + 1 <= limit:
+        # Allowed again once the previous window's weight has shrunk enough
+        wait = (1 - (limit - 1 - curr) / prev - fraction) * window
+    else:
+        # This window is full: wait for it to end and for its count to decay
+        wait = (1 - fraction) * window + (1 - (limit - 1) / curr) * window
+    return False, max(1, math.ceil(wait))
+
+
+class MemoryBackend:
+    """Per-process counters: (window index, previous count, current count) per key.
+
+    Holds at most ``maxsize`` keys, evicting the least recently used; an
+    evicted key simply starts from zero again.
+    """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._counters = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, key, limit, window):
+        index, elapsed = divmod(time.time(), window)
+        with self._lock:
+            entry = self._counters.get(key)
+            if entry is None or entry[0] < index - 1:
+                prev, curr = 0, 0
+            elif entry[0] < index:
+                prev, curr = entry[2], 0
+            else:
+                prev, curr = entry[1], entry[2]
+            allowed, retry_after = _decide(prev, curr, elapsed / window, limit, window)
+            self._counters[key] = (index, prev, curr + 1 if allowed else curr)
+            self._counters.move_to_end(key)
+            while len(self._counters) > self.maxsize:
+                self._counters.popitem(last=False)
+        return allowed, retry_after
+
+    def __len__(self):
+        return len(self._counters)
+
+
+# Counts the request only if it is allowed, so rejected requests don't extend a client's lockout
+_REDIS_HIT = """
+local curr = tonumber(redis.call('GET', KEYS[1]) or '0')
+local prev = tonumber(redis.call('GET', KEYS[2]) or '0')
+if prev * tonumber(ARGV[3]) + curr + 1 > tonumber(ARGV[1]) then
+    return {0, prev, curr}
+end
+redis.call('INCR', KEYS[1])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return {1, prev, curr}
+"""
+
+
+class RedisBackend:
+    """Counters shared by every worker and host through Redis.
+
+    One key per rule, client and fixed window, updated atomically by a Lua
+    script in a single round trip. If Redis is unreachable requests are let
+    through (and a warning is logged at most once a minute) rather than
+    failing logins and payments.
+    """
+
+    def __init__(self, url, prefix='wiman:rl:', timeout=0.2):
+        import redis  # optional dependency, only needed for backend = redis
+
+        self.prefix = prefix
+        self.errors = 0
+        self._client = redis.Redis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout)
+        self._script = self._client.register_script(_REDIS_HIT)
+        self._error_class = redis.RedisError
+        self._last_warning = 0.0
+
+    def hit(self, key, limit, window):
+        index, elapsed = divmod(time.time(), window)
+        fraction = elapsed / window
+        keys = [f"{self.prefix}{key}:{int(index)}", f"{self.prefix}{key}:{int(index) - 1}"]
+        try:
+            allowed, prev, curr = self._script(keys=keys, args=[limit, math.ceil(2 * window), 1 - fraction])
+        except self._error_class as e:
+            self.errors += 1
+            if time.monotonic() - self._last_warning > 60:
+                self._last_warning = time.monotonic()
+                logger.warning("Rate limiting skipped, Redis is unavailable: %s", e)
+            return True, 0
+        if allowed:
+            return True, 0
+        return _decide(int(prev), int(curr), fraction, limit, window)
+
+
+class RateLimiter:
+    """Applies named rules to per-client keys, e.g. ('login_user', 'alice')."""
+
+    def __init__(self, rules, backend, enabled=True):
+        self.rules = {rule.name: rule for rule in rules}
+        self.backend = backend
+        self.enabled = enabled
+
+    def hit(self, rule_name, key):
+        """Counts one request for key under the rule; raises RateLimited if its budget is spent."""
+        if not self.enabled:
+            return
+        rule = self.rules[rule_name]
+        allowed, retry_after = self.backend.hit(f"{rule_name}:{key}", rule.limit, rule.window)
+        if not allowed:
+            rejections.inc(rule_name)
+            raise RateLimited(rule_name, retry_after)
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'backend': type(self.backend).__name__,
+            'rules': {name: f"{rule.limit}/{rule.window:g}s" for name, rule in self.rules.items()},
+        }
+
+
+def get_rate_limiter():
+    """Returns the process-wide limiter configured from [ratelimit]."""
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                settings = get_section('ratelimit')
+                rules = [Rule.parse(name, settings.get(name, spec)) for name, spec in DEFAULT_RULES.items()]
+                backend = None
+                if settings.get('backend', 'memory') == 'redis':
+                    try:
+                        backend = RedisBackend(settings.get('redis_url', 'redis://localhost:6379/0'))
+                    except ImportError:
+                        logger.warning("backend = redis needs the redis package, using per-process counters")
+                if backend is None:
+                    backend = MemoryBackend(settings.getint('maxsize', 100000))
+                _limiter = RateLimiter(rules, backend, enabled=settings.getboolean('enabled', True))
+    return _limiter
+
+
+# Key functions for rate_limit(); returning None skips the rule for this request
+
+def client_ip():
+    return request.remote_addr
+
+
+def json_field(name):
+    def key():
+        data = request.get_json(silent=True)
+        value = data.get(name) if isinstance(data, dict) else None
+        return str(value).strip().lower() if value else None
+    return key
+
+
+def token_user():
+    claims = g.get('token_claims')
+    return claims.get('username') if claims else None
+
+
+def rate_limit(*limits):
+    """Decorator checking (rule name, key function) pairs, in order, before the view runs.
+
+    Place it below token_required so token_user() can see the caller. A
+    rejected request never reaches the view, so it costs no database query
+    or bcrypt work.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            limiter = get_rate_limiter()
+            for rule_name, key_func in limits:
+                key = key_func()
+                if key:
+                    limiter.hit(rule_name, key)
+            return f(*args, **kwargs)
+        return decorated
+    return decorator
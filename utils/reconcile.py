@@ -0,0 +1,163 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.config import get_section
+from utils.daraja import get_daraja_client, DarajaError
+from utils.db import get_db_connection
+from utils.payments import record_payment, RECORDED, DUPLICATE
+from utils.stk import QUEUED, PENDING, PAID, CANCELLED, FAILED, CANCELLED_CODES
+
+logger = logging.getLogger(__name__)
+
+SELECT_FIRST_ID = """
+    SELECT id FROM stk_checkouts
+    WHERE created_at >= NOW() - INTERVAL %s HOUR
+    ORDER BY created_at LIMIT 1
+"""
+# Checkouts still open, or paid without a payments row, after (id, min age, states..., limit)
+SELECT_UNSETTLED = """
+    SELECT c.id, c.user_id, c.phone_number, c.amount, c.status, c.checkout_request_id, c.receipt_number
+    FROM stk_checkouts c
+    LEFT JOIN payments p ON p.checkout_request_id = c.checkout_request_id
+    WHERE c.id > %s
+    AND c.created_at < NOW() - INTERVAL %s SECOND
+    AND (c.status IN (%s, %s) OR (c.status = %s AND p.id IS NULL))
+    ORDER BY c.id
+    LIMIT %s
+"""
+SETTLE_OPEN_CHECKOUT = """
+    UPDATE stk_checkouts SET status = %s, result_code = %s, result_desc = %s
+    WHERE id = %s AND status IN (%s, %s)
+"""
+
+
+class Reconciler:
+    """Settles STK checkouts whose callback never arrived and backfills their payments.
+
+    Reads the checkouts created in the last ``lookback_hours`` that are at
+    least ``min_age`` seconds old and are still queued or pending, or are
+    paid without a payments row. They are streamed ``chunk_size`` rows at a
+    time in primary key order (``id > last id``), so memory stays flat
+    however many there are. Pending checkouts are looked up with Daraja's
+    STK query, ``workers`` at a time; paid ones are recorded through
+    record_payment, which makes running the job twice harmless.
+    """
+
+    def __init__(self, workers=8, chunk_size=500, min_age=300, lookback_hours=24,
+                 client_factory=get_daraja_client):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.min_age = min_age
+        self.lookback_hours = lookback_hours
+        self._client_factory = client_factory
+
+    def _first_id(self):
+        """Smallest id created within the lookback window, or None if there is none."""
+        with get_db_connection() as db, db.cursor() as cursor:
+            cursor.execute(SELECT_FIRST_ID, (self.lookback_hours,))
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    def _chunk(self, after_id):
+        with get_db_connection() as db, db.cursor() as cursor:
+            cursor.execute(
+                SELECT_UNSETTLED,
+                (after_id, self.min_age, QUEUED, PENDING, PAID, self.chunk_size)
+            )
+            return cursor.fetchall()
+
+    def chunks(self):
+        """Yields the checkouts to reconcile a chunk at a time.
+
+        Rows are (id, user_id, phone_number, amount, status, checkout_request_id, receipt_number).
+        """
+        first_id = self._first_id()
+        if first_id is None:
+            return
+        last_id = first_id - 1
+        while True:
+            chunk = self._chunk(last_id)
+            if chunk:
+                yield chunk
+            if len(chunk) < self.chunk_size:
+                return
+            last_id = chunk[-1][0]
+
+    def _settle(self, row_id, status, result_code, result_desc):
+        """Moves a checkout out of queued/pending; a callback that got there first wins."""
+        with get_db_connection() as db, db.cursor() as cursor:
+            cursor.execute(
+                SETTLE_OPEN_CHECKOUT,
+                (status, result_code, result_desc, row_id, QUEUED, PENDING)
+            )
+            db.commit()
+
+    def reconcile(self, row):
+        """Reconciles one checkout; returns what happened to it, for the summary."""
+        row_id, user_id, phone_number, amount, status, checkout_request_id, receipt_number = row
+        if status == QUEUED and not checkout_request_id:
+            # Its push worker died before sending it, so the customer never saw a prompt
+            self._settle(row_id, FAILED, None, "Push was never sent")
+            return 'never_pushed'
+
+        if status != PAID:
+            try:
+                response = self._client_factory().stk_query(checkout_request_id)
+            except DarajaError as e:
+                logger.warning("STK query for %s failed: %s", checkout_request_id, e)
+                return 'query_errors'
+            if response.get('ResultCode') in (None, ''):
+                # errorCode 500.001.1001: the customer hasn't answered yet
+                return 'still_pending'
+            result_code = int(response['ResultCode'])
+            result_desc = response.get('ResultDesc')
+            if result_code != 0:
+                self._settle(row_id, CANCELLED if result_code in CANCELLED_CODES else FAILED, result_code, result_desc)
+                return 'cancelled' if result_code in CANCELLED_CODES else 'failed'
+            self._settle(row_id, PAID, result_code, result_desc)
+
+        outcome = record_payment({
+            'user_id': user_id,
+            'phone_number': phone_number,
+            'amount': amount,
+            # The query doesn't return the M-Pesa receipt; the callback fills it in if it ever arrives
+            'receipt_number': receipt_number or checkout_request_id,
+            'checkout_request_id': checkout_request_id,
+        })
+        if outcome == RECORDED:
+            return 'backfilled'
+        return 'duplicates' if outcome == DUPLICATE else 'unmatched'
+
+    def _reconcile(self, row):
+        try:
+            return self.reconcile(row)
+        except Exception as e:
+            logger.error("Could not reconcile checkout %s: %s", row[0], e)
+            return 'errors'
+
+    def run(self):
+        """Reconciles every checkout in the window; returns a summary of counts."""
+        started = time.perf_counter()
+        summary = dict.fromkeys(('checked', 'backfilled', 'duplicates', 'unmatched', 'cancelled', 'failed',
+                                 'never_pushed', 'still_pending', 'query_errors', 'errors'), 0)
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='reconcile') as executor:
+            for chunk in self.chunks():
+                for outcome in executor.map(self._reconcile, chunk):
+                    summary[outcome] += 1
+                summary['checked'] += len(chunk)
+        summary['seconds'] = round(time.perf_counter() - started, 3)
+        return summary
+
+
+def reconcile_payments():
+    """Scheduled job: reconciles STK checkouts with Daraja, configured from [reconcile]."""
+    settings = get_section('reconcile')
+    summary = Reconciler(
+        workers=settings.getint('workers', 8),
+        chunk_size=settings.getint('chunk_size', 500),
+        min_age=settings.getint('min_age', 300),
+        lookback_hours=settings.getint('lookback_hours', 24),
+    ).run()
+    logger.info("Payment reconciliation: %s", ', '.join(f"{key}={value}" for key, value in summary.items()))
+    return summary
@@ -0,0 +1,253 @@
+import atexit
+import hashlib
+import logging
+import math
+import threading
+import time
+
+from utils.config import get_section
+from utils.db import get_db_connection
+
+logger = logging.getLogger(__name__)
+
+# Rows re-read below the highest id seen, so a revocation whose INSERT
+# committed after a later id was already polled is still picked up
+LOOKBACK_IDS = 100
+
+INSERT_REVOCATION = "INSERT INTO token_revocations (kind, subject, revoked_at, expires_at) VALUES (%s, %s, %s, %s)"
+SELECT_REVOCATIONS = """
+    SELECT id, kind, subject, revoked_at, expires_at
+    FROM token_revocations
+    WHERE id > %s
+    ORDER BY id
+    LIMIT %s
+"""
+PURGE_REVOCATIONS = "DELETE FROM token_revocations WHERE expires_at < %s LIMIT %s"
+
+_store = None
+_store_lock = threading.Lock()
+
+
+class BloomFilter:
+    """Fixed-size bloom filter over strings.
+
+    Sized for ``capacity`` items at ``error_rate`` false positives; the
+    positions of an item come from one blake2b digest by double hashing, so
+    a lookup costs one hash and ``hashes`` bit tests whatever the size.
+    Items cannot be removed; RevocationStore rebuilds the filter instead.
+    """
+
+    def __init__(self, capacity=100000, error_rate=0.001):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class RevocationStore:
+    """Revoked token ids and per-user revocation times, checked without touching MySQL.
+
+    A token is revoked if its ``jti`` was revoked (logout) or if it was
+    issued (``iat``) at or before its user's revocation time (blocked user,
+    password reset). Token ids sit in an exact {jti: exp} map fronted by a
+    bloom filter, so the common case, a token nobody revoked, is answered
+    by the filter alone; entries are dropped once the token would have
+    expired anyway. Revocations are written to the token_revocations table
+    and a daemon thread polls it every ``poll_interval`` seconds, which is
+    how revocations made by other workers arrive here.
+    """
+
+    def __init__(self, capacity=100000, error_rate=0.001, poll_interval=2,
+                 max_token_lifetime=7 * 86400, chunk_size=1000):
+        if chunk_size <= LOOKBACK_IDS:
+            raise ValueError(f"chunk_size must be larger than {LOOKBACK_IDS}")
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.poll_interval = poll_interval
+        self.max_token_lifetime = max_token_lifetime
+        self.chunk_size = chunk_size
+        self.rejected = 0
+        self.bloom_negatives = 0
+        self._tokens = {}  # jti -> expires_at
+        self._users = {}   # username -> (revoked_at, expires_at)
+        self._bloom = BloomFilter(capacity, error_rate)
+        self._last_id = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='token-revocations', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def is_revoked(self, claims):
+        jti = claims.get('jti')
+        if jti is not None:
+            if jti not in self._bloom:
+                self.bloom_negatives += 1
+            elif self._tokens.get(jti, 0) > time.time():
+                self.rejected += 1
+                return True
+        revoked = self._users.get(claims.get('username'))
+        # Tokens from before iat was added count as issued at 0
+        if revoked is not None and claims.get('iat', 0) <= revoked[0]:
+            self.rejected += 1
+            return True
+        return False
+
+    def revoke_token(self, claims):
+        """Revokes one token until its exp; tokens without a jti can only be revoked per user."""
+        jti = claims.get('jti')
+        if jti is None:
+            return False
+        revoked_at = time.time()
+        expires_at = claims.get('exp') or revoked_at + self.max_token_lifetime
+        self._insert('token', jti, revoked_at, expires_at)
+        self._add('token', jti, revoked_at, expires_at)
+        return True
+
+    def revoke_user(self, username):
+        """Revokes every token of username issued up to now."""
+        revoked_at = time.time()
+        expires_at = revoked_at + self.max_token_lifetime
+        self._insert('user', username, revoked_at, expires_at)
+        self._add('user', username, revoked_at, expires_at)
+
+    def revoke_users(self, usernames):
+        """revoke_user for many users with one multi-row INSERT."""
+        revoked_at = time.time()
+        expires_at = revoked_at + self.max_token_lifetime
+        rows = [('user', username, revoked_at, expires_at) for username in usernames]
+        if not rows:
+            return
+        with get_db_connection() as db, db.cursor() as cursor:
+            cursor.executemany(INSERT_REVOCATION, rows)
+            db.commit()
+        for row in rows:
+            self._add(*row)
+
+    def _add(self, kind, subject, revoked_at, expires_at):
+        with self._lock:
+            if kind == 'token':
+                self._tokens[subject] = expires_at
+                self._bloom.add(subject)
+            elif revoked_at > self._users.get(subject, (0, 0))[0]:
+                self._users[subject] = (revoked_at, expires_at)
+
+    def _insert(self, kind, subject, revoked_at, expires_at):
+        with get_db_connection() as db, db.cursor() as cursor:
+            cursor.execute(INSERT_REVOCATION, (kind, subject, revoked_at, expires_at))
+            db.commit()
+
+    def poll(self):
+        """Loads revocations written since the last poll, in key-ordered chunks; returns how many."""
+        loaded = 0
+        now = time.time()
+        while True:
+            with get_db_connection() as db, db.cursor() as cursor:
+                cursor.execute(SELECT_REVOCATIONS, (max(0, self._last_id - LOOKBACK_IDS), self.chunk_size))
+                rows = cursor.fetchall()
+            # Re-read rows are added again, which changes nothing
+            for row_id, kind, subject, revoked_at, expires_at in rows:
+                if expires_at > now:
+                    self._add(kind, subject, revoked_at, expires_at)
+                if row_id > self._last_id:
+                    self._last_id = row_id
+                    loaded += 1
+            if len(rows) < self.chunk_size:
+                return loaded
+
+    def prune(self):
+        """Drops entries past their expiry and rebuilds the bloom filter from what is left."""
+        now = time.time()
+        with self._lock:
+            tokens = {jti: exp for jti, exp in self._tokens.items() if exp > now}
+            users = {name: entry for name, entry in self._users.items() if entry[1] > now}
+            if len(tokens) == len(self._tokens) and len(users) == len(self._users):
+                return 0
+            dropped = len(self._tokens) - len(tokens) + len(self._users) - len(users)
+            bloom = BloomFilter(max(self.capacity, 2 * len(tokens)), self.error_rate)
+            for jti in tokens:
+                bloom.add(jti)
+            self._tokens, self._users, self._bloom = tokens, users, bloom
+        return dropped
+
+    def _run(self):
+        next_prune = time.monotonic() + 60
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                logger.error("Error loading token revocations: %s", e)
+            if time.monotonic() >= next_prune:
+                next_prune = time.monotonic() + 60
+                self.prune()
+            self._stop.wait(self.poll_interval)
+
+    def stats(self):
+        return {
+            'revoked_tokens': len(self._tokens),
+            'revoked_users': len(self._users),
+            'bloom_bits': self._bloom.size,
+            'bloom_hashes': self._bloom.hashes,
+            'bloom_negatives': self.bloom_negatives,
+            'rejected': self.rejected,
+            'last_id': self._last_id,
+        }
+
+
+def get_revocation_store():
+    """Returns the process-wide store configured from [revocation], starting its poller on first use."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                settings = get_section('revocation')
+                store = RevocationStore(
+                    capacity=settings.getint('capacity', 100000),
+                    error_rate=settings.getfloat('error_rate', 0.001),
+                    poll_interval=settings.getfloat('poll_interval', 2),
+                    max_token_lifetime=settings.getint('max_token_lifetime', 7 * 86400),
+                )
+                try:
+                    store.poll()  # load existing revocations before the first check
+                except Exception as e:
+                    logger.error("Error loading token revocations: %s", e)
+                store.start()
+                atexit.register(store.stop)
+                _store = store
+    return _store
+
+
+def purge_expired_revocations(chunk_size=1000):
+    """Scheduled job: deletes revocations whose tokens have all expired, a chunk at a time."""
+    deleted = 0
+    while True:
+        with get_db_connection() as db, db.cursor() as cursor:
+            cursor.execute(PURGE_REVOCATIONS, (time.time(), chunk_size))
+            count = cursor.rowcount
+            db.commit()
+        deleted += count
+        if count < chunk_size:
+            break
+    logger.info("Purged %d expired token revocations", deleted)
+    return deleted
@@ -0,0 +1,318 @@
+import atexit
+import datetime
+import heapq
+import logging
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import MySQLdb
+
+from utils.config import get_section
+from utils.db import get_db_connection, open_connection
+from utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+SELECT_LAST_SCHEDULED = "SELECT MAX(scheduled_for) FROM job_runs WHERE job_name = %s"
+
+job_duration = registry.histogram(
+    'wiman_job_duration_seconds', 'Duration of scheduled job runs.', ('job', 'outcome'))
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+class Job:
+    def __init__(self, name, func, interval, run_at_start=True, catch_up=True):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.run_at_start = run_at_start
+        self.catch_up = catch_up
+        self.running = False
+        self.runs = 0
+        self.failures = 0
+        self.last_run = None  # {'scheduled_for', 'duration_seconds', 'outcome', 'error'}
+
+
+class Scheduler:
+    """Runs registered jobs in exactly one process across all workers and hosts.
+
+    Every process starts a Scheduler, but only the one holding the MySQL
+    named lock ``lock_name`` (GET_LOCK on a dedicated connection) runs jobs;
+    the others retry the lock every ``heartbeat`` seconds and take over if
+    the leader's connection goes away. Each run is recorded in job_runs with
+    its duration and outcome. When a process becomes leader it reads the
+    last run of every job from job_runs: a job whose interval elapsed while
+    no one was leading is run once straight away (``catch_up``) instead of
+    waiting a full interval.
+    """
+
+    def __init__(self, lock_name='wiman:scheduler', heartbeat=10, workers=2, connect=open_connection):
+        self.lock_name = lock_name
+        self.heartbeat = heartbeat
+        self.is_leader = False
+        self.leader_since = None
+        self._connect = connect
+        self._lock_conn = None
+        self._jobs = {}
+        self._heap = []  # (next_run epoch, job name)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self._cond = threading.Condition()
+        self._stop = False
+        self._thread = None
+
+    def register(self, name, func, interval, run_at_start=True, catch_up=True):
+        """Adds a job run every ``interval`` seconds; registering a name twice replaces the job."""
+        if interval <= 0:
+            raise ValueError("Job interval must be positive")
+        with self._cond:
+            self._jobs[name] = Job(name, func, interval, run_at_start, catch_up)
+            self._heap = [entry for entry in self._heap if entry[1] != name]
+            heapq.heapify(self._heap)
+            if self.is_leader:
+                self._schedule_from_history(self._jobs[name])
+            self._cond.notify()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='scheduler', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5):
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._step_down()
+
+    # -- Leader election ------------------------------------------------------
+
+    def _try_acquire(self):
+        try:
+            conn = self._connect()
+        except MySQLdb.Error as e:
+            logger.warning("Scheduler could not connect to MySQL: %s", e)
+            return False
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT GET_LOCK(%s, 0)", (self.lock_name,))
+                acquired = cursor.fetchone()[0] == 1
+        except MySQLdb.Error as e:
+            logger.warning("Scheduler lock attempt failed: %s", e)
+            acquired = False
+        if not acquired:
+            conn.close()
+            return False
+        self._lock_conn = conn
+        self.is_leader = True
+        self.leader_since = time.time()
+        logger.info("This process (pid %s) is now the scheduler leader", os.getpid())
+        return True
+
+    def _still_leader(self):
+        """Checks the lock is still held by our session; a dropped connection has released it."""
+        try:
+            with self._lock_conn.cursor() as cursor:
+                cursor.execute("SELECT IS_USED_LOCK(%s) = CONNECTION_ID()", (self.lock_name,))
+                return cursor.fetchone()[0] == 1
+        except MySQLdb.Error as e:
+            logger.warning("Scheduler lost its lock connection: %s", e)
+            return False
+
+    def _step_down(self):
+        conn, self._lock_conn = self._lock_conn, None
+        if self.is_leader:
+            logger.info("This process (pid %s) is no longer the scheduler leader", os.getpid())
+        self.is_leader = False
+        self.leader_since = None
+        with self._cond:
+            self._heap = []
+        if conn is not None:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT RELEASE_LOCK(%s)", (self.lock_name,))
+            except MySQLdb.Error:
+                pass
+            try:
+                conn.close()
+            except MySQLdb.Error:
+                pass
+
+    # -- Scheduling -----------------------------------------------------------
+
+    def _last_scheduled(self, name):
+        with get_db_connection() as db, db.cursor() as cursor:
+            cursor.execute(SELECT_LAST_SCHEDULED, (name,))
+            row = cursor.fetchone()
+        if not row or row[0] is None:
+            return None
+        return row[0].replace(tzinfo=datetime.timezone.utc).timestamp()  # stored as UTC
+
+    def _schedule_from_history(self, job):
+        """Works out a new leader's first run of job from its last recorded run."""
+        now = time.time()
+        try:
+            last = self._last_scheduled(job.name)
+        except MySQLdb.Error as e:
+            logger.warning("Could not read the run history of %s: %s", job.name, e)
+            last = None
+
+        if last is None:
+            next_run = now if job.run_at_start else now + job.interval
+        else:
+            next_run = last + job.interval
+            if next_run < now and not job.catch_up:
+                # Skip the missed runs and stay on the job's original cadence
+                next_run += job.interval * ((now - next_run) // job.interval + 1)
+            elif next_run < now:
+                logger.info("Job %s missed its run %.0fs ago, catching up", job.name, now - next_run)
+        heapq.heappush(self._heap, (max(next_run, now), job.name))
+
+    def _run(self):
+        next_heartbeat = 0
+        while True:
+            with self._cond:
+                if self._stop:
+                    return
+            now = time.time()
+
+            if now >= next_heartbeat:
+                next_heartbeat = now + self.heartbeat
+                if self.is_leader and not self._still_leader():
+                    self._step_down()
+                if not self.is_leader and self._try_acquire():
+                    with self._cond:
+                        for job in self._jobs.values():
+                            self._schedule_from_history(job)
+
+            with self._cond:
+                while self._heap and self._heap[0][0] <= time.time():
+                    scheduled_for, name = heapq.heappop(self._heap)
+                    job = self._jobs.get(name)
+                    if job is None:
+                        continue
+                    next_run = scheduled_for + job.interval
+                    while next_run <= time.time():
+                        next_run += job.interval  # don't replay runs missed while this one was late
+                    heapq.heappush(self._heap, (next_run, name))
+                    if job.running:
+                        logger.warning("Job %s is still running, skipping the run due at %s", name, scheduled_for)
+                        continue
+                    job.running = True
+                    self._executor.submit(self._execute, job, scheduled_for)
+
+                wait = next_heartbeat - time.time()
+                if self._heap:
+                    wait = min(wait, self._heap[0][0] - time.time())
+                if not self._stop:
+                    self._cond.wait(max(0.0, wait))
+
+    # -- Running jobs ---------------------------------------------------------
+
+    def _execute(self, job, scheduled_for):
+        run_id = self._record_start(job.name, scheduled_for)
+        started = time.perf_counter()
+        outcome, error = 'success', None
+        try:
+            job.func()
+        except Exception as e:
+            outcome, error = 'failed', str(e)
+            job.failures += 1
+            logger.exception("Job %s failed", job.name)
+        finally:
+            duration = time.perf_counter() - started
+            job.running = False
+            job.runs += 1
+            job.last_run = {
+                'scheduled_for': scheduled_for,
+                'duration_seconds': round(duration, 3),
+                'outcome': outcome,
+                'error': error,
+            }
+            job_duration.observe(duration, job.name, outcome)
+            self._record_finish(run_id, duration, outcome, error)
+
+    def _record_start(self, name, scheduled_for):
+        try:
+            with get_db_connection() as db, db.cursor() as cursor:
+                cursor.execute(
+                    """
+                    INSERT INTO job_runs (job_name, scheduled_for, started_at, outcome, host, pid)
+                    VALUES (%s, %s, UTC_TIMESTAMP(3), 'running', %s, %s)
+                    """,
+                    (name, datetime.datetime.fromtimestamp(scheduled_for, datetime.timezone.utc)
+                     .replace(tzinfo=None), socket.gethostname(), os.getpid())
+                )
+                run_id = cursor.lastrowid
+                db.commit()
+            return run_id
+        except MySQLdb.Error as e:
+            logger.warning("Could not record the start of job %s: %s", name, e)
+            return None
+
+    def _record_finish(self, run_id, duration, outcome, error):
+        if run_id is None:
+            return
+        try:
+            with get_db_connection() as db, db.cursor() as cursor:
+                cursor.execute(
+                    """
+                    UPDATE job_runs
+                    SET finished_at = UTC_TIMESTAMP(3), duration_ms = %s, outcome = %s, error = %s
+                    WHERE id = %s
+                    """,
+                    (int(duration * 1000), outcome, error, run_id)
+                )
+                db.commit()
+        except MySQLdb.Error as e:
+            logger.warning("Could not record the outcome of job run %s: %s", run_id, e)
+
+    def stats(self):
+        with self._cond:
+            next_runs = {name: when for when, name in sorted(self._heap, reverse=True)}
+            jobs = {
+                name: {
+                    'interval_seconds': job.interval,
+                    'running': job.running,
+                    'runs': job.runs,
+                    'failures': job.failures,
+                    'next_run_in_seconds': round(next_runs[name] - time.time(), 3) if name in next_runs else None,
+                    'last_run': job.last_run,
+                }
+                for name, job in self._jobs.items()
+            }
+        return {
+            'leader': self.is_leader,
+            'leader_for_seconds': round(time.time() - self.leader_since, 1) if self.leader_since else None,
+            'pid': os.getpid(),
+            'jobs': jobs,
+        }
+
+
+def get_scheduler():
+    """Returns the process-wide scheduler configured from [scheduler], starting it on first use."""
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                settings = get_section('scheduler')
+                scheduler = Scheduler(
+                    lock_name=settings.get('lock_name', 'wiman:scheduler'),
+                    heartbeat=settings.getfloat('heartbeat_seconds', 10),
+                    workers=settings.getint('workers', 2),
+                )
+                scheduler.start()
+                atexit.register(scheduler.stop)
+                _scheduler = scheduler
+    return _scheduler
+
+
+def register_job(name, func, interval, run_at_start=True, catch_up=True):
+    """Registers a background job that runs once per interval across the whole deployment."""
+    get_scheduler().register(name, func, interval, run_at_start=run_at_start, catch_up=catch_up)
@@ -0,0 +1,414 @@
+import atexit
+import datetime
+import json
+import logging
+import math
+import queue
+import threading
+import time
+from collections import Counter
+
+from utils.config import get_section, request_threads
+from utils.db import get_db_connection
+
+logger = logging.getLogger(__name__)
+
+# Client kinds a heartbeat can come from
+PORTAL = 'portal'
+GATEWAY = 'gateway'
+
+# Plan bucket for users without an active subscription
+NO_PLAN = 'none'
+
+# Joined/left usernames sent per change event; the counts are always exact
+MAX_EVENT_NAMES = 100
+
+# Each user's id and the plan of their active subscription
+SELECT_PLANS = """
+    SELECT u.username, u.id, p.name
+    FROM users u
+    LEFT JOIN subscriptions s ON s.user_id = u.id AND s.status = 'active' AND s.expires_at > NOW()
+    LEFT JOIN plans p ON p.id = s.plan_id
+    WHERE u.username IN ({usernames})
+    ORDER BY s.expires_at
+"""
+# Rows changed after the (updated_at, session_key) watermark
+SELECT_CHANGED = """
+    SELECT session_key, username, plan, client, last_seen, updated_at
+    FROM active_sessions
+    WHERE updated_at > %s OR (updated_at = %s AND session_key > %s)
+    ORDER BY updated_at, session_key
+    LIMIT %s
+"""
+PURGE_SESSIONS = "DELETE FROM active_sessions WHERE last_seen < %s LIMIT %s"
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+class TimingWheel:
+    """Hashed timing wheel for deadlines at most ``horizon`` seconds ahead.
+
+    Keys sit in one of ceil(horizon / tick) + 1 slots by deadline, so
+    scheduling, moving and cancelling a key are O(1), and advance() only
+    looks at the slots whose tick has passed. Deadlines are rounded up to
+    the next tick.
+    """
+
+    def __init__(self, horizon, tick=1.0, now=None):
+        self.tick = tick
+        self.size = int(math.ceil(horizon / tick)) + 1
+        self._slots = [set() for _ in range(self.size)]
+        self._current = int((time.time() if now is None else now) // tick)
+
+    def _tick_of(self, deadline):
+        # Never behind the current tick (that slot is swept next), never a full turn ahead
+        return min(max(int(math.ceil(deadline / self.tick)), self._current + 1), self._current + self.size - 1)
+
+    def schedule(self, key, deadline, old_tick=None):
+        """Places key at deadline, taking it out of old_tick's slot; returns its new tick."""
+        if old_tick is not None:
+            self._slots[old_tick % self.size].discard(key)
+        tick = self._tick_of(deadline)
+        self._slots[tick % self.size].add(key)
+        return tick
+
+    def cancel(self, key, tick):
+        self._slots[tick % self.size].discard(key)
+
+    def advance(self, now):
+        """Returns the keys whose deadline is at or before now, removing them."""
+        target = int(now // self.tick)
+        expired = []
+        # After a long pause only one turn needs sweeping: every slot is covered once
+        start = max(self._current + 1, target - self.size + 1)
+        for tick in range(start, target + 1):
+            slot = self._slots[tick % self.size]
+            if slot:
+                expired.extend(slot)
+                slot.clear()
+        self._current = max(self._current, target)
+        return expired
+
+
+class Session:
+    __slots__ = ('username', 'client', 'last_seen', 'tick')
+
+    def __init__(self, username, client, last_seen, tick):
+        self.username = username
+        self.client = client
+        self.last_seen = last_seen
+        self.tick = tick
+
+
+class SessionRegistry:
+    """Live view of who is online, fed by heartbeats from portal and gateway clients.
+
+    heartbeat() only records the latest beat of a session in memory. Every
+    ``flush_interval`` seconds a background thread writes the beats to
+    active_sessions in one multi-row upsert, then reads back every row
+    changed since its last read, from any worker, and applies them here;
+    so every worker ends up with the same sessions, a flush interval or
+    two behind. A session is online until ``timeout`` seconds after its
+    last beat; expiry is driven by a timing wheel, so it costs nothing per
+    idle session. Online sessions, users and users per plan and client
+    are counted as sessions come and go, so reading them is O(1).
+    Subscribers (the admin SSE stream) get an event after each cycle that
+    changed something; at most ``max_subscribers`` at a time.
+    """
+
+    def __init__(self, timeout=90, tick=1.0, flush_interval=2, lookback=2, chunk_size=1000, plans_ttl=60,
+                 max_subscribers=2):
+        self.timeout = timeout
+        self.max_subscribers = max_subscribers
+        self.flush_interval = flush_interval
+        self.lookback = lookback
+        self.chunk_size = chunk_size
+        self.plans_ttl = plans_ttl
+        self.version = 0
+        self.beats = 0
+        self.flush_failures = 0
+        self._wheel = TimingWheel(timeout, tick)
+        self._sessions = {}          # session key -> Session
+        self._users = {}             # username -> [number of sessions, plan]
+        self._by_plan = Counter()    # plan -> online users
+        self._by_client = Counter()  # client kind -> online sessions
+        self._joined = []
+        self._left = []
+        self._beats = {}             # session key -> (username, client, last_seen), waiting to be written
+        self._plans = {}             # username -> (user_id, plan, loaded_at)
+        self._watermark = None       # (updated_at, session_key) of the last row read
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='session-registry', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    # -- Heartbeats -------------------------------------------------------------
+
+    def heartbeat(self, session_key, username, client, ended=False):
+        """Records a beat for the session; ``ended`` takes it offline straight away instead."""
+        self.heartbeats([(session_key, username, client, ended)])
+
+    def heartbeats(self, beats):
+        """heartbeat() for many (session_key, username, client, ended) at once."""
+        now = time.time()
+        with self._lock:
+            for session_key, username, client, ended in beats:
+                self._beats[session_key] = (username, client, 0.0 if ended else now)
+            self.beats += len(beats)
+
+    def _load_plans(self, usernames):
+        placeholders = ', '.join(['%s'] * len(usernames))
+        with get_db_connection() as db, db.cursor() as cursor:
+            cursor.execute(SELECT_PLANS.format(usernames=placeholders), list(usernames))
+            rows = cursor.fetchall()
+        now = time.monotonic()
+        # Ordered by expiry, so the subscription running longest wins
+        return {username: (user_id, plan or NO_PLAN, now) for username, user_id, plan in rows}
+
+    def flush(self):
+        """Writes the beats received since the last flush; returns how many were written."""
+        with self._lock:
+            beats, self._beats = self._beats, {}
+        if not beats:
+            return 0
+        try:
+            now = time.monotonic()
+            stale = {username for username, _, _ in beats.values()
+                     if username not in self._plans or now - self._plans[username][2] > self.plans_ttl}
+            if stale:
+                self._plans.update(self._load_plans(stale))
+            rows = []
+            for key, (username, client, last_seen) in beats.items():
+                if username in self._plans:  # beats for deleted users are dropped
+                    user_id, plan, _ = self._plans[username]
+                    rows.append((key, username, user_id, plan, client, last_seen))
+            if rows:
+                with get_db_connection() as db, db.cursor() as cursor:
+                    cursor.executemany(
+                        """
+                        INSERT INTO active_sessions (session_key, username, user_id, plan, client, last_seen)
+                        VALUES (%s, %s, %s, %s, %s, %s)
+                        ON DUPLICATE KEY UPDATE
+                            plan = VALUES(plan),
+                            last_seen = IF(VALUES(last_seen) = 0, 0, GREATEST(last_seen, VALUES(last_seen)))
+                        """,
+                        rows
+                    )
+                    db.commit()
+        except Exception:
+            with self._lock:
+                for key, beat in beats.items():
+                    self._beats.setdefault(key, beat)  # a newer beat that arrived meanwhile wins
+            raise
+        return len(rows)
+
+    # -- Reading changes --------------------------------------------------------
+
+    def poll(self):
+        """Applies rows changed since the last poll, a chunk at a time; returns how many were read."""
+        if self._watermark is None:
+            with get_db_connection() as db, db.cursor() as cursor:
+                cursor.execute("SELECT NOW(3) - INTERVAL %s SECOND", (self.timeout,))
+                self._watermark = (cursor.fetchone()[0], '')
+        # Rows committed late can carry an updated_at just behind the watermark; they are read again
+        updated_at, key = self._watermark[0] - datetime.timedelta(seconds=self.lookback), ''
+        read = 0
+        while True:
+            with get_db_connection() as db, db.cursor() as cursor:
+                cursor.execute(SELECT_CHANGED, (updated_at, updated_at, key, self.chunk_size))
+                rows = cursor.fetchall()
+            with self._lock:
+                for row in rows:
+                    self._apply(*row[:5])
+            read += len(rows)
+            if rows:
+                updated_at, key = rows[-1][5], rows[-1][0]
+                self._watermark = max(self._watermark, (updated_at, key))
+            if len(rows) < self.chunk_size:
+                return read
+
+    def _apply(self, key, username, plan, client, last_seen):
+        deadline = last_seen + self.timeout
+        session = self._sessions.get(key)
+        if deadline <= time.time():
+            if session is not None:
+                self._wheel.cancel(key, session.tick)
+                self._remove(key)
+            return
+        if session is None:
+            self._sessions[key] = Session(username, client, last_seen, self._wheel.schedule(key, deadline))
+            self._count(username, plan, client, 1)
+        elif last_seen > session.last_seen:
+            session.last_seen = last_seen
+            session.tick = self._wheel.schedule(key, deadline, session.tick)
+        user = self._users[username]
+        if user[1] != plan:
+            # Subscribed to another plan since their first session came online
+            self._by_plan[user[1]] -= 1
+            self._by_plan[plan] += 1
+            user[1] = plan
+            self.version += 1
+
+    def _count(self, username, plan, client, change):
+        self._by_client[client] += change
+        user = self._users.get(username)
+        if user is None:
+            user = self._users[username] = [0, plan]
+            self._by_plan[plan] += 1
+            self._joined.append(username)
+        user[0] += change
+        if not user[0]:
+            del self._users[username]
+            self._by_plan[user[1]] -= 1
+            self._left.append(username)
+        self.version += 1
+
+    def _remove(self, key):
+        session = self._sessions.pop(key, None)
+        if session is not None:
+            self._count(session.username, None, session.client, -1)
+
+    def expire(self):
+        """Takes sessions whose last beat is older than ``timeout`` offline; returns how many."""
+        with self._lock:
+            expired = self._wheel.advance(time.time())
+            for key in expired:
+                self._remove(key)
+        return len(expired)
+
+    # -- Reading the registry ---------------------------------------------------
+
+    def counts(self):
+        with self._lock:
+            return {
+                'sessions': len(self._sessions),
+                'users': len(self._users),
+                'by_plan': {plan: count for plan, count in self._by_plan.items() if count},
+                'by_client': {client: count for client, count in self._by_client.items() if count},
+                'version': self.version,
+            }
+
+    def subscribe(self, maxsize=100):
+        """Returns a queue that receives a change event (a dict) after every cycle that changed the counts.
+
+        Returns None if ``max_subscribers`` are already subscribed.
+        """
+        subscriber = queue.Queue(maxsize=maxsize)
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                return None
+            self._subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+
+    def _publish(self, last_version):
+        with self._lock:
+            if self.version == last_version:
+                return last_version
+            joined, left = self._joined, self._left
+            self._joined, self._left = [], []
+            subscribers = list(self._subscribers)
+        event = dict(self.counts(), joined=joined[:MAX_EVENT_NAMES], left=left[:MAX_EVENT_NAMES],
+                     truncated=len(joined) > MAX_EVENT_NAMES or len(left) > MAX_EVENT_NAMES)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                pass  # a stalled reader misses events; each carries the full counts anyway
+        return event['version']
+
+    def _prune_plans(self):
+        """Forgets cached plans of users not heard from lately; they are reloaded on their next beat."""
+        now = time.monotonic()
+        self._plans = {name: entry for name, entry in self._plans.items() if now - entry[2] <= self.plans_ttl}
+
+    def _run(self):
+        published = self.version
+        next_prune = time.monotonic() + 60
+        while not self._stop.is_set():
+            for step in (self.flush, self.poll):
+                try:
+                    step()
+                except Exception as e:
+                    self.flush_failures += 1
+                    logger.error("Session registry %s failed: %s", step.__name__, e)
+            self.expire()
+            published = self._publish(published)
+            if time.monotonic() >= next_prune:
+                next_prune = time.monotonic() + 60
+                self._prune_plans()
+            self._stop.wait(self.flush_interval)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sessions': len(self._sessions),
+                'waiting_beats': len(self._beats),
+                'beats': self.beats,
+                'subscribers': len(self._subscribers),
+                'flush_failures': self.flush_failures,
+                'version': self.version,
+            }
+
+
+def format_event(event, name='change'):
+    """One server-sent event carrying event as JSON."""
+    return f"event: {name}\ndata: {json.dumps(event)}\n\n"
+
+
+def get_session_registry():
+    """Returns the process-wide registry configured from [sessions], starting its thread on first use.
+
+    Each subscriber is an open admin stream holding a request thread, so
+    max_streams defaults to a quarter of the worker's request threads.
+    """
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                settings = get_section('sessions')
+                registry = SessionRegistry(
+                    timeout=settings.getfloat('timeout', 90),
+                    tick=settings.getfloat('tick', 1),
+                    flush_interval=settings.getfloat('flush_interval', 2),
+                    lookback=settings.getfloat('lookback', 2),
+                    chunk_size=settings.getint('chunk_size', 1000),
+                    plans_ttl=settings.getfloat('plans_ttl', 60),
+                    max_subscribers=settings.getint('max_streams', 0) or max(1, request_threads() // 4),
+                )
+                registry.start()
+                atexit.register(registry.stop)
+                _registry = registry
+    return _registry
+
+
+def purge_stale_sessions(chunk_size=1000):
+    """Scheduled job: deletes active_sessions rows long past their last beat, a chunk at a time."""
+    cutoff = time.time() - 2 * get_section('sessions').getfloat('timeout', 90)
+    deleted = 0
+    while True:
+        with get_db_connection() as db, db.cursor() as cursor:
+            cursor.execute(PURGE_SESSIONS, (cutoff, chunk_size))
+            count = cursor.rowcount
+            db.commit()
+        deleted += count
+        if count < chunk_size:
+            break
+    logger.info("Purged %d stale sessions", deleted)
+    return deleted
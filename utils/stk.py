@@ -0,0 +1,294 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+import uuid
+
+from utils.cache import TTLCache
+from utils.config import get_section, request_threads
+from utils.daraja import get_daraja_client, DarajaError
+from utils.db import get_db_connection, get_pooled_connection
+from utils.payments import QueueFullError
+
+logger = logging.getLogger(__name__)
+
+# Checkout states, as stored in stk_checkouts.status
+QUEUED = 'queued'
+PENDING = 'pending'
+PAID = 'paid'
+CANCELLED = 'cancelled'
+FAILED = 'failed'
+FINAL_STATES = (PAID, CANCELLED, FAILED)
+
+# Callback ResultCodes meaning the customer dismissed the prompt or never answered it
+CANCELLED_CODES = (1032, 1037)
+
+# Fields of a checkout returned by the status endpoint
+PUBLIC_FIELDS = ('handle', 'status', 'amount', 'phone_number', 'checkout_request_id',
+                 'result_code', 'result_desc', 'receipt_number')
+
+_COLUMNS = ('handle', 'user_id', 'phone_number', 'amount', 'status', 'checkout_request_id',
+            'merchant_request_id', 'result_code', 'result_desc', 'receipt_number')
+
+SELECT_CHECKOUT = f"SELECT {', '.join(_COLUMNS)} FROM stk_checkouts WHERE handle = %s"
+UPDATE_CHECKOUT = "UPDATE stk_checkouts SET {assignments} WHERE handle = %s"
+# A callback settles its checkout only while it is still open
+SETTLE_CHECKOUT = """
+    UPDATE stk_checkouts
+    SET status = %s, result_code = %s, result_desc = %s, receipt_number = %s
+    WHERE checkout_request_id = %s AND status IN (%s, %s)
+"""
+
+_orchestrator = None
+_orchestrator_lock = threading.Lock()
+
+
+class StkOrchestrator:
+    """Runs STK pushes on background threads and tracks each checkout until its callback.
+
+    submit() records the checkout in stk_checkouts, queues it and returns a
+    handle straight away; ``workers`` threads make the Daraja calls, so a
+    request thread never waits on Safaricom. The state of every checkout is
+    kept in memory by handle. Pushes and callbacks handled by this process
+    update it directly and wake anyone waiting in wait(); changes made by
+    other workers (the callback can land on any of them) are picked up from
+    the database, at most once per ``poll_interval`` per checkout. A callback
+    that reaches another worker before this one has saved the push reply
+    leaves the row pending until the reconciliation job settles it.
+    """
+
+    def __init__(self, workers=8, max_queue=1000, state_ttl=3600, maxsize=100000, poll_interval=1.0,
+                 max_waiters=2, client_factory=get_daraja_client):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.max_waiters = max_waiters
+        self.waiting = 0
+        self.pushed = 0
+        self.push_failures = 0
+        self.callbacks = 0
+        self._client_factory = client_factory
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._states = TTLCache(maxsize=maxsize, ttl=state_ttl)        # handle -> state dict
+        self._by_checkout = TTLCache(maxsize=maxsize, ttl=state_ttl)   # CheckoutRequestID -> handle
+        self._early = TTLCache(maxsize=10000, ttl=600)                 # callbacks that beat their push's reply
+        self._cond = threading.Condition()
+        self._callback_lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        if self._threads:
+            return
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'stk-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=10):
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def submit(self, user_id, phone_number, amount):
+        """Records a checkout and queues its push; returns its state. Raises QueueFullError when busy."""
+        if self._queue.full():
+            raise QueueFullError("STK push queue is full")
+        state = {
+            'handle': uuid.uuid4().hex, 'user_id': user_id, 'phone_number': phone_number, 'amount': amount,
+            'status': QUEUED, 'checkout_request_id': None, 'merchant_request_id': None,
+            'result_code': None, 'result_desc': None, 'receipt_number': None, 'checked_at': time.monotonic(),
+        }
+        with get_db_connection() as db, db.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO stk_checkouts (handle, user_id, phone_number, amount, status) VALUES (%s, %s, %s, %s, %s)",
+                (state['handle'], user_id, phone_number, amount, QUEUED)
+            )
+            db.commit()
+        self._states.set(state['handle'], state)
+        try:
+            self._queue.put_nowait(state['handle'])
+        except queue.Full:
+            self._update(state['handle'], status=FAILED, result_desc="Push queue was full")
+            raise QueueFullError("STK push queue is full")
+        return dict(state)
+
+    def _run(self):
+        while True:
+            handle = self._queue.get()
+            if handle is None:
+                return
+            try:
+                self._push(handle)
+            except Exception as e:
+                logger.error("STK push %s failed unexpectedly: %s", handle, e)
+                self._update(handle, status=FAILED, result_desc="Internal error")
+
+    def _push(self, handle):
+        state = self._states.get(handle)
+        if state is None:
+            return
+        try:
+            response = self._client_factory().stk_push(state['phone_number'], state['amount'])
+        except DarajaError as e:
+            self.push_failures += 1
+            logger.error("STK push %s failed: %s", handle, e)
+            self._update(handle, status=FAILED, result_desc=str(e))
+            return
+
+        checkout_request_id = response.get('CheckoutRequestID')
+        if str(response.get('ResponseCode')) != '0' or not checkout_request_id:
+            self.push_failures += 1
+            description = response.get('errorMessage') or response.get('ResponseDescription') or "Push rejected"
+            logger.warning("STK push %s rejected: %s", handle, description)
+            self._update(handle, status=FAILED, result_desc=description)
+            return
+
+        self.pushed += 1
+        with self._callback_lock:
+            self._update(handle, status=PENDING, checkout_request_id=checkout_request_id,
+                         merchant_request_id=response.get('MerchantRequestID'),
+                         result_desc=response.get('CustomerMessage'))
+            self._by_checkout.set(checkout_request_id, handle)
+            early = self._early.pop(checkout_request_id)
+        if early is not None:
+            self.on_callback(early)
+
+    def _update(self, handle, **fields):
+        """Writes fields to the checkout's row and its in-memory state, then wakes waiters."""
+        try:
+            assignments = ', '.join(f"{column} = %s" for column in fields)
+            with get_db_connection() as db, db.cursor() as cursor:
+                cursor.execute(UPDATE_CHECKOUT.format(assignments=assignments), list(fields.values()) + [handle])
+                db.commit()
+        except Exception as e:
+            logger.error("Could not save the state of checkout %s: %s", handle, e)
+        with self._cond:
+            state = self._states.get(handle)
+            if state is not None:
+                state.update(fields)
+            self._cond.notify_all()
+
+    def on_callback(self, callback):
+        """Applies a parsed STK callback to its checkout. Safaricom retries change nothing."""
+        self.callbacks += 1
+        checkout_request_id = callback['checkout_request_id']
+        if callback['result_code'] == 0:
+            status = PAID
+        elif callback['result_code'] in CANCELLED_CODES:
+            status = CANCELLED
+        else:
+            status = FAILED
+        fields = {'status': status, 'result_code': callback['result_code'],
+                  'result_desc': callback['result_desc'], 'receipt_number': callback['receipt_number']}
+
+        # Serialized with _push storing a CheckoutRequestID, so a callback that
+        # arrives before the push reply has been saved is parked, not lost
+        with self._callback_lock:
+            with get_db_connection() as db, db.cursor() as cursor:
+                cursor.execute(
+                    SETTLE_CHECKOUT,
+                    (status, fields['result_code'], fields['result_desc'], fields['receipt_number'],
+                     checkout_request_id, QUEUED, PENDING)
+                )
+                updated = cursor.rowcount
+                db.commit()
+            handle = self._by_checkout.get(checkout_request_id)
+            if handle is None and not updated:
+                self._early.set(checkout_request_id, callback)
+
+        if handle is not None:
+            with self._cond:
+                state = self._states.get(handle)
+                if state is not None and state['status'] not in FINAL_STATES:
+                    state.update(fields)
+                self._cond.notify_all()
+
+    def _load(self, handle):
+        # Not the request's connection: wait() calls this between sleeps, and
+        # must not keep a pool connection checked out while it sleeps
+        with get_pooled_connection() as db, db.cursor() as cursor:
+            cursor.execute(SELECT_CHECKOUT, (handle,))
+            row = cursor.fetchone()
+        return dict(zip(_COLUMNS, row)) if row else None
+
+    def get(self, handle):
+        """Returns a copy of the checkout's state, or None if there is no such checkout."""
+        state = self._states.get(handle)
+        if state is not None and (state['status'] in FINAL_STATES
+                                  or time.monotonic() - state['checked_at'] < self.poll_interval):
+            return dict(state)
+        stored = self._load(handle)
+        if stored is None:
+            return None
+        stored['checked_at'] = time.monotonic()
+        with self._cond:
+            if state is None:
+                self._states.set(handle, stored)
+            elif state['status'] not in FINAL_STATES:
+                state.update(stored)
+            return dict(self._states.get(handle) or stored)
+
+    def wait(self, handle, known_status=None, timeout=0):
+        """Long-poll: returns the state once its status differs from known_status, or after timeout seconds.
+
+        Every waiter holds a request thread, so at most ``max_waiters`` wait
+        at once; past that QueueFullError is raised and the client polls again.
+        """
+        with self._cond:
+            if self.waiting >= self.max_waiters:
+                raise QueueFullError("Too many status requests waiting")
+            self.waiting += 1
+        try:
+            deadline = time.monotonic() + timeout
+            while True:
+                state = self.get(handle)
+                remaining = deadline - time.monotonic()
+                if (state is None or state['status'] != known_status or state['status'] in FINAL_STATES
+                        or remaining <= 0):
+                    return state
+                with self._cond:
+                    self._cond.wait(min(remaining, self.poll_interval))
+        finally:
+            with self._cond:
+                self.waiting -= 1
+
+    def stats(self):
+        return {
+            'queued': self._queue.qsize(),
+            'tracked': len(self._states),
+            'waiting': self.waiting,
+            'pushed': self.pushed,
+            'push_failures': self.push_failures,
+            'callbacks': self.callbacks,
+            'early_callbacks': len(self._early),
+        }
+
+
+def public_state(state):
+    return {field: state.get(field) for field in PUBLIC_FIELDS}
+
+
+def get_stk_orchestrator():
+    """Returns the process-wide orchestrator configured from [stk], starting its workers on first use.
+
+    max_waiters defaults to a quarter of the worker's request threads, so
+    long-polls can never take every thread.
+    """
+    global _orchestrator
+    if _orchestrator is None:
+        with _orchestrator_lock:
+            if _orchestrator is None:
+                settings = get_section('stk')
+                orchestrator = StkOrchestrator(
+                    workers=settings.getint('workers', 8),
+                    max_queue=settings.getint('max_queue', 1000),
+                    state_ttl=settings.getint('state_ttl', 3600),
+                    poll_interval=settings.getfloat('poll_interval', 1.0),
+                    max_waiters=settings.getint('max_waiters', 0) or max(1, request_threads() // 4),
+                )
+                orchestrator.start()
+                atexit.register(orchestrator.stop)
+                _orchestrator = orchestrator
+    return _orchestrator
@@ -1,47 +1,302 @@
+import atexit
+import heapq
 import logging
+import threading
+import time
+from collections import deque
+
+from utils.config import get_section
 from utils.db import get_db_connection
+from utils.entitlements import get_entitlement_index
+
+_settings = get_section('expiry')
+SWEEP_CHUNK_SIZE = _settings.getint('chunk_size', 500)
+HORIZON_SECONDS = _settings.getint('horizon_minutes', 30) * 60
+
+# Catch-up sweep: each select is paged by (last_id, limit); its update repeats the predicate
+SELECT_LAPSED = """
+    SELECT id, user_id, TIMESTAMPDIFF(SECOND, expires_at, NOW())
+    FROM subscriptions
+    WHERE id > %s AND status = 'active' AND expires_at <= NOW()
+    ORDER BY id
+    LIMIT %s
+"""
+EXPIRE_LAPSED = """
+    UPDATE subscriptions
+    SET status = 'expired'
+    WHERE id IN ({ids}) AND status = 'active' AND expires_at <= NOW()
+"""
+SELECT_PENDING_PAST_END = """
+    SELECT id, user_id
+    FROM subscriptions
+    WHERE id > %s AND end_date < NOW() AND (status IS NULL OR status = 'pending')
+    ORDER BY id
+    LIMIT %s
+"""
+EXPIRE_PENDING_PAST_END = """
+    UPDATE subscriptions
+    SET status = 'expired'
+    WHERE id IN ({ids}) AND end_date < NOW() AND (status IS NULL OR status = 'pending')
+"""
+SELECT_UNDATED = """
+    SELECT id
+    FROM users_subscriptions
+    WHERE id > %s AND status = 'active' AND (start_at IS NULL OR expires_at IS NULL)
+    ORDER BY id
+    LIMIT %s
+"""
+SET_DATES = """
+    UPDATE users_subscriptions
+    SET start_at = NOW(),
+        expires_at = DATE_ADD(NOW(), INTERVAL duration_days DAY)
+    WHERE id IN ({ids}) AND status = 'active' AND (start_at IS NULL OR expires_at IS NULL)
+"""
+# ExpiryEngine: deadlines within the horizon, and the due rows still to expire
+SELECT_UPCOMING = """
+    SELECT id, user_id, TIMESTAMPDIFF(MICROSECOND, NOW(), expires_at) / 1000000
+    FROM subscriptions
+    WHERE id > %s AND status = 'active'
+    AND expires_at > NOW() AND expires_at <= NOW() + INTERVAL %s SECOND
+    ORDER BY id
+    LIMIT %s
+"""
+SELECT_DUE = """
+    SELECT id FROM subscriptions
+    WHERE id IN ({ids}) AND status = 'active' AND expires_at <= NOW()
+    FOR UPDATE
+"""
+
+_engine = None
+_engine_lock = threading.Lock()
 
-def expired_subscriptions():
-    """Marks expired subscriptions as 'expired' and updates start/end dates for active ones."""
-    try:
-        db = get_db_connection()
-        if not db:
-            logging.error("Database connection failed")
-            return {'error': 'Database connection failed'}
-
-        with db.cursor() as cursor:
-            # Log when the function starts
-            logging.info("Running expired_subscriptions job...")
-
-            # Mark expired subscriptions
-            expire_query = """
-                UPDATE subscriptions 
-                SET status = 'expired' 
-                WHERE end_date < NOW() 
-                AND (status IS NULL OR status = 'pending');
-            """
-            cursor.execute(expire_query)
-            expired_count = cursor.rowcount  # Get affected rows
-
-            # Update start_at and expires_at for active subscriptions
-            update_dates_query = """
-                UPDATE users_subscriptions 
-                SET start_at = NOW(), 
-                    expires_at = DATE_ADD(NOW(), INTERVAL duration_days DAY) 
-                WHERE status = 'active' 
-                AND (start_at IS NULL OR expires_at IS NULL);
-            """
-            cursor.execute(update_dates_query)
-            updated_count = cursor.rowcount  # Get affected rows
 
+def _sweep(select_query, update_query, chunk_size, on_chunk=None):
+    """Applies update_query to the ids returned by select_query, one key-ordered chunk at a time.
+
+    select_query must take (last_id, limit) and return rows whose first
+    column is the primary key in ascending order; update_query takes the
+    chunk's ids and must repeat the select's predicate, so rows that changed
+    in between are left alone. Each chunk commits on its own, keeping row
+    locks short, and is then handed to ``on_chunk`` and dropped, so memory
+    stays at one chunk however large the backlog. Returns the affected count.
+    """
+    last_id = 0
+    affected = 0
+    while True:
+        with get_db_connection() as db, db.cursor() as cursor:
+            cursor.execute(select_query, (last_id, chunk_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            ids = [row[0] for row in rows]
+            placeholders = ', '.join(['%s'] * len(ids))
+            cursor.execute(update_query.format(ids=placeholders), ids)
+            affected += cursor.rowcount
             db.commit()
+        if on_chunk is not None:
+            on_chunk(rows)
+        last_id = ids[-1]
+        if len(rows) < chunk_size:
+            break
+    return affected
+
+
+def expired_subscriptions(chunk_size=None):
+    """Marks expired subscriptions as 'expired' and updates start/end dates for active ones.
+
+    This is the catch-up sweep behind the ExpiryEngine: it walks the tables in
+    primary-key chunks so it never holds long row locks, and it picks up
+    anything the engine missed (restarts, rows written by other processes).
+    """
+    chunk_size = chunk_size or SWEEP_CHUNK_SIZE
+    entitlements = get_entitlement_index()
+    max_lateness = 0
+
+    def on_lapsed(rows):
+        nonlocal max_lateness
+        for subscription_id, user_id, lateness in rows:
+            entitlements.invalidate(user_id)
+            max_lateness = max(max_lateness, lateness)
+            logging.debug("Subscription %s of user %s expired %ss late", subscription_id, user_id, lateness)
+
+    def on_pending(rows):
+        for _, user_id in rows:
+            entitlements.invalidate(user_id)
+
+    try:
+        logging.info("Running expired_subscriptions job...")
+
+        # Active subscriptions past their expires_at
+        lapsed_count = _sweep(SELECT_LAPSED, EXPIRE_LAPSED, chunk_size, on_lapsed)
+
+        # Pending subscriptions past their end_date
+        pending_count = _sweep(SELECT_PENDING_PAST_END, EXPIRE_PENDING_PAST_END, chunk_size, on_pending)
+
+        # Update start_at and expires_at for active subscriptions
+        updated_count = _sweep(SELECT_UNDATED, SET_DATES, chunk_size)
+
+        expired_count = lapsed_count + pending_count
+        logging.info("Subscriptions expired: %d (max lateness %ss), Dates updated: %d", expired_count, max_lateness, updated_count)
+        return {
+            'message': f"{expired_count} subscriptions expired, {updated_count} updated",
+            'expired': expired_count,
+            'updated': updated_count,
+            'max_lateness_seconds': max_lateness,
+        }
 
-        logging.info(f"Subscriptions expired: {expired_count}, Dates updated: {updated_count}")
-        return {'message': f"{expired_count} subscriptions expired, {updated_count} updated"}
-        
     except Exception as e:
-        logging.error(f"Error in expired_subscriptions: {e}")
+        logging.error("Error in expired_subscriptions: %s", e)
         return {'error': str(e)}
-    finally:
-        if db:
-            db.close()
+
+
+class ExpiryEngine:
+    """Expires active subscriptions within seconds of their expires_at.
+
+    Upcoming deadlines sit in a min-heap; one daemon thread sleeps until the
+    earliest is due and expires everything that has come due in one small
+    UPDATE by primary key. Deadlines are loaded for the next ``horizon``
+    seconds by refresh(), which the periodic sweep calls, and subscribe()
+    adds new ones through schedule(). The heap holds wall-clock deadlines
+    derived from the database clock so app/DB timezone differences don't
+    shift them.
+    """
+
+    def __init__(self, horizon=HORIZON_SECONDS, chunk_size=SWEEP_CHUNK_SIZE):
+        self.horizon = horizon
+        self.chunk_size = chunk_size
+        self.expired = 0
+        self.recent = deque(maxlen=100)  # (subscription_id, user_id, lateness_seconds)
+        self._heap = []  # (deadline, subscription_id, user_id)
+        self._scheduled = set()
+        self._cond = threading.Condition()
+        self._stop = False
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='subscription-expiry', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5):
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def schedule(self, subscription_id, user_id, deadline):
+        """Adds a deadline (a time.time() timestamp) if it falls within the horizon."""
+        if deadline > time.time() + self.horizon:
+            return  # a later refresh() will pick it up
+        with self._cond:
+            if subscription_id in self._scheduled:
+                return
+            self._scheduled.add(subscription_id)
+            heapq.heappush(self._heap, (deadline, subscription_id, user_id))
+            if self._heap[0][1] == subscription_id:
+                self._cond.notify_all()
+
+    def refresh(self):
+        """Loads active subscriptions expiring within the horizon, in key-ordered chunks."""
+        last_id = 0
+        loaded = 0
+        while True:
+            with get_db_connection() as db, db.cursor() as cursor:
+                cursor.execute(SELECT_UPCOMING, (last_id, self.horizon, self.chunk_size))
+                rows = cursor.fetchall()
+            now = time.time()
+            for subscription_id, user_id, remaining in rows:
+                self.schedule(subscription_id, user_id, now + float(remaining))
+            loaded += len(rows)
+            if len(rows) < self.chunk_size:
+                return loaded
+            last_id = rows[-1][0]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stop:
+                    wait = self._heap[0][0] - time.time() if self._heap else None
+                    if wait is not None and wait <= 0:
+                        break
+                    self._cond.wait(wait)
+                if self._stop:
+                    return
+                now = time.time()
+                due = []
+                while self._heap and self._heap[0][0] <= now and len(due) < self.chunk_size:
+                    due.append(heapq.heappop(self._heap))
+            try:
+                self._expire(due)
+            except Exception as e:
+                logging.error("Error expiring subscriptions: %s", e)
+                with self._cond:
+                    for entry in due:
+                        heapq.heappush(self._heap, entry)
+                    self._cond.wait(5)  # back off before retrying the same batch
+            else:
+                with self._cond:
+                    self._scheduled.difference_update(entry[1] for entry in due)
+
+    def _expire(self, due):
+        ids = [subscription_id for _, subscription_id, _ in due]
+        placeholders = ', '.join(['%s'] * len(ids))
+        with get_db_connection() as db, db.cursor() as cursor:
+            # The status/expires_at guard skips subscriptions renewed since they were scheduled
+            db.begin()
+            cursor.execute(SELECT_DUE.format(ids=placeholders), ids)
+            expired_ids = {row[0] for row in cursor.fetchall()}
+            if expired_ids:
+                expired_placeholders = ', '.join(['%s'] * len(expired_ids))
+                cursor.execute(
+                    f"UPDATE subscriptions SET status = 'expired' WHERE id IN ({expired_placeholders})",
+                    list(expired_ids)
+                )
+            db.commit()
+
+        now = time.time()
+        entitlements = get_entitlement_index()
+        for deadline, subscription_id, user_id in due:
+            if subscription_id in expired_ids:
+                entitlements.invalidate(user_id)
+                lateness = now - deadline
+                self.recent.append((subscription_id, user_id, round(lateness, 3)))
+                logging.info("Subscription %s of user %s expired %.3fs after its deadline", subscription_id, user_id, lateness)
+        self.expired += len(expired_ids)
+
+    def stats(self):
+        with self._cond:
+            pending = len(self._heap)
+            next_deadline = self._heap[0][0] if self._heap else None
+        latenesses = [entry[2] for entry in self.recent]
+        return {
+            'scheduled': pending,
+            'next_due_in_seconds': round(next_deadline - time.time(), 3) if next_deadline else None,
+            'expired': self.expired,
+            'max_recent_lateness_seconds': max(latenesses, default=0),
+            'recent': list(self.recent),
+        }
+
+
+def get_expiry_engine():
+    """Returns the process-wide engine, starting its thread on first use."""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                engine = ExpiryEngine()
+                engine.start()
+                atexit.register(engine.stop)
+                _engine = engine
+    return _engine
+
+
+def run_expiry_sweep():
+    """Scheduled job: catch-up sweep, then reload the engine's upcoming deadlines."""
+    result = expired_subscriptions()
+    try:
+        get_expiry_engine().refresh()
+    except Exception as e:
+        logging.error("Error loading upcoming subscription expiries: %s", e)
+    return result
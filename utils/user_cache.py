@@ -0,0 +1,43 @@
+from collections import namedtuple
+
+from utils.cache import TTLCache
+from utils.config import get_section
+from utils.db import get_db_connection
+
+# What the authorization checks need to know about a user
+UserRecord = namedtuple('UserRecord', ['role', 'status', 'user_id'])
+
+SELECT_USER_RECORD = "SELECT role, status, id FROM users WHERE username = %s"
+
+_settings = get_section('cache')
+_users = TTLCache(
+    maxsize=_settings.getint('user_maxsize', 10000),
+    ttl=_settings.getfloat('user_ttl', 60),
+)
+
+
+def get_user_record(username):
+    """Returns the cached (role, status, user_id) of a user, or None if the user does not exist.
+
+    Entries live for user_ttl seconds. Writes made through this process call
+    invalidate_user() so they take effect immediately; other workers pick them
+    up once the entry expires.
+    """
+    record = _users.get(username)
+    if record is None:
+        with get_db_connection() as db, db.cursor() as cursor:
+            cursor.execute(SELECT_USER_RECORD, (username,))
+            row = cursor.fetchone()
+        if not row:
+            return None
+        record = UserRecord(*row)
+        _users.set(username, record)
+    return record
+
+
+def invalidate_user(username):
+    _users.pop(username)
+
+
+def user_cache_stats():
+    return _users.stats()
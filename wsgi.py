@@ -0,0 +1,9 @@
+"""WSGI entry point for production servers: gunicorn -c gunicorn.conf.py wsgi:app
+
+Background jobs are not started here. With preload_app the app is built
+once in the gunicorn master before it forks, and threads do not survive a
+fork, so each worker starts them from gunicorn.conf.py's post_worker_init.
+"""
+from app import create_app
+
+app = create_app(start_background=False)